@@ -1,5 +1,7 @@
 """Top-level module for MSAF."""
 
+import os
+
 # Import all submodules (for each task)
 import eval
 import featextract
@@ -38,14 +40,37 @@ class Dataset():
     audio_dir = "audio"
     estimations_dir = "estimations"
     features_dir = "features"
+    ledger_dir = "ledger"
     references_dir = "references"
 
     # Extensions
     estimations_ext = ".jams"
-    features_ext = ".json"
+    features_ext = ".npz"
+    ledger_ext = ".json"
     references_ext = ".jams"
     audio_exts = [".wav", "mp3", ".aif"]
 
+    # Manifest of the feature extraction runs
+    features_manifest = "features_manifest.json"
+
+
+# Content-addressed cache of the audio features (see feature_cache.py)
+class FeatureCache():
+    enabled = False     # Opt-in (featextract.py -c), it may take max_size
+    cache_dir = os.path.join(os.path.expanduser("~"), ".msaf", "features")
+    max_size = 10 * 2 ** 30     # In bytes
+
+
+# Cache of the self-similarity matrices (see ssm_cache.py)
+class SSMCache():
+    enabled = False
+    max_size = 2 ** 28  # Bytes of matrices kept in memory
+    cache_dir = None    # Directory to also keep them on disk (None: memory only)
+
+
+# Feature blocks and names stored in the features files
+feat_blocks = ["framesync", "est_beatsync", "ann_beatsync"]
+feat_names = ["hpcp", "mfcc", "tonnetz"]
 
 feat_dict = {
     'serra' :   'mix',
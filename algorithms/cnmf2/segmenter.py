@@ -16,7 +16,6 @@ import logging
 import numpy as np
 import time
 from scipy.spatial import distance
-from scipy.ndimage import filters
 import sys
 import pylab as plt
 
@@ -24,6 +23,7 @@ sys.path.append("../../")
 import msaf_io as MSAF
 #import eval as EV
 import utils as U
+import kernels as K
 try:
     import pymf
 except:
@@ -31,13 +31,6 @@ except:
     sys.exit()
 
 
-def median_filter(X, M=8):
-    """Median filter along the first axis of the feature matrix X."""
-    for i in xrange(X.shape[1]):
-        X[:, i] = filters.median_filter(X[:, i], size=M)
-    return X
-
-
 def mean_filter(x, M=9):
     """Average filter."""
     #window = np.ones(M) / float(M)
@@ -152,7 +145,7 @@ def get_boundaries(S, rank, R=9, niter=500, bound_idxs=None):
 
         # TODO: Order matters?
         W = np.sum(W, axis=1)
-        W = median_filter(W[:, np.newaxis], R)
+        W = K.median_filter(W[:, np.newaxis], R)
 
         #plt.imshow(W, interpolation="nearest", aspect="auto")
         #plt.show()
@@ -226,7 +219,7 @@ def process(in_path, feature="hpcp", annot_beats=False, annot_bounds=False,
 
     if F.shape[0] >= h:
         # Median filter
-        F = median_filter(F, M=h)
+        F = K.median_filter(F, M=h)
         #plt.imshow(F.T, interpolation="nearest", aspect="auto"); plt.show()
 
         # Self similarity matrix
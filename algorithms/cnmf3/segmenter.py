@@ -13,26 +13,19 @@ __email__ = "oriol@nyu.edu"
 
 import logging
 import numpy as np
-from scipy.ndimage import filters
-import sys
 
 from msaf.algorithms.interface import SegmenterInterface
+import msaf.factorization as NMF
+import msaf.kernels as K
 
+# PyMF is only needed for the Convex Hull NMF
 try:
     import pymf
-except:
-    logging.error("PyMF module not found, C-NMF won't work")
-    sys.exit()
+except ImportError:
+    pymf = None
 
 
-def median_filter(X, M=8):
-    """Median filter along the first axis of the feature matrix X."""
-    for i in xrange(X.shape[1]):
-        X[:, i] = filters.median_filter(X[:, i], size=M)
-    return X
-
-
-def cnmf(S, rank, niter=500, hull=False):
+def cnmf(S, rank, niter=500, hull=False, tol=1e-4, gram=None, init=None):
     """(Convex) Non-Negative Matrix Factorization.
 
     Parameters
@@ -42,7 +35,17 @@ def cnmf(S, rank, niter=500, hull=False):
     rank: int
         Rank of decomposition
     niter: int
-        Number of iterations to be used
+        Maximum number of iterations to be used
+    hull: boolean
+        Whether to use the Convex Hull NMF (requires PyMF)
+    tol: float
+        Convergence tolerance (see msaf.factorization.cnmf)
+    gram: tuple
+        Gram matrix of S (see msaf.factorization.compute_gram), to share it
+        among factorizations of S
+    init: tuple
+        Initial convex weights and activation matrices (W, G), to warm start
+        the factorization (None to initialize them with k-means)
 
     Returns
     -------
@@ -50,16 +53,18 @@ def cnmf(S, rank, niter=500, hull=False):
         Cluster matrix (decomposed matrix)
     G: np.array
         Activation matrix (decomposed matrix)
-        (s.t. S ~= F * G)
+    W: np.array
+        Convex weights matrix (None for the Convex Hull NMF)
+        (s.t. S ~= F * G = S * W * G)
     """
     if hull:
+        if pymf is None:
+            raise ImportError("PyMF module not found, C-HNMF won't work")
         nmf_mdl = pymf.CHNMF(S, num_bases=rank)
-    else:
-        nmf_mdl = pymf.CNMF(S, num_bases=rank)
-    nmf_mdl.factorize(niter=niter)
-    F = np.asarray(nmf_mdl.W)
-    G = np.asarray(nmf_mdl.H)
-    return F, G
+        nmf_mdl.factorize(niter=niter)
+        return np.asarray(nmf_mdl.W), np.asarray(nmf_mdl.H), None
+    W, G = (None, None) if init is None else init
+    return NMF.cnmf(S, rank, niter=niter, tol=tol, gram=gram, W=W, G=G)
 
 
 def most_frequent(x):
@@ -67,11 +72,11 @@ def most_frequent(x):
     return np.argmax(np.bincount(x))
 
 
-def compute_labels(X, rank, R, bound_idxs, niter=300):
+def compute_labels(X, rank, R, bound_idxs, niter=300, gram=None):
     """Computes the labels using the bounds."""
 
     try:
-        F, G = cnmf(X, rank, niter=niter, hull=False)
+        F, G, W = cnmf(X, rank, niter=niter, hull=False, gram=gram)
     except:
         return [1]
 
@@ -108,7 +113,7 @@ def filter_activation_matrix(G, R):
 
     # TODO: Order matters?
     G = np.sum(G, axis=1)
-    G = median_filter(G[:, np.newaxis], R)
+    G = K.median_filter(G[:, np.newaxis], R)
 
     return G.flatten()
 
@@ -146,21 +151,31 @@ def get_segmentation(X, rank, R, rank_labels, R_labels, niter=300,
     #plt.imshow(X, interpolation="nearest", aspect="auto")
     #plt.show()
 
-    # Find non filtered boundaries
+    # Find non filtered boundaries, computing the Gram matrix of X only once
+    # for all the factorizations
+    gram = None
+    init = None
+    W, G = None, None
     while True:
         if bound_idxs is None:
             try:
-                F, G = cnmf(X, rank, niter=niter, hull=False)
+                if gram is None:
+                    gram = NMF.compute_gram(X)
+                F, G, W = cnmf(X, rank, niter=niter, hull=False, gram=gram,
+                               init=init)
             except:
                 return np.empty(0), [1]
 
-            # Filter G
-            G = filter_activation_matrix(G.T, R)
+            # Filter a copy of G (G itself warm starts the next rank)
+            G_filt = filter_activation_matrix(G.T.copy(), R)
             if bound_idxs is None:
-                bound_idxs = np.where(np.diff(G) != 0)[0] + 1
+                bound_idxs = np.where(np.diff(G_filt) != 0)[0] + 1
 
         # Increase rank if we found too few boundaries
         if len(np.unique(bound_idxs)) <= 2:
+            # Warm start the next factorization with one more component
+            if G is not None:
+                init = NMF.add_component(X, W, G)
             rank += 1
             bound_idxs = None
         else:
@@ -170,7 +185,8 @@ def get_segmentation(X, rank, R, rank_labels, R_labels, niter=300,
     bound_idxs = np.concatenate(([0], bound_idxs, [X.shape[1]-1]))
     bound_idxs = np.asarray(bound_idxs, dtype=int)
     if in_labels is None:
-        labels = compute_labels(X, rank_labels, R_labels, bound_idxs)
+        labels = compute_labels(X, rank_labels, R_labels, bound_idxs,
+                                gram=gram)
     else:
         labels = np.ones(len(bound_idxs) - 1)
 
@@ -200,7 +216,7 @@ class Segmenter(SegmenterInterface):
 
         if F.shape[0] >= self.config["h"]:
             # Median filter
-            F = median_filter(F, M=self.config["h"])
+            F = K.median_filter(F, M=self.config["h"])
             #plt.imshow(F.T, interpolation="nearest", aspect="auto"); plt.show()
 
             # Find the boundary indices and labels using matrix factorization
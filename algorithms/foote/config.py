@@ -4,7 +4,9 @@
 config = {
     "M_gaussian"    : 24,
     "m_median"      : 1,
-    "L_peaks"       : 24
+    "L_peaks"       : 24,
+    "banded_ssm"    : True     # Compute only the band of the SSM used by the
+                               # kernel (linear memory, same results)
 }
 
 algo_id = "foote"
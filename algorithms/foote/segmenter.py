@@ -17,18 +17,12 @@ __email__ = "oriol@nyu.edu"
 
 import logging
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 from scipy.spatial import distance
 from scipy import signal
-from scipy.ndimage import filters
 
 from msaf.algorithms.interface import SegmenterInterface
-
-
-def median_filter(X, M=8):
-    """Median filter along the first axis of the feature matrix X."""
-    for i in xrange(X.shape[1]):
-        X[:, i] = filters.median_filter(X[:, i], size=M)
-    return X
+import msaf.kernels as K
 
 
 def compute_gaussian_krnl(M):
@@ -42,21 +36,107 @@ def compute_gaussian_krnl(M):
 
 def compute_ssm(X, metric="seuclidean"):
     """Computes the self-similarity matrix of X."""
-    D = distance.pdist(X, metric=metric)
+    return distances_to_ssm(distance.pdist(X, metric=metric))
+
+
+def distances_to_ssm(D):
+    """Self-similarity matrix of the condensed distances D (see
+    scipy.spatial.distance.pdist)."""
     D = distance.squareform(D)
     D /= D.max()
     return 1 - D
 
 
-def compute_nc(X, G):
-    """Computes the novelty curve from the self-similarity matrix X and
-        the gaussian kernel G."""
+def compute_ssm_band(X, width, metric="seuclidean", block_size=2 ** 22):
+    """Computes the band of the self-similarity matrix of X around its main
+    diagonal, in linear memory.
+
+    The normalization is the same as in compute_ssm (i.e. by the maximum
+    distance of the whole matrix), computed in blocks of rows.
+
+    Parameters
+    ----------
+    X : np.array((N, F))
+        Feature matrix.
+    width : int
+        Width of the band (i.e. number of lags, including the main diagonal).
+    metric : str
+        Distance metric (see scipy.spatial.distance.cdist).
+    block_size : int
+        Maximum number of distances computed at once.
+
+    Returns
+    -------
+    B : np.array((N, width))
+        Band of the self-similarity matrix, where B[i, l] is the similarity
+        between the frames i and i + l (zero for i + l >= N).
+    """
+    X = np.asarray(X, dtype=np.float64)
+    N = X.shape[0]
+    kwargs = {}
+    if metric == "seuclidean":
+        # Variances of the whole matrix, as pdist does
+        kwargs["V"] = np.var(X, axis=0, ddof=1)
+
+    D = np.zeros((N, width))
+    max_dist = 0
+    n_rows = max(1, block_size // max(N, 1))
+    lags = np.arange(width)
+    for start in xrange(0, N, n_rows):
+        end = min(N, start + n_rows)
+        D_rows = distance.cdist(X[start:end], X, metric=metric, **kwargs)
+        max_dist = max(max_dist, D_rows.max())
+
+        # Keep only the band
+        rows, cols = np.indices((end - start, width))
+        cols = cols + rows + start
+        valid = cols < N
+        D[start:end][valid] = D_rows[rows[valid], cols[valid]]
+
+    B = 1 - D / max_dist
+    B[np.arange(N)[:, np.newaxis] + lags >= N] = 0
+    return B
+
+
+def ssm_to_band(X, width):
+    """Gets the band of the self-similarity matrix X around its main
+        diagonal, in the format of compute_ssm_band."""
     N = X.shape[0]
-    M = G.shape[0]
+    cols = np.arange(N)[:, np.newaxis] + np.arange(width)
+    B = X[np.arange(N)[:, np.newaxis], np.minimum(cols, N - 1)]
+    B[cols >= N] = 0
+    return B
+
+
+def compute_lag_kernel(G):
+    """Folds the symmetric checkerboard kernel G by lags, so that it can be
+        applied to the band of the self-similarity matrix: K[a, l] weights
+        the similarity between the frames a and a + l of the block."""
+    w = G.shape[0] / 2 * 2
+    K = np.zeros((w, w))
+    a = np.arange(w)
+    K[:, 0] = G[a, a]
+    for l in xrange(1, w):
+        K[:w - l, l] = G[a[:w - l], a[l:]] + G[a[l:], a[:w - l]]
+    return K
+
+
+def compute_nc_band(B, G):
+    """Computes the novelty curve from the band B of the self-similarity
+        matrix (see compute_ssm_band) and the gaussian kernel G, for all the
+        frames at once. The result is the same as compute_nc on the full
+        matrix."""
+    N = B.shape[0]
+    K = compute_lag_kernel(G)
+    w = K.shape[0]
     nc = np.zeros(N)
 
-    for i in xrange(M / 2, N - M / 2 + 1):
-        nc[i] = np.sum(X[i - M / 2:i + M / 2, i - M / 2:i + M / 2] * G)
+    if N >= w:
+        # View of the band of each block of w frames (without copying it)
+        B = np.ascontiguousarray(B[:, :w])
+        blocks = as_strided(B, shape=(N - w + 1, w, w),
+                            strides=(B.strides[0],) + B.strides)
+        nc[w / 2:N - w / 2 + 1] = np.einsum("tal,al->t", blocks, K)
 
     # Normalize
     nc += nc.min()
@@ -64,31 +144,44 @@ def compute_nc(X, G):
     return nc
 
 
+def compute_nc(X, G):
+    """Computes the novelty curve from the self-similarity matrix X and
+        the gaussian kernel G."""
+    return compute_nc_band(ssm_to_band(X, G.shape[0]), G)
+
+
+def compute_ncs(S, Ms, banded=True):
+    """Computes the novelty curves for several kernel sizes at once, reusing
+    the same self-similarity matrix.
+
+    Parameters
+    ----------
+    S : np.array
+        Self-similarity matrix (N x N), or its band (see compute_ssm_band)
+        if banded. The band must be at least as wide as the largest kernel.
+    Ms : list
+        Sizes of the gaussian checkerboard kernels.
+    banded : bool
+        Whether S is the band of the self-similarity matrix.
+
+    Returns
+    -------
+    ncs : list
+        Novelty curves, one per kernel size.
+    """
+    if not banded:
+        S = ssm_to_band(S, max(Ms))
+    return [compute_nc_band(S, compute_gaussian_krnl(M)) for M in Ms]
+
+
 def pick_peaks(nc, L=16):
     """Obtain peaks from a novelty curve using an adaptive threshold."""
-    offset = nc.mean() / 2.
-
-    th = filters.median_filter(nc, size=L) + offset
-    #th = filters.gaussian_filter(nc, sigma=L/2., mode="nearest") + offset
+    #th = K.adaptive_threshold(nc, L=L, offset_coef=0.5)
 
-    nc = filters.gaussian_filter1d(nc, sigma=2)  # Hack for Musichackathon
+    nc = K.gaussian_filter(nc, M=4)  # Hack for Musichackathon
     th = np.zeros(len(nc))  # Hack continues
 
-    peaks = []
-    for i in xrange(1, nc.shape[0] - 1):
-        # is it a peak?
-        if nc[i - 1] < nc[i] and nc[i] > nc[i + 1]:
-            # is it above the threshold?
-            if nc[i] > th[i]:
-                peaks.append(i)
-    #import pylab as plt
-    #plt.plot(nc)
-    #plt.plot(th)
-    #for peak in peaks:
-        #plt.axvline(peak)
-    #plt.show()
-
-    return peaks
+    return K.pick_peaks(nc, th)
 
 
 class Segmenter(SegmenterInterface):
@@ -105,18 +198,32 @@ class Segmenter(SegmenterInterface):
         F, frame_times, dur, bound_idxs = self._preprocess()
 
         # Median filter
-        F = median_filter(F, M=self.config["m_median"])
+        F = K.median_filter(F, M=self.config["m_median"])
         #plt.imshow(F.T, interpolation="nearest", aspect="auto"); plt.show()
 
-        # Self similarity matrix
-        S = compute_ssm(F)
-
         # Compute gaussian kernel
-        G = compute_gaussian_krnl(self.config["M_gaussian"])
-        #plt.imshow(G, interpolation="nearest", aspect="auto"); plt.show()
+        M = self.config["M_gaussian"]
+
+        # Distances of the features shared through the SSM cache
+        preprocessing = dict(m_median=self.config["m_median"])
+        D = None
+        if self.config["banded_ssm"]:
+            # Only use them if they have already been computed
+            D = self._find_distances(F, "seuclidean", **preprocessing)
+        else:
+            D = self._get_distances(F, "seuclidean", **preprocessing)
+
+        if D is None:
+            # Only the band of the self similarity matrix read by the kernel
+            S = compute_ssm_band(F, M)
+            banded = True
+        else:
+            # Self similarity matrix
+            S = distances_to_ssm(D)
+            banded = False
 
         # Compute the novelty curve
-        nc = compute_nc(S, G)
+        nc = compute_ncs(S, [M], banded=banded)[0]
 
         # Find peaks in the novelty curve
         bound_idxs = pick_peaks(nc, L=self.config["L_peaks"])
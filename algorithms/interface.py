@@ -1,6 +1,7 @@
 """Interface for all the algorithms in MSAF."""
 import numpy as np
 import msaf.input_output as io
+import msaf.ssm_cache as ssm_cache
 import msaf.utils as U
 
 __author__ = "Oriol Nieto"
@@ -63,24 +64,21 @@ class SegmenterInterface:
         this interface."""
         raise NotImplementedError("This method must be implemented")
 
-    def _preprocess(self, valid_features=["hpcp", "tonnetz", "mfcc"],
-                    normalize=True):
-        """This method obtains the actual features, their frame times,
-        and the boundary indeces in these features if needed."""
-        # Read features
+    def _read_features(self):
+        """Reads the frame times and the duration of the track, either from
+        the features passed in memory (self.features) or from its features
+        file. The feature matrices are then obtained with _get_feature."""
         if self.features is None:
-            # Features stored in a json file
-            self.hpcp, self.mfcc, self.tonnetz, beats, dur, anal = \
-                io.get_features(self.audio_file, annot_beats=self.annot_beats,
-                                framesync=self.framesync)
+            # Features stored in a binary file, only the ones that are
+            # actually used will be read
+            self._features_handle = io.FeatureHandle(
+                self.audio_file, annot_beats=self.annot_beats,
+                framesync=self.framesync)
+            beats = self._features_handle.beats
+            dur = self._features_handle.dur
+            anal = self._features_handle.analysis
         else:
             # Features passed as parameters
-            feat_prefix = ""
-            if not self.framesync:
-                feat_prefix = "bs_"
-            self.hpcp = self.features["%shpcp" % feat_prefix]
-            self.mfcc = self.features["%smfcc" % feat_prefix]
-            self.tonnetz = self.features["%stonnetz" % feat_prefix]
             beats = self.features["beats"]
             dur = self.features["anal"]["dur"]
             anal = self.features["anal"]
@@ -93,6 +91,15 @@ class SegmenterInterface:
         if self.framesync:
             frame_times = U.get_time_frames(dur, anal)
 
+        return frame_times, dur
+
+    def _preprocess(self, valid_features=["hpcp", "tonnetz", "mfcc"],
+                    normalize=True):
+        """This method obtains the actual features, their frame times,
+        and the boundary indeces in these features if needed."""
+        # Read features
+        frame_times, dur = self._read_features()
+
         # Read input bounds if necessary
         bound_idxs = None
         if self.in_bound_times is not None:
@@ -106,7 +113,7 @@ class SegmenterInterface:
                                (self.feature_str, __name__, valid_features))
         else:
             try:
-                F = eval("self." + self.feature_str)
+                F = self._get_feature(self.feature_str)
             except:
                 raise RuntimeError("Feature %s in not supported by MSAF" %
                                    (self.feature_str))
@@ -117,6 +124,43 @@ class SegmenterInterface:
 
         return F, frame_times, dur, bound_idxs
 
+    def _get_feature(self, feat_name):
+        """Gets the feature matrix feat_name (e.g. "hpcp") for the current
+        synchronization. When reading from disk, only this feature is read,
+        and only once. It must be called after _preprocess (or
+        _read_features)."""
+        if self.features is None:
+            return self._features_handle[feat_name]
+        feat_prefix = ""
+        if not self.framesync:
+            feat_prefix = "bs_"
+        return self.features[feat_prefix + feat_name]
+
+    def _describe_features(self, params):
+        """Parameters that identify the features in the SSM cache: the
+        feature, its synchronization, plus the given params (e.g. the
+        preprocessing)."""
+        description = dict(feature=self.feature_str,
+                           framesync=self.framesync,
+                           annot_beats=self.annot_beats)
+        description.update(params)
+        return description
+
+    def _get_distances(self, X, metric, **params):
+        """Gets the condensed distances between the frames (rows) of X from
+        the SSM cache, so that they are computed only once per track and
+        shared by all the matrices derived from them. The params describe
+        the preprocessing of X (and override the feature if X is not
+        self.feature_str)."""
+        return ssm_cache.get_distances(X, metric,
+                                       **self._describe_features(params))
+
+    def _find_distances(self, X, metric, **params):
+        """Like _get_distances, but returns None instead of computing the
+        distances if they are not in the SSM cache."""
+        return ssm_cache.find_distances(X, metric,
+                                        **self._describe_features(params))
+
     def _postprocess(self, est_times, est_labels):
         """Post processes the estimations from the algorithm, removing empty
         segments and making sure the lenghts of the boundaries and labels
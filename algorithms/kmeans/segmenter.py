@@ -17,7 +17,6 @@ import logging
 import numpy as np
 import time
 from scipy.spatial import distance
-from scipy.ndimage import filters
 from scipy.cluster.vq import whiten, vq, kmeans
 import sys
 import pylab as plt
@@ -25,13 +24,7 @@ import pylab as plt
 sys.path.append("../../")
 import msaf_io as MSAF
 import utils as U
-
-
-def median_filter(X, M=8):
-    """Median filter along the first axis of the feature matrix X."""
-    for i in xrange(X.shape[1]):
-        X[:, i] = filters.median_filter(X[:, i], size=M)
-    return X
+import kernels as K
 
 
 def mean_filter(x, M=9):
@@ -67,29 +60,8 @@ def compute_nc(X, G):
 
 def pick_peaks(nc, L=16):
     """Obtain peaks from a novelty curve using an adaptive threshold."""
-    offset = nc.mean() / 2.
-    th = filters.median_filter(nc, size=L) + offset
-    #th = filters.gaussian_filter(nc, sigma=L/2., mode="nearest") + offset
-    peaks = []
-
-    k_hill = 0
-    hill = False
-    for i in xrange(1, nc.shape[0] - 1):
-        # is it above the threshold?
-        if nc[i] > th[i]:
-            # is it a peak?
-            if nc[i - 1] < nc[i] and nc[i] > nc[i + 1]:
-                    k_hill = 0
-                    hill = False
-                    peaks.append(i)
-            # is it a flat hill?
-            if nc[i - 1] == nc[i] and nc[i] == nc[i - 1]:
-                hill = True
-                k_hill += 1
-        elif hill:
-            peaks.append(i - k_hill / 2)
-            k_hill = 0
-            hill = False
+    th = K.adaptive_threshold(nc, L=L, offset_coef=0.5)
+    peaks = K.pick_peaks(nc, th, flat_hills=True)
 
     #plt.plot(nc)
     #plt.plot(th)
@@ -176,7 +148,7 @@ def process(in_path, feature="hpcp", annot_beats=False):
 
     if F.shape[0] >= m:
         # Median filter
-        F = median_filter(F, M=m)
+        F = K.median_filter(F, M=m)
         #plt.imshow(F.T, interpolation="nearest", aspect="auto"); plt.show()
 
         # Self similarity matrix
@@ -2,6 +2,7 @@
 #
 # Ordinal LDA
 
+import copy
 import itertools
 import numpy as np
 import scipy.linalg
@@ -107,6 +108,31 @@ class OLDA(BaseEstimator, TransformerMixin):
                 prev_mean = seg_mean
                 prev_length = seg_length
         
+        return self._decompose()
+
+    def regularize(self, sigma):
+        '''Copy of the fitted model with another regularization parameter,
+        without refitting it
+
+        Parameters
+        ----------
+        sigma : float
+            Regularization parameter
+
+        Returns
+        -------
+        model : OLDA
+        '''
+
+        model = copy.deepcopy(self)
+        model.scatter_within_ = self.scatter_within_ + \
+            (sigma - self.sigma) * np.eye(len(self.scatter_within_))
+        model.sigma = sigma
+        return model._decompose()
+
+    def _decompose(self):
+        '''Solves the generalized eigenvalue problem of the scatter matrices'''
+
         e_vals, e_vecs = scipy.linalg.eig(self.scatter_ordinal_, self.scatter_within_)
         self.e_vals_ = e_vals
         self.e_vecs_ = e_vecs
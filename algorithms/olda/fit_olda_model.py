@@ -5,6 +5,7 @@ import sys
 import argparse
 import numpy as np
 import glob
+import itertools
 
 import mir_eval
 import cPickle as pickle
@@ -13,6 +14,7 @@ from joblib import Parallel, delayed
 
 import OLDA
 import segmenter
+import make_train
 
 import msaf
 from msaf import jams2
@@ -27,7 +29,9 @@ def process_arguments():
 
     parser.add_argument('input_file',
                         action = 'store',
-                        help = 'path to training data (from make_*_train.py)')
+                        help = 'path to training data (from make_*_train.py), '
+                        'or to the output dir of make_train.py -s (streamed '
+                        'one track at a time)')
 
     parser.add_argument('output_file',
                         action = 'store',
@@ -52,6 +56,21 @@ def process_arguments():
                         default="*",
                         help="The prefix of the dataset to use "
                         "(e.g. Isophonics, SALAMI)")
+    parser.add_argument("-s",
+                        "--state",
+                        action="store",
+                        dest="state_file",
+                        default=None,
+                        help="Path to the fitted scatter matrices. If it "
+                        "exists, only the new tracks are added to them "
+                        "(keeping their sigma). It is saved after fitting")
+    parser.add_argument("-B",
+                        "--batch-size",
+                        action="store",
+                        dest="batch_size",
+                        type=int,
+                        default=32,
+                        help="Number of tracks per call to partial_fit")
     return vars(parser.parse_args(sys.argv[1:]))
 
 
@@ -69,6 +88,42 @@ def load_data(input_file):
     return X, Y, B, T
 
 
+def iter_tracks(input_file, ds_path, annot_beats=False, ds_name="*"):
+    '''Generates the training tracks, as dictionaries with the features,
+    segments, beats, segment_times and filename of each one. They are read
+    one at a time from the shards of input_file if it is a directory, or
+    from the training data file otherwise.'''
+
+    if os.path.isdir(input_file):
+        shard_files = make_train.get_shard_files(input_file, annot_beats,
+                                                 ds_name)
+        for d in make_train.load_shards(shard_files):
+            yield d
+        return
+
+    with open(input_file, 'r') as f:
+        data = pickle.load(f)
+    X, Y, B, T = data[:4]
+    if len(data) > 4:
+        F = data[4]
+    else:
+        # Older training files don't keep the filenames
+        F = glob.glob(os.path.join(ds_path,
+                                   msaf.Dataset.references_dir,
+                                   ds_name + "_*.jams"))
+    for x, y, b, t, f in zip(X, Y, B, T, F):
+        yield {'features': x, 'segments': y, 'beats': b, 'segment_times': t,
+               'filename': f}
+
+
+def has_annot_beats(filename, ds_path):
+    jam_file = os.path.join(ds_path, msaf.Dataset.references_dir,
+                            os.path.splitext(os.path.basename(filename))[0] +
+                            msaf.Dataset.references_ext)
+    jam = jams2.load(jam_file)
+    return jam.beats != [] and jam.beats[0].data != []
+
+
 def score_model(model, x, b, t):
 
     # First, transform the data
@@ -97,55 +152,85 @@ def score_model(model, x, b, t):
     return score
 
 
-def fit_model(X, Y, B, T, n_jobs, annot_beats, ds_path, ds_name):
+def score_track(models, d, annot_beats, ds_path):
+    '''Scores all the models on a track (None if it has to be skipped)'''
 
-    SIGMA = 10 ** np.arange(-2, 18)
+    if annot_beats and not has_annot_beats(d['filename'], ds_path):
+        return None
+    print "\t\tProcessing ", d['filename']
+    return [score_model(model, d['features'], d['beats'],
+                        d['segment_times']) for model in models]
 
-    best_score = -np.inf
-    best_sigma = None
-    model = None
 
-    print len(X)
+def fit_scatter(tracks, model, batch_size=32):
+    '''Streams the tracks through model.partial_fit, batch_size at a time,
+    so that only one batch is in memory. Returns the filenames of the
+    tracks.'''
 
-    for sig in SIGMA:
-        O = OLDA.OLDA(sigma=sig)
-        O.fit(X, Y)
+    filenames = []
+    while True:
+        batch = list(itertools.islice(tracks, batch_size))
+        if len(batch) == 0:
+            break
+        model.partial_fit([d['features'] for d in batch],
+                          [d['segments'] for d in batch])
+        filenames.extend([d['filename'] for d in batch])
 
-        scores = []
-        files = glob.glob(os.path.join(ds_path,
-                                       msaf.Dataset.references_dir,
-                                       ds_name + "_*.jams"))[:]
-        for f, z in zip(files, zip(X, B, T)):
-            if annot_beats:
-                jam = jams2.load(f)
-                if jam.beats == []:
-                    continue
-                if jam.beats[0].data == []:
-                    continue
-            print "\t\tProcessing ", f
-            scores.append(score_model(O.components_, *z))
-        #scores = Parallel(n_jobs=n_jobs)( delayed(score_model)(O.components_, *z) for z in zip(X, B, T))
+    return filenames
 
-        mean_score = np.mean(scores)
-        print 'Sigma=%.2e, score=%.3f' % (sig, mean_score)
 
-        if mean_score > best_score:
-            best_score = mean_score
-            best_sigma = sig
-            model = O.components_
+def fit_model(input_file, n_jobs, annot_beats, ds_path, ds_name,
+              state_file=None, batch_size=32):
 
-    print 'Best sigma: %.2e' % best_sigma
-    return model
+    SIGMA = 10. ** np.arange(-2, 18)
+
+    if state_file is not None and os.path.isfile(state_file):
+        # Add the new tracks to the fitted scatter matrices
+        with open(state_file, 'r') as f:
+            O, filenames = pickle.load(f)
+        known = set(filenames)
+        tracks = (d for d in iter_tracks(input_file, ds_path, annot_beats,
+                                         ds_name)
+                  if d['filename'] not in known)
+        new_filenames = fit_scatter(tracks, O, batch_size)
+        filenames.extend(new_filenames)
+        print '%d new tracks, sigma=%.2e' % (len(new_filenames), O.sigma)
+    else:
+        # The scatter matrices are accumulated once, in a single pass, and
+        # only their regularization depends on sigma
+        O = OLDA.OLDA(sigma=SIGMA[0])
+        filenames = fit_scatter(iter_tracks(input_file, ds_path,
+                                            annot_beats, ds_name),
+                                O, batch_size)
+        print len(filenames)
+        models = [O.regularize(sig) for sig in SIGMA]
+
+        # Score all the sigmas in a single (parallel) pass over the tracks
+        scores = Parallel(n_jobs=n_jobs)(
+            delayed(score_track)([model.components_ for model in models], d,
+                                 annot_beats, ds_path)
+            for d in iter_tracks(input_file, ds_path, annot_beats, ds_name))
+        mean_scores = np.mean([s for s in scores if s is not None], axis=0)
+
+        for sig, mean_score in zip(SIGMA, mean_scores):
+            print 'Sigma=%.2e, score=%.3f' % (sig, mean_score)
+
+        O = models[np.argmax(mean_scores)]
+        print 'Best sigma: %.2e' % O.sigma
+
+    if state_file is not None:
+        with open(state_file, 'w') as f:
+            pickle.dump((O, filenames), f)
+
+    return O.components_
 
 if __name__ == '__main__':
     parameters = process_arguments()
 
-    print "Loading data from %s ..." % parameters["input_file"]
-    X, Y, B, T = load_data(parameters['input_file'])[:4]
-
-    print "Fitting model..."
-    model = fit_model(X, Y, B, T, parameters['num_jobs'],
+    print "Fitting model from %s ..." % parameters["input_file"]
+    model = fit_model(parameters['input_file'], parameters['num_jobs'],
                       parameters['annot_beats'], parameters['ds_path'],
-                      parameters['ds_name'])
+                      parameters['ds_name'], parameters['state_file'],
+                      parameters['batch_size'])
 
     np.save(parameters['output_file'], model)
@@ -79,11 +79,29 @@ def get_annotation(song, rootpath):
     return '%s/annotations/%s.jams' % (rootpath, os.path.basename(song)[:-4])
 
 
+def get_shard_file(song, output_path, annot_beats):
+    '''Path to the training data (shard) of a song'''
+    return '%s/features/%s_annotbeatsE%d.pickle' % \
+        (output_path, os.path.splitext(os.path.basename(song))[0], annot_beats)
+
+
+def get_shard_files(output_path, annot_beats=False, ds_name="*"):
+    '''Paths to all the shards of a dataset already extracted'''
+    return sorted(glob.glob(get_shard_file(ds_name + "_*", output_path,
+                                           annot_beats)))
+
+
+def load_shards(shard_files):
+    '''Generates the training data of the shards, one at a time'''
+    for shard_file in shard_files:
+        with open(shard_file, 'r') as f:
+            yield pickle.load(f)
+
+
 def import_data(song, rootpath, output_path, annot_beats):
     msaf.utils.ensure_dir(output_path)
     msaf.utils.ensure_dir(os.path.join(output_path, "features"))
-    data_file = '%s/features/%s_annotbeatsE%d.pickle' % \
-        (output_path, os.path.splitext(os.path.basename(song))[0], annot_beats)
+    data_file = get_shard_file(song, output_path, annot_beats)
 
     if os.path.exists(data_file):
         with open(data_file, 'r') as f:
@@ -121,9 +139,18 @@ def import_data(song, rootpath, output_path, annot_beats):
     return Data
 
 
-def make_dataset(n=None, n_jobs=1, rootpath='', output_path='',
-                 annot_beats=False, ds_name="*"):
+def import_shard(song, rootpath, output_path, annot_beats):
+    '''Extracts the training data of a song, and returns the path to its
+    shard (None if it could not be extracted), so that the data itself is not
+    sent back to the main process'''
+    shard_file = get_shard_file(song, output_path, annot_beats)
+    if not os.path.exists(shard_file) and \
+            import_data(song, rootpath, output_path, annot_beats) is None:
+        return None
+    return shard_file
+
 
+def get_audio_files(rootpath, ds_name="*", n=None):
     audio_files = glob.glob(os.path.join(rootpath,
                                          msaf.Dataset.audio_dir,
                                          ds_name + "_*.[wm][ap][v3]"))
@@ -131,9 +158,27 @@ def make_dataset(n=None, n_jobs=1, rootpath='', output_path='',
     if n is None:
         n = len(audio_files)
 
+    return audio_files[:n]
+
+
+def make_shards(n=None, n_jobs=1, rootpath='', output_path='',
+                annot_beats=False, ds_name="*"):
+    '''Extracts the training data of each song in parallel, into one shard
+    per song (see load_shards), without keeping it in memory'''
+
+    shard_files = Parallel(n_jobs=n_jobs)(delayed(import_shard)(song,
+            rootpath, output_path, annot_beats)
+            for song in get_audio_files(rootpath, ds_name, n))
+
+    return [shard_file for shard_file in shard_files if shard_file is not None]
+
+
+def make_dataset(n=None, n_jobs=1, rootpath='', output_path='',
+                 annot_beats=False, ds_name="*"):
+
     data = Parallel(n_jobs=n_jobs)(delayed(import_data)(song,
             rootpath, output_path, annot_beats)
-            for song in audio_files[:n])
+            for song in get_audio_files(rootpath, ds_name, n))
 
     X, Y, B, T, F, L = [], [], [], [], [], []
     for d in data:
@@ -183,10 +228,27 @@ if __name__ == '__main__':
                         default="*",
                         help="The prefix of the dataset to use "
                         "(e.g. Isophonics, SALAMI)")
+    parser.add_argument("-s",
+                        action="store_true",
+                        dest="shards_only",
+                        help="Only extract the per-track shards (to train "
+                        "with fit_olda_model.py on output_path)",
+                        default=False)
     args = parser.parse_args()
     start_time = time.time()
     salami_path = sys.argv[1]
     output_path = sys.argv[2]
+    if args.shards_only:
+        shard_files = make_shards(n=args.n,
+                                  n_jobs=args.n_jobs,
+                                  rootpath=args.ds_path,
+                                  output_path=args.output_path,
+                                  annot_beats=args.annot_beats,
+                                  ds_name=args.ds_name)
+        print "%d shards in %s/features" % (len(shard_files),
+                                           args.output_path)
+        sys.exit()
+
     X, Y, B, T, F, L = make_dataset(n=args.n,
                                     n_jobs=args.n_jobs,
                                     rootpath=args.ds_path,
@@ -16,9 +16,12 @@ import sys
 import numpy as np
 import scipy.signal
 import scipy.linalg
+import sklearn.cluster
+import sklearn.feature_extraction
 
 import librosa
 import msaf
+import msaf.kernels as K
 
 from msaf.algorithms.interface import SegmenterInterface
 
@@ -33,11 +36,73 @@ N_REP = 32
 __DIMENSION = N_MFCC + N_CHROMA + 2 * N_REP + 4
 
 
+def compress_data(X, k):
+    '''Projects X on the k leading eigenvectors of X * X^T (i.e. the left
+    singular vectors of X), normalized by the leading singular value of X.
+    '''
+    if not np.all(np.isfinite(X)):
+        logging.warning("Non-finite repetition features, setting them to 0")
+        X = np.where(np.isfinite(X), X, 0)
+
+    Xtemp = X.dot(X.T)
+    if len(Xtemp) == 0:
+        return None
+
+    # Only the k leading eigenpairs of the symmetric X * X^T
+    n = len(Xtemp)
+    try:
+        e_vals, e_vecs = scipy.linalg.eigh(Xtemp,
+                                           eigvals=(max(0, n - k), n - 1))
+    except np.linalg.LinAlgError:
+        logging.warning("Symmetric eigensolver did not converge, using the "
+                        "general one")
+        e_vals, e_vecs = np.linalg.eig(Xtemp)
+
+    e_vals = np.maximum(0.0, np.real(e_vals))
+    e_vecs = np.real(e_vecs)
+
+    # Truncate to the k largest ones
+    idx = np.argsort(e_vals)[::-1][:k]
+
+    e_vals = e_vals[idx]
+    e_vecs = e_vecs[:, idx]
+
+    # Normalize by the leading singular value of X
+    Z = np.sqrt(e_vals.max())
+
+    if Z > 0:
+        e_vecs = e_vecs / Z
+
+    return e_vecs.T.dot(X)
+
+
 def features(audio_path, annot_beats=False):
-    '''Feature-extraction for audio segmentation
+    '''Feature-extraction for audio segmentation, from the features file
+    of the song (see compute_features)
     Arguments:
         audio_path -- str
         path to the input song in the Segmentation dataset
+    '''
+    print '\tloading annotations and features of ', audio_path
+    chroma, mfcc, tonnetz, beats, dur, anal = msaf.io.get_features(audio_path, annot_beats)
+
+    return compute_features(chroma, mfcc, beats, dur)
+
+
+def compute_features(chroma, mfcc, beats, dur):
+    '''Feature-extraction for audio segmentation
+    Arguments:
+        chroma -- ndarray
+        beat-synchronous chromagram (one beat per row)
+
+        mfcc -- ndarray
+        beat-synchronous MFCC (one beat per row)
+
+        beats -- array
+        beat times in seconds
+
+        dur -- float
+        duration of the track in seconds
 
     Returns:
         - X -- ndarray
@@ -58,33 +123,6 @@ def features(audio_path, annot_beats=False):
             duration of the track in seconds
 
     '''
-    def compress_data(X, k):
-        Xtemp = X.dot(X.T)
-        if len(Xtemp) == 0:
-            return None
-        e_vals, e_vecs = np.linalg.eig(Xtemp)
-
-        e_vals = np.maximum(0.0, np.real(e_vals))
-        e_vecs = np.real(e_vecs)
-
-        idx = np.argsort(e_vals)[::-1]
-
-        e_vals = e_vals[idx]
-        e_vecs = e_vecs[:, idx]
-
-        # Truncate to k dimensions
-        if k < len(e_vals):
-            e_vals = e_vals[:k]
-            e_vecs = e_vecs[:, :k]
-
-        # Normalize by the leading singular value of X
-        Z = np.sqrt(e_vals.max())
-
-        if Z > 0:
-            e_vecs = e_vecs / Z
-
-        return e_vecs.T.dot(X)
-
     # Latent factor repetition features
     def repetition(X, metric='seuclidean'):
         R = librosa.segment.recurrence_matrix(X,
@@ -101,10 +139,6 @@ def features(audio_path, annot_beats=False):
 
         return compress_data(P, N_REP)
 
-    #########
-    print '\tloading annotations and features of ', audio_path
-    chroma, mfcc, tonnetz, beats, dur, anal = msaf.io.get_features(audio_path, annot_beats)
-
     # Sampling Rate
     sr = 11025
 
@@ -120,7 +154,7 @@ def features(audio_path, annot_beats=False):
 
     #########
     # Get the beat-sync chroma
-    C = chroma.T
+    C = np.array(chroma.T)
     C += C.min() + 0.1
     C = C / C.max(axis=0)
     C = 80 * np.log10(C)  # Normalize from -80 to 0
@@ -171,41 +205,82 @@ def gaussian_cost(X):
     return cost
 
 
-def clustering_cost(X, boundaries):
+def clustering_cost(X, boundaries, moments=None):
+    '''Cost of a segmentation of X. moments are the cumulative sums of X
+    (see msaf.kernels.segment_moments), to avoid recomputing them for every
+    segmentation of the same X.
+    '''
 
     # Boundaries include beginning and end frames, so k is one less
     k = len(boundaries) - 1
 
     d, n = map(float, X.shape)
 
+    if moments is None:
+        moments = K.segment_moments(X)
+
     # Compute the average log-likelihood of each cluster
-    cost = [gaussian_cost(X[:, start:end]) for
-            (start, end) in zip(boundaries[:-1], boundaries[1:])]
+    cost = K.gaussian_segment_costs(moments, boundaries)
 
     cost = - 2 * np.sum(cost) / n + 2 * (d * k)
 
     return cost
 
 
-def get_k_segments(X, k):
+def ward_boundaries(X):
+    '''Builds the temporally constrained Ward tree of the frames of X (as
+    librosa.segment.agglomerative does) and returns the boundaries in the
+    order in which the tree merges them away: the last k - 1 ones are the
+    boundaries of the segmentation in k segments.
+    '''
+
+    n = X.shape[1]
+    if n < 2:
+        return np.zeros(0, dtype=int)
+
+    grid = sklearn.feature_extraction.image.grid_to_graph(n_x=n, n_y=1, n_z=1)
+    children = sklearn.cluster.ward_tree(X.T, connectivity=grid)[0]
+
+    # Segments only merge with their neighbors, so each merge removes the
+    # first frame of its right child
+    first = np.concatenate((np.arange(n), np.zeros(len(children), dtype=int)))
+    merged = np.zeros(len(children), dtype=int)
+    for i, (left, right) in enumerate(children):
+        first[n + i] = min(first[left], first[right])
+        merged[i] = max(first[left], first[right])
+
+    return merged
 
-    # Step 1: run ward
-    boundaries = librosa.segment.agglomerative(X, k)
+
+def get_k_segments(X, k, merged=None, moments=None):
+
+    if k > X.shape[1]:
+        raise ValueError("Cannot extract %d segments from %d frames" %
+                         (k, X.shape[1]))
+
+    # Step 1: run ward (or cut the tree already built)
+    if merged is None:
+        merged = ward_boundaries(X)
+    boundaries = merged[len(merged) - k + 1:]
 
     boundaries = np.unique(np.concatenate(([0], boundaries, [X.shape[1]])))
 
     # Step 2: compute cost
-    cost = clustering_cost(X, boundaries)
+    cost = clustering_cost(X, boundaries, moments)
 
     return boundaries, cost
 
 
 def get_segments(X, kmin=8, kmax=32):
 
+    # The Ward tree and the cumulative sums are the same for all k
+    merged = ward_boundaries(X)
+    moments = K.segment_moments(X)
+
     cost_min = np.inf
     S_best = []
     for k in range(kmax, kmin, -1):
-        S, cost = get_k_segments(X, k)
+        S, cost = get_k_segments(X, k, merged, moments)
         if cost < cost_min:
             cost_min = cost
             S_best = S
@@ -247,12 +322,19 @@ def process_arguments():
     return vars(parser.parse_args(sys.argv[1:]))
 
 
+# Transforms already loaded, by file
+_transforms = {}
+
+
 def load_transform(transform_file):
 
     if transform_file is None:
         W = np.eye(__DIMENSION)
     else:
-        W = np.load(transform_file)
+        # Read each model only once per process
+        if transform_file not in _transforms:
+            _transforms[transform_file] = np.load(transform_file)
+        W = _transforms[transform_file]
 
     return W
 
@@ -274,8 +356,13 @@ class Segmenter(SegmenterInterface):
         est_labels : np.array(N-1)
             Estimated labels for the segments.
         """
-        # Preprocess to obtain features, times, and input boundary indeces
-        F, frame_times, dur = features(self.audio_file, self.annot_beats)
+        # OLDA only works with beat-synchronous features, that can also be
+        # passed in memory
+        self.framesync = False
+        beats, dur = self._read_features()
+        F, frame_times, dur = compute_features(self._get_feature("hpcp"),
+                                               self._get_feature("mfcc"),
+                                               beats, dur)
 
         try:
             # Load and apply transform
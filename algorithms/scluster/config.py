@@ -4,7 +4,11 @@
 config = {
     "verbose"    : False,
     "median"     : False,
-    "num_types"  : None
+    "num_types"  : None,
+    "sparse"     : False,   # KD-tree based sparse recurrence (long tracks)
+    "warm_start" : False,   # Warm start k-means from the previous num_types
+                            # (faster, but changes the results)
+    "n_jobs"     : 1        # Threads for the num_types (without warm_start)
 }
 
 algo_id = "scluster"
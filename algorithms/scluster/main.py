@@ -13,17 +13,23 @@ import sys
 import os
 import argparse
 import string
+import multiprocessing
+import multiprocessing.pool
 
 import numpy as np
 import scipy.spatial
 import scipy.signal
 import scipy.linalg
+import scipy.sparse
+import scipy.sparse.linalg
 
 import sklearn.cluster
 
 # Requires librosa-develop 0.3 branch
 import librosa
 
+from msaf import utils
+
 # Suppress neighbor links within REP_WIDTH beats of the current one
 REP_WIDTH=3
 
@@ -193,19 +199,31 @@ def expand_transitionals(R, local=True):
     return R_out
 
 def rw_laplacian(A):
-    Dinv = np.sum(A, axis=1)**-1.0
+    Dinv = np.asarray(A.sum(axis=1)).ravel()**-1.0
     Dinv[~np.isfinite(Dinv)] = 1.0
-    L = np.eye(A.shape[0]) - (Dinv * A.T).T
+
+    if scipy.sparse.issparse(A):
+        return scipy.sparse.identity(A.shape[0], format='csr') - \
+            scipy.sparse.diags(Dinv).dot(A)
+
+    L = -(Dinv * A.T).T
+    L[np.diag_indices_from(L)] += 1.0
     return L
 
 def sym_laplacian(A):
-    Dinv = np.sum(A, axis=1)**-1.0
+    Dinv = np.asarray(A.sum(axis=1)).ravel()**-1.0
 
     Dinv[~np.isfinite(Dinv)] = 1.0
 
-    Dinv = np.diag(Dinv**0.5)
+    Dinv = Dinv**0.5
+
+    if scipy.sparse.issparse(A):
+        Dinv = scipy.sparse.diags(Dinv)
+        return scipy.sparse.identity(A.shape[0], format='csr') - \
+            Dinv.dot(A.dot(Dinv))
 
-    L = np.eye(len(A)) - Dinv.dot(A.dot(Dinv))
+    L = -Dinv[:, np.newaxis] * (A * Dinv)
+    L[np.diag_indices_from(L)] += 1.0
 
     return L
 
@@ -257,14 +275,34 @@ def weighted_ridge(A_rep, A_loc):
     Goal: avg flow should be balanced between the repeater graph and the sequence graph
 
     '''
-    d1 = np.sum(A_rep, axis=1)
-    d2 = np.sum(A_loc, axis=1)
+    d1 = np.asarray(A_rep.sum(axis=1)).ravel()
+    d2 = np.asarray(A_loc.sum(axis=1)).ravel()
 
     ds = d1 + d2
     mu = d2.dot(ds) / np.dot(ds, ds)
     return mu * A_rep + (1 - mu) * A_loc
 
 def factorize(L, k=20):
+    '''Bottom k eigenvectors of the Laplacian L (as rows), and the gap
+    between the k-th and (k+1)-th eigenvalues.
+
+    A sparse L must be symmetric (see sym_laplacian): only its bottom k + 1
+    eigenpairs are computed, with Lanczos iterations.'''
+    n = L.shape[0]
+    if scipy.sparse.issparse(L) and k + 1 < n:
+        # The bottom eigenpairs of L are the top ones of I - L, which
+        # converge much faster than the smallest ones of L
+        M = scipy.sparse.identity(n, format='csr') - L
+        v0 = np.random.RandomState(0).rand(n)
+        e_vals, e_vecs = scipy.sparse.linalg.eigsh(M, k=k + 1, which='LA',
+                                                   v0=v0)
+        e_vals = 1.0 - e_vals
+        idx = np.argsort(e_vals)
+        return e_vecs[:, idx[:k]].T, e_vals[idx[k]] - e_vals[idx[k-1]]
+
+    if scipy.sparse.issparse(L):
+        L = L.toarray()
+
     e_vals, e_vecs = scipy.linalg.eig(L)
     e_vals = e_vals.real
     e_vecs = e_vecs.real
@@ -304,7 +342,108 @@ def cond_entropy(y_old, y_new):
 
     return P_new.dot(h_old_given_new)
 
-def time_clusterer(Lf, k_min, k_max, times):
+def label_boundaries(labels):
+    '''Change-points of the labels, with the start and end markers.'''
+    boundaries = 1 + np.asarray(np.where(labels[:-1] != labels[1:])).reshape((-1,))
+
+    return np.unique(np.concatenate([[0], boundaries, [len(labels)]]))
+
+def rep_features(Lf, n_types):
+    '''Normalized repetition features of the first n_types eigenvectors.'''
+    return librosa.util.normalize(Lf[:n_types].T, norm=2, axis=1)
+
+def warm_start_centers(Y, labels):
+    '''Initial k-means centers for one more type than labels: the centroids
+    of the labels in Y, and the frame that is farthest from its centroid.'''
+    n_types = labels.max() + 1
+    counts = np.bincount(labels, minlength=n_types)
+    centers = np.zeros((n_types, Y.shape[1]))
+    np.add.at(centers, labels, Y)
+    centers /= np.maximum(counts, 1)[:, np.newaxis]
+
+    dists = np.sum((Y - centers[labels])**2, axis=1)
+    return np.vstack((centers, Y[np.argmax(dists)]))
+
+def fit_labels(Y, n_types, init=None, **kwargs):
+    '''Labels the frames Y with n_types using k-means.'''
+    if init is None:
+        C = sklearn.cluster.KMeans(n_clusters=n_types, **kwargs)
+    else:
+        kwargs['n_init'] = 1
+        C = sklearn.cluster.KMeans(n_clusters=n_types, init=init, **kwargs)
+    return C.fit_predict(Y)
+
+def select_partition(Lf, evaluate, upper_bound, warm_start=False, n_jobs=1,
+                     max_types=None, seed=None, **kwargs):
+    '''Model selection over the number of segment types (2 to max_types,
+    len(Lf) by default).
+
+    Each n_types is labeled with fit_labels (kwargs are passed to k-means)
+    and scored with evaluate(n_types, labels) (-np.inf if not feasible).
+    The search stops as soon as upper_bound(n_types), the best score that
+    n_types or more types can get, does not improve the best score.
+
+    With warm_start, the k-means of each n_types starts from the solution
+    of n_types - 1 (see warm_start_centers).  Otherwise, they are fitted
+    from random initializations in n_jobs threads.
+
+    The k-means of each n_types is seeded with seed + n_types, so that the
+    result does not depend on n_jobs.  By default, seed is drawn from the
+    global NumPy RNG.
+
+    Returns the best (n_types, Y, labels), or None if none is feasible.'''
+    if max_types is None:
+        max_types = len(Lf)
+    best = None
+    best_score = -np.inf
+    labels = None
+
+    if seed is None:
+        seed = np.random.randint(2**30)
+
+    pool = None
+    if not warm_start and n_jobs != 1:
+        if n_jobs <= 0:
+            n_jobs = multiprocessing.cpu_count()
+        pool = multiprocessing.pool.ThreadPool(n_jobs)
+    fits = {}
+
+    try:
+        for n_types in range(2, 1+max_types):
+            if upper_bound(n_types) <= best_score:
+                break
+
+            if pool is not None:
+                # Keep all the threads busy with the next n_types (each
+                # fit is kept with its features)
+                for n in range(n_types, min(n_types + n_jobs, 1+max_types)):
+                    if n not in fits:
+                        Y_n = rep_features(Lf, n)
+                        fits[n] = (Y_n, pool.apply_async(
+                            fit_labels, (Y_n, n),
+                            dict(kwargs, random_state=seed + n)))
+                Y, fit = fits.pop(n_types)
+                labels = fit.get()
+            else:
+                Y = rep_features(Lf, n_types)
+                init = None
+                if warm_start and labels is not None:
+                    init = warm_start_centers(Y, labels)
+                labels = fit_labels(Y, n_types, init=init,
+                                    random_state=seed + n_types, **kwargs)
+
+            score = evaluate(n_types, labels)
+            if score > best_score:
+                best_score = score
+                best = (n_types, Y, labels)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return best
+
+def time_clusterer(Lf, k_min, k_max, times, warm_start=False, n_jobs=1):
 
     best_boundaries = [0, Lf.shape[1]]
     best_n_types    = 1
@@ -312,27 +451,29 @@ def time_clusterer(Lf, k_min, k_max, times):
 
     times = np.asarray(times)
 
-    for n_types in range(2, Lf.shape[0]):
-        # Build the affinity matrix on the first n_types-1 repetition features
-        Y = librosa.util.normalize(Lf[:n_types].T, norm=2, axis=1)
-        # Try to label the data with n_types
-        C = sklearn.cluster.KMeans(n_clusters=n_types, tol=1e-10, n_init=100)
-        labels = C.fit_predict(Y)
-
-        boundaries = 1 + np.asarray(np.where(labels[:-1] != labels[1:])).reshape((-1,))
-
-        boundaries = np.unique(np.concatenate([[0], boundaries, [len(labels)]]))
+    # Every type takes at least one segment
+    max_types = (times[Lf.shape[1]] - times[0]) / MIN_SEG
 
-        segment_deltas = np.diff(times[boundaries])
+    def evaluate(n_types, labels):
+        segment_deltas = np.diff(times[label_boundaries(labels)])
 
         # Easier to compute this before filling it out
         feasible = (np.mean(segment_deltas) >= MIN_SEG)# and (np.mean(segment_deltas) <= MAX_SEG)
 
-        # Edge-case: always take at least 2 segment types
-        if feasible:
-            best_boundaries = boundaries
-            best_n_types    = n_types
-            Y_best          = Y
+        # Take the largest feasible n_types
+        return n_types if feasible else -np.inf
+
+    def upper_bound(n_types):
+        return n_types if n_types <= max_types else -np.inf
+
+    # Up to len(Lf) - 1 types
+    best = select_partition(Lf, evaluate, upper_bound, warm_start, n_jobs,
+                            max_types=Lf.shape[0] - 1, tol=1e-10, n_init=100)
+
+    # Edge-case: always take at least 2 segment types
+    if best is not None:
+        best_n_types, Y_best, labels = best
+        best_boundaries = label_boundaries(labels)
 
     intervals, labels = label_rep_sections(Y_best.T, best_boundaries, best_n_types)
 
@@ -341,63 +482,43 @@ def time_clusterer(Lf, k_min, k_max, times):
 def fixed_partition(Lf, n_types):
 
     # Build the affinity matrix on the first n_types-1 repetition features
-    Y = librosa.util.normalize(Lf[:n_types].T, norm=2, axis=1)
+    Y = rep_features(Lf, n_types)
 
     # Try to label the data with n_types
-    C = sklearn.cluster.KMeans(n_clusters=n_types, tol=1e-10, n_init=100)
-    labels = C.fit_predict(Y)
+    labels = fit_labels(Y, n_types, tol=1e-10, n_init=100)
 
-    boundaries = 1 + np.asarray(np.where(labels[:-1] != labels[1:])).reshape((-1,))
-
-    boundaries = np.unique(np.concatenate([[0], boundaries, [len(labels)]]))
+    boundaries = label_boundaries(labels)
 
     intervals, labels = label_rep_sections(Y.T, boundaries, n_types)
 
     return boundaries, labels
 
-def median_partition(Lf, k_min, k_max, beats):
-    best_score      = -np.inf
+def median_partition(Lf, k_min, k_max, beats, warm_start=False, n_jobs=1):
     best_boundaries = [0, Lf.shape[1]]
     best_n_types    = 1
     Y_best          = Lf[:1].T
 
-    label_dict = {}
-
-    # The trivial solution
-    label_dict[1]   = np.zeros(Lf.shape[1])
-
-    for n_types in range(2, 1+len(Lf)):
-        Y = librosa.util.normalize(Lf[:n_types].T, norm=2, axis=1)
-
-        # Try to label the data with n_types
-        C = sklearn.cluster.KMeans(n_clusters=n_types, n_init=100)
-        labels = C.fit_predict(Y)
-        label_dict[n_types] = labels
-
-        # Find the label change-points
-        boundaries = 1 + np.asarray(np.where(labels[:-1] != labels[1:])).reshape((-1,))
-
-        boundaries = np.unique(np.concatenate([[0], boundaries, [len(labels)]]))
+    def evaluate(n_types, labels):
+        boundaries = label_boundaries(labels)
 
         # boundaries now include start and end markers; n-1 is the number of segments
-        feasible = (len(boundaries) > k_min)
+        if len(boundaries) <= k_min:
+            return -np.inf
+
         durations = np.diff([beats[x] for x in boundaries])
         med_diff = np.median(durations)
 
-        score = -np.mean(np.abs(np.log(durations) - np.log(med_diff)))
+        return -np.mean(np.abs(np.log(durations) - np.log(med_diff)))
 
-        if score > best_score and feasible:
-            best_boundaries = boundaries
-            best_n_types    = n_types
-            best_score      = score
-            Y_best          = Y
+    # All the segments with the median duration
+    best = select_partition(Lf, evaluate, lambda n_types: 0.0, warm_start,
+                            n_jobs, n_init=100)
 
     # Did we fail to find anything with enough boundaries?
-    # Take the last one then
-    if best_boundaries is None:
-        best_boundaries = boundaries
-        best_n_types    = n_types
-        Y_best          = librosa.util.normalize(Lf[:best_n_types].T, norm=2, axis=1)
+    # Take the trivial solution then
+    if best is not None:
+        best_n_types, Y_best, labels = best
+        best_boundaries = label_boundaries(labels)
 
     intervals, best_labels = label_rep_sections(Y_best.T, best_boundaries, best_n_types)
 
@@ -418,47 +539,30 @@ def label_entropy(labels):
 
     return scipy.stats.entropy(labels)
 
-def label_clusterer(Lf, k_min, k_max):
-    best_score      = -np.inf
+def label_clusterer(Lf, k_min, k_max, warm_start=False, n_jobs=1):
     best_boundaries = [0, Lf.shape[1]]
     best_n_types    = 1
     Y_best          = Lf[:1].T
 
-    label_dict = {}
-
-    # The trivial solution
-    label_dict[1]   = np.zeros(Lf.shape[1])
-
-    for n_types in range(2, 1+len(Lf)):
-        Y = librosa.util.normalize(Lf[:n_types].T, norm=2, axis=1)
-
-        # Try to label the data with n_types
-        C = sklearn.cluster.KMeans(n_clusters=n_types, n_init=100)
-        labels = C.fit_predict(Y)
-        label_dict[n_types] = labels
-
-        # Find the label change-points
-        boundaries = 1 + np.asarray(np.where(labels[:-1] != labels[1:])).reshape((-1,))
-
-        boundaries = np.unique(np.concatenate([[0], boundaries, [len(labels)]]))
+    n = Lf.shape[1]
 
+    def evaluate(n_types, labels):
         # boundaries now include start and end markers; n-1 is the number of segments
-        feasible = (len(boundaries) > k_min)
+        if len(label_boundaries(labels)) <= k_min:
+            return -np.inf
 
-        score = label_entropy(labels) / np.log(n_types)
+        return label_entropy(labels) / np.log(n_types)
 
-        if score > best_score and feasible:
-            best_boundaries = boundaries
-            best_n_types    = n_types
-            best_score      = score
-            Y_best          = Y
+    # The entropy of n labels is at most log(n)
+    best = select_partition(Lf, evaluate,
+                            lambda n_types: np.log(n) / np.log(n_types),
+                            warm_start, n_jobs, n_init=100)
 
     # Did we fail to find anything with enough boundaries?
-    # Take the last one then
-    if best_boundaries is None:
-        best_boundaries = boundaries
-        best_n_types    = n_types
-        Y_best          = librosa.util.normalize(Lf[:best_n_types].T, norm=2, axis=1)
+    # Take the trivial solution then
+    if best is not None:
+        best_n_types, Y_best, labels = best
+        best_boundaries = label_boundaries(labels)
 
     intervals, best_labels = label_rep_sections(Y_best.T, best_boundaries, best_n_types)
 
@@ -475,6 +579,10 @@ def estimate_bandwidth(D, k):
 
 def self_similarity(X, k):
     D = scipy.spatial.distance.cdist(X.T, X.T, metric=METRIC)
+    return similarity_from_distances(D, k)
+
+def similarity_from_distances(D, k):
+    '''self_similarity given the (square) matrix of pairwise distances D.'''
     sigma = estimate_bandwidth(D, k)
     A = np.exp(-0.5 * (D / sigma))
     return A
@@ -493,28 +601,74 @@ def local_similarity(X):
     A = np.diag(rbf, k=1) + np.diag(rbf, k=-1)
     return A
 
-def do_segmentation(X, beats, parameters):
-
-    X_rep, X_loc = X
-    # Find the segment boundaries
-    print '\tpredicting segments...'
-    k_min, k_max  = get_num_segs(beats[-1])
-
-    # Get the raw recurrence plot
-    Xpad = np.pad(X_rep, [(0,0), (N_STEPS, 0)], mode='edge')
-    Xs = librosa.feature.stack_memory(Xpad, n_steps=N_STEPS)[:, N_STEPS:]
-
-    k_link = 1 + int(np.ceil(2 * np.log2(X_rep.shape[1])))
-    R = librosa.segment.recurrence_matrix(  Xs,
-                                            k=k_link,
-                                            width=REP_WIDTH,
-                                            metric=METRIC,
-                                            sym=True).astype(np.float32)
+def clean_reps_sparse(R):
+    '''Sparse version of structure_feature + clean_reps + inverse
+    structure_feature for a binary recurrence matrix R: each diagonal (i.e.
+    lag) is median filtered along time, with reflected padding.
+
+    The median of a binary window is 1 iff most of it is 1, so only the
+    windows around the links of R have to be counted.'''
+    R = R.tocoo()
+    n = R.shape[0]
+    half = FILTER_WIDTH // 2
+    times = R.col[R.data > 0]
+    lags = R.row[R.data > 0] - times
+
+    # Positions of each link in the reflected padding of its diagonal
+    left = (times > 0) & (times <= half)
+    right = (times < n - 1) & (times >= n - 1 - half)
+    pos = np.concatenate((times, -times[left], 2 * (n - 1) - times[right]))
+    lags = np.concatenate((lags, lags[left], lags[right]))
+
+    # Count the links in the window of each time
+    out_t = (pos[:, np.newaxis] + np.arange(-half, half + 1)).ravel()
+    out_l = np.repeat(lags, FILTER_WIDTH)
+    valid = (out_t >= 0) & (out_t < n) & (out_t + out_l >= 0) & \
+        (out_t + out_l < n)
+    counts = scipy.sparse.coo_matrix(
+        (np.ones(valid.sum()), (out_t[valid] + out_l[valid], out_t[valid])),
+        shape=(n, n)).tocsr()
+    counts.sum_duplicates()
+
+    counts.data = (counts.data > half).astype(np.float32)
+    counts.eliminate_zeros()
+    return counts
+
+def self_similarity_sparse(X, k, mask):
+    '''self_similarity evaluated only at the nonzero entries of mask. The
+    bandwidth is estimated from the nearest neighbors (see utils.knn).'''
+    if METRIC != 'sqeuclidean':
+        raise ValueError('Sparse similarity only supports sqeuclidean')
+    n = X.shape[1]
+    k = min(k, n - 2)
+    D_knn = utils.knn(X, k + 2, metric=METRIC)[0]
+    sigma = np.mean(D_knn[:, 1 + k])
+
+    mask = mask.tocoo()
+    D = np.sum((X[:, mask.row] - X[:, mask.col]) ** 2, axis=0)
+    return scipy.sparse.csr_matrix((np.exp(-0.5 * (D / sigma)),
+                                    (mask.row, mask.col)), shape=mask.shape)
+
+def dense_jukebox_matrix(Xs, X_loc, k_link, get_distances=None):
+    '''Infinite jukebox matrix of do_segmentation: the repetition links of
+    the cleaned recurrence matrix, weighted by the similarity of Xs, plus
+    the +- 1 diagonals, weighted by the similarity of X_loc. The recurrence
+    matrix and the repetition kernel share the distances of Xs.'''
+    if get_distances is None:
+        get_distances = compute_distances
+    D_rep = scipy.spatial.distance.squareform(
+        get_distances(Xs.T, METRIC, feature="hpcp", n_steps=N_STEPS))
+    R = utils.recurrence_from_distances(D_rep,
+                                        k=k_link,
+                                        width=REP_WIDTH,
+                                        sym=True).astype(np.float32)
     # Generate the repetition kernel
-    A_rep = self_similarity(Xs, k=k_link)
+    A_rep = similarity_from_distances(D_rep, k=k_link)
 
     # And the local path kernel
-    A_loc = self_similarity(X_loc, k=k_link)
+    D_loc = scipy.spatial.distance.squareform(
+        get_distances(X_loc.T, METRIC, feature="mfcc"))
+    A_loc = similarity_from_distances(D_loc, k=k_link)
 
     # Mask the self-similarity matrix by recurrence
     S = librosa.segment.structure_feature(R)
@@ -533,18 +687,78 @@ def do_segmentation(X, beats, parameters):
     # We can jump to a random neighbor, or +- 1 step in time
     # Call it the infinite jukebox matrix
     T = weighted_ridge(Rf * A_rep, (np.eye(len(A_loc),k=1) + np.eye(len(A_loc),k=-1)) * A_loc)
-    # Get the graph laplacian
-    L = sym_laplacian(T)
+    return T
+
+def sparse_jukebox_matrix(Xs, X_loc, k_link):
+    '''Sparse version of dense_jukebox_matrix:
+    the recurrence matrix is built from the nearest neighbors (found with a
+    KD-tree), it is cleaned in the lag domain without densifying it, and the
+    similarities are only computed where they are used.'''
+    R = utils.recurrence_matrix(Xs,
+                                k=k_link,
+                                width=REP_WIDTH,
+                                metric=METRIC,
+                                sym=True)
+
+    # Clean the repetitions, symmetrize and suppress the diagonal
+    Rf = clean_reps_sparse(R)
+    Rf = Rf.maximum(Rf.T).tolil()
+    Rf.setdiag(0)
+    Rf = Rf.tocsr()
+    Rf.eliminate_zeros()
+
+    # Repetition kernel on the links, and local kernel on the +- 1 diagonals
+    A_rep = self_similarity_sparse(Xs, k_link, Rf)
+    n = X_loc.shape[1]
+    ridge_idx = scipy.sparse.diags([np.ones(n - 1), np.ones(n - 1)], [1, -1])
+    A_loc = self_similarity_sparse(X_loc, k_link, ridge_idx)
+
+    return weighted_ridge(A_rep, A_loc)
+
+def compute_distances(X, metric, **params):
+    """Default way of getting the distances of do_segmentation: simply
+    compute them."""
+    return scipy.spatial.distance.pdist(X, metric=metric)
+
+def do_segmentation(X, beats, parameters, get_distances=compute_distances):
+    """Segments the features X. get_distances(X, metric, **params) is used
+    to get the condensed distances between the frames (e.g. from a cache),
+    from which the recurrence and similarity matrices are derived."""
+
+    X_rep, X_loc = X
+    # Find the segment boundaries
+    print '\tpredicting segments...'
+    k_min, k_max  = get_num_segs(beats[-1])
+
+    # Get the raw recurrence plot
+    Xpad = np.pad(X_rep, [(0,0), (N_STEPS, 0)], mode='edge')
+    Xs = librosa.feature.stack_memory(Xpad, n_steps=N_STEPS)[:, N_STEPS:]
+
+    k_link = 1 + int(np.ceil(2 * np.log2(X_rep.shape[1])))
+    if parameters.get('sparse', False):
+        T = sparse_jukebox_matrix(Xs, X_loc, k_link)
+
+        # Get the graph laplacian (sparse too)
+        L = sym_laplacian(T)
+    else:
+        T = dense_jukebox_matrix(Xs, X_loc, k_link, get_distances)
+
+        # Get the graph laplacian
+        L = sym_laplacian(T)
 
     # Get the bottom k eigenvectors of L
     Lf = factorize(L, k=1+MAX_REP)[0]
 
+    warm_start = parameters.get('warm_start', False)
+    n_jobs = parameters.get('n_jobs', 1)
     if parameters['num_types']:
         boundaries, labels = fixed_partition(Lf, parameters['num_types'])
     elif parameters['median']:
-        boundaries, labels = median_partition(Lf, k_min, k_max, beats)
+        boundaries, labels = median_partition(Lf, k_min, k_max, beats,
+                                              warm_start, n_jobs)
     else:
-        boundaries, labels = label_clusterer(Lf, k_min, k_max)
+        boundaries, labels = label_clusterer(Lf, k_min, k_max, warm_start,
+                                             n_jobs)
 
     return boundaries, labels
 
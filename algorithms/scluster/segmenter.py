@@ -40,14 +40,15 @@ class Segmenter(SegmenterInterface):
 
         # Brian wants HPCP and MFCC
         # (transosed, because he's that kind of person)
-        F = (self.hpcp.T, self.mfcc.T)
+        F = (self._get_feature("hpcp").T, self._get_feature("mfcc").T)
 
         # Brian also wants the last duration
         frame_times = np.concatenate((frame_times, [dur]))
 
         # Do actual segmentation
         bound_idxs, est_labels = main.do_segmentation(F, frame_times,
-                                                      self.config)
+                                                      self.config,
+                                                      self._get_distances)
 
         # Add first and last boundaries (silence)
         bound_idxs = np.asarray(bound_idxs, dtype=int)
@@ -6,7 +6,10 @@ config = {
     "m_embedded"    : 3,
     "k_nearest"     : 0.06,
     "Mp_adaptive"   : 24,
-    "offset_thres"  : 0.04
+    "offset_thres"  : 0.04,
+    "sparse_recurrence" : False    # KD-tree based sparse recurrence matrix
+                                   # (at most 1 + 2 log2(N) neighbors instead
+                                   # of k_nearest * N, for long tracks)
 }
 
 algo_id = "sf"
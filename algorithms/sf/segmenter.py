@@ -20,28 +20,20 @@ __email__ = "oriol@nyu.edu"
 
 import logging
 import numpy as np
-import librosa
+from numpy.lib.stride_tricks import as_strided
+import scipy.sparse
 from scipy.spatial import distance
 from scipy import signal
-from scipy.ndimage import filters
 
 from msaf.algorithms.interface import SegmenterInterface
-
-
-def median_filter(X, M=8):
-    """Median filter along the first axis of the feature matrix X."""
-    for i in xrange(X.shape[1]):
-        X[:, i] = filters.median_filter(X[:, i], size=M)
-    return X
+import msaf.kernels as K
+import msaf.utils as U
 
 
 def gaussian_filter(X, M=8, axis=0):
     """Gaussian filter along the first axis of the feature matrix X."""
-    for i in xrange(X.shape[axis]):
-        if axis == 1:
-            X[:, i] = filters.gaussian_filter(X[:, i], sigma=M / 2.)
-        elif axis == 0:
-            X[i, :] = filters.gaussian_filter(X[i, :], sigma=M / 2.)
+    # Each column (axis=1) or row (axis=0) is filtered independently, in place
+    X[:] = K.gaussian_filter(X, M=M, axis=1 - axis)
     return X
 
 
@@ -67,9 +59,9 @@ def compute_nc(X):
     N = X.shape[0]
     # nc = np.sum(np.diff(X, axis=0), axis=1) # Difference between SF's
 
+    # Euclidean distance between consecutive SF's
     nc = np.zeros(N)
-    for i in xrange(N - 1):
-        nc[i] = distance.euclidean(X[i, :], X[i + 1, :])
+    nc[:N - 1] = np.sqrt(np.sum(np.diff(X, axis=0) ** 2, axis=1))
 
     # Normalize
     nc += np.abs(nc.min())
@@ -79,43 +71,174 @@ def compute_nc(X):
 
 def pick_peaks(nc, L=16, offset_denom=0.1):
     """Obtain peaks from a novelty curve using an adaptive threshold."""
-    offset = nc.mean() * float(offset_denom)
-    th = filters.median_filter(nc, size=L) + offset
-    #th = filters.gaussian_filter(nc, sigma=L/2., mode="nearest") + offset
+    th = K.adaptive_threshold(nc, L=L, offset_coef=offset_denom)
     # plt.plot(nc)
     # plt.plot(th)
     # plt.show()
     # th = np.ones(nc.shape[0]) * nc.mean() - 0.08
-    peaks = []
-    for i in xrange(1, nc.shape[0] - 1):
-        # is it a peak?
-        if nc[i - 1] < nc[i] and nc[i] > nc[i + 1]:
-            # is it above the threshold?
-            if nc[i] > th[i]:
-                peaks.append(i)
-    return peaks
+    return K.pick_peaks(nc, th)
 
 
 def circular_shift(X):
     """Shifts circularly the X squre matrix in order to get a
         time-lag matrix."""
     N = X.shape[0]
-    L = np.zeros(X.shape)
-    for i in xrange(N):
-        L[i, :] = np.asarray([X[(i + j) % N, j] for j in xrange(N)])
-    return L
+    # L[i, j] = X[(i + j) % N, j], i.e. element (i + j, j) of X stacked twice
+    X2 = np.concatenate((X, X)).astype(np.float64)
+    L = as_strided(X2, shape=(N, N),
+                   strides=(X2.strides[0], X2.strides[0] + X2.strides[1]))
+    return L.copy()
+
+
+def circular_shift_sparse(R):
+    """Sparse version of circular_shift, for a sparse recurrence matrix R."""
+    R = R.tocoo()
+    N = R.shape[0]
+    return scipy.sparse.csr_matrix(
+        (R.data, ((R.row - R.col) % N, R.col)), shape=R.shape)
+
+
+def compute_nc_sparse(L, M=8, block_size=2 ** 24):
+    """Computes the novelty curve of the structural features of the sparse
+    lag matrix L, without building the (dense) N x N structural features.
+
+    It is equivalent to filtering L.T with gaussian_filter(M=M, axis=1) and
+    gaussian_filter(M=1, axis=0), and then calling compute_nc, but it filters
+    blocks of frames (plus the margin needed by the gaussian filter) one at a
+    time, so that memory only grows with the number of links of L (and not
+    with the square of the number of frames).
+
+    Parameters
+    ----------
+    L : scipy.sparse matrix((N, N))
+        Lag matrix (see circular_shift_sparse).
+    M : int
+        Size of the gaussian filter along time.
+    block_size : int
+        Maximum number of elements of the structural features computed at
+        once.
+
+    Returns
+    -------
+    nc : np.array(N)
+        Normalized novelty curve.
+    """
+    N = L.shape[0]
+    LT = L.T.tocsr()
+    margin = int(4.0 * M / 2. + 0.5)   # Radius of the gaussian filter
+    n_rows = max(1, block_size // N - 2 * margin)
+
+    nc = np.zeros(N)
+    for start in xrange(0, N - 1, n_rows):
+        end = min(N, start + n_rows + 1)    # Next frame needed for the diff
+        lo = max(0, start - margin)
+        hi = min(N, end + margin)
+        SF = LT[lo:hi].toarray().astype(np.float64)
+        SF = K.gaussian_filter(SF, M=M, axis=0)
+        SF = K.gaussian_filter(SF, M=1, axis=1)
+        SF = SF[start - lo:end - lo]
+        nc[start:end - 1] = np.sqrt(np.sum(np.diff(SF, axis=0) ** 2, axis=1))
+
+    # Normalize
+    nc += np.abs(nc.min())
+    nc /= nc.max()
+    return nc
+
+
+def sparse_neighbors(N, k_nearest):
+    """Number of neighbors of the sparse recurrence matrix of N frames.
+
+    The dense recurrence matrix links each frame to its k_nearest * N
+    nearest neighbors, so its number of links grows quadratically with N.
+    The sparse one caps them at 1 + ceil(2 * log2(N)), as scluster does, so
+    that it only takes N log N memory. Both match for short tracks (up to
+    around 300 frames with the default k_nearest), but they differ above
+    that.
+    """
+    return int(min(k_nearest * N, 1 + np.ceil(2 * np.log2(N))))
+
+
+def compute_distances(X, metric, **params):
+    """Default way of getting the distances of novelty_curve: simply compute
+    them."""
+    return distance.pdist(X, metric=metric)
+
+
+def novelty_curve(F, m, M, k, sparse=False,
+                  get_distances=compute_distances):
+    """Computes the novelty curve of the structural features of F.
+
+    Parameters
+    ----------
+    F : np.array((N, d))
+        Feature matrix, one frame per row.
+    m : float
+        Number of embedded dimensions.
+    M : int
+        Size of the gaussian filter of the lag matrix.
+    k : float
+        Fraction of the frames linked to each frame in the recurrence
+        matrix (capped by sparse_neighbors if sparse).
+    sparse : bool
+        Whether to use a sparse recurrence matrix and compute the structural
+        features in blocks, so that memory does not grow quadratically with
+        the number of frames (the time still does).
+    get_distances : function
+        get_distances(X, metric, **params) gets the condensed distances
+        between the rows of X (e.g. from a cache), from which the dense
+        recurrence matrix is built.
+
+    Returns
+    -------
+    nc : np.array(N - ceil(m))
+        Normalized novelty curve.
+    """
+    # Recurrence matrix of the embedded feature space (i.e. shingle)
+    if sparse:
+        # Sparse, using a KD-tree for the nearest neighbors
+        R = U.recurrence_matrix(embedded_space(F, m).T,
+                                k=sparse_neighbors(F.shape[0], k), width=0,
+                                metric="seuclidean", sym=True)
+
+        # Circular shift, structural features (in blocks of frames) and
+        # novelty curve
+        L = circular_shift_sparse(R)
+        return compute_nc_sparse(L, M=M)
+
+    D = get_distances(embedded_space(F, m), "seuclidean", m_embedded=m)
+    R = U.recurrence_from_distances(
+        distance.squareform(D), k=k * int(F.shape[0]),
+        width=0,  # zeros from the diagonal
+        sym=True).astype(np.float32)
+
+    # Circular shift
+    L = circular_shift(R)
+    #plt.imshow(L, interpolation="nearest", cmap=plt.get_cmap("binary"))
+    #plt.show()
+
+    # Obtain structural features by filtering the lag matrix
+    SF = gaussian_filter(L.T, M=M, axis=1)
+    SF = gaussian_filter(L.T, M=1, axis=0)
+    # plt.imshow(SF.T, interpolation="nearest", aspect="auto")
+    #plt.show()
+
+    # Compute the novelty curve
+    return compute_nc(SF)
 
 
 def embedded_space(X, m, tau=1):
     """Time-delay embedding with m dimensions and tau delays."""
     N = X.shape[0] - int(np.ceil(m))
-    Y = np.zeros((N, int(np.ceil(X.shape[1] * m))))
-    for i in xrange(N):
-        # print X[i:i+m,:].flatten().shape, w, X.shape
-        # print Y[i,:].shape
-        rem = int((m % 1) * X.shape[1])  # Reminder for float m
-        Y[i, :] = np.concatenate((X[i:i + int(m), :].flatten(),
-                                 X[i + int(m), :rem]))
+    rem = int((m % 1) * X.shape[1])  # Reminder for float m
+    W = int(m) * X.shape[1] + rem
+    if W != int(np.ceil(X.shape[1] * m)):
+        raise ValueError("m * %d must be an integer" % X.shape[1])
+    # Each row is a window of the flattened X, so all of them can be views
+    # of the same (contiguous) memory
+    X = np.ascontiguousarray(X, dtype=np.float64)
+    Y = as_strided(X, shape=(max(N, 0), W),
+                   strides=(X.strides[0], X.strides[1]))
+    Y.flags.writeable = False
     return Y
 
 
@@ -146,30 +269,11 @@ class Segmenter(SegmenterInterface):
         # Check size in case the track is too short
         if F.shape[0] > 20:
 
-            # Emedding the feature space (i.e. shingle)
-            E = embedded_space(F, m)
-            # plt.imshow(E.T, interpolation="nearest", aspect="auto"); plt.show()
-
-            # Recurrence matrix
-            R = librosa.segment.recurrence_matrix(E.T,
-                                                k=k * int(F.shape[0]),
-                                                width=0,  # zeros from the diagonal
-                                                metric="seuclidean",
-                                                sym=True).astype(np.float32)
-
-            # Circular shift
-            L = circular_shift(R)
-            #plt.imshow(L, interpolation="nearest", cmap=plt.get_cmap("binary"))
-            #plt.show()
-
-            # Obtain structural features by filtering the lag matrix
-            SF = gaussian_filter(L.T, M=M, axis=1)
-            SF = gaussian_filter(L.T, M=1, axis=0)
-            # plt.imshow(SF.T, interpolation="nearest", aspect="auto")
-            #plt.show()
-
-            # Compute the novelty curve
-            nc = compute_nc(SF)
+            # Novelty curve of the structural features, with the distances
+            # of the embedded features shared through the SSM cache
+            nc = novelty_curve(F, m, M, k,
+                               sparse=self.config["sparse_recurrence"],
+                               get_distances=self._get_distances)
 
             # Find peaks in the novelty curve
             est_bounds = pick_peaks(nc, L=Mp, offset_denom=od)
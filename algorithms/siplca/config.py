@@ -6,7 +6,8 @@ config = {
     "alphaZ"            :   -0.01,
     "normalize_frames"  :   True,
     "viterbi_segmenter" :   True,
-    "min_segment_length":   32
+    "min_segment_length":   32,
+    "n_jobs"            :   1       # Processes for the random restarts
 }
 
 algo_id = "siplca"
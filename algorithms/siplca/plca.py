@@ -49,6 +49,7 @@ import functools
 import logging
 
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 import scipy as sp
 import scipy.signal
 
@@ -107,6 +108,46 @@ def shift(a, shift, axis=None, circular=True):
     return aroll
 
 
+def shifted_copies(X, win, circular=False, sign=1, out=None):
+    """Stacks copies of the rows of X shifted by 0, ..., `win` - 1
+    along time (the last axis).
+
+    The copies are ``out[i, tau, t] = X[i, t - sign * tau]``, i.e.
+    delayed for positive `sign` and advanced for negative `sign`, with
+    zeros (or wrapping around if `circular`) past the edges of X.
+    This turns convolutions along time with kernels of length `win`
+    into matrix products.
+
+    See Also
+    --------
+    shift
+    """
+    N, T = X.shape
+    if circular:
+        if sign > 0:
+            Xpad = X[:, np.arange(-(win - 1), T) % T]
+        else:
+            Xpad = X[:, np.arange(T + win - 1) % T]
+    else:
+        Xpad = np.zeros((N, T + win - 1))
+        if sign > 0:
+            Xpad[:, win - 1:] = X
+        else:
+            Xpad[:, :T] = X
+    if sign > 0:
+        copies = as_strided(Xpad[:, win - 1:], shape=(N, win, T),
+                            strides=(Xpad.strides[0], -Xpad.strides[1],
+                                     Xpad.strides[1]))
+    else:
+        copies = as_strided(Xpad, shape=(N, win, T),
+                            strides=(Xpad.strides[0], Xpad.strides[1],
+                                     Xpad.strides[1]))
+    if out is None:
+        return copies.copy()
+    out[:] = copies
+    return out
+
+
 class PLCA(object):
     """Probabilistic Latent Component Analysis
 
@@ -468,6 +509,11 @@ class SIPLCA(PLCA):
         self.VRW = np.empty((self.F, self.rank, self.win))
         self.VRH = np.empty((self.T, self.rank))
 
+        # Shifted copies of H and V / WZH (see shifted_copies), so that
+        # the convolutions along time are done as matrix products.
+        self.Hs = np.empty((self.rank, self.win, self.T))
+        self.VdivWZHs = np.empty((self.F, self.win, self.T))
+
     @staticmethod
     def reconstruct(W, Z, H, norm=1.0, circular=False):
         if W.ndim == 2:
@@ -476,10 +522,11 @@ class SIPLCA(PLCA):
             H = H[np.newaxis,:]
         F, rank, win = W.shape
         rank, T = H.shape
-    
-        WZH = np.zeros((F, T))
-        for tau in xrange(win):
-            WZH += np.dot(W[:,:,tau] * Z, shift(H, tau, 1, circular))
+
+        # WZH[f,t] = sum_{z,tau} W[f,z,tau] Z[z] H[z,t-tau]
+        WZ = W * np.reshape(Z, (1, -1, 1))
+        Hs = shifted_copies(H, win, circular)
+        WZH = np.dot(WZ.reshape(F, rank * win), Hs.reshape(rank * win, T))
         return norm * WZH
 
     def plot(self, V, W, Z, H, curriter=-1):
@@ -531,18 +578,29 @@ class SIPLCA(PLCA):
         return W, Z, H
 
     def do_estep(self, W, Z, H):
-        WZH = self.reconstruct(W, Z, H, circular=self.circular)
-        logprob = self.compute_logprob(W, Z, H, WZH)
+        F, T, win = self.F, self.T, self.win
+        if self.Hs.shape[0] != self.rank:
+            # Some bases were pruned
+            self.Hs = np.empty((self.rank, win, T))
 
         WZ = W * Z[np.newaxis,:,np.newaxis]
-        VdivWZH = (self.V / (WZH + EPS))[:,:,np.newaxis]
-        self.VRW[:] = 0
-        self.VRH[:] = 0
-        for tau in xrange(self.win):
-            Ht = shift(H, tau, 1, self.circular)
-            tmp = WZ[:,:,tau][:,np.newaxis,:] * Ht.T[np.newaxis,:,:] * VdivWZH
-            self.VRW[:,:,tau] += tmp.sum(1)
-            self.VRH += shift(tmp.sum(0), -tau, 0, self.circular)
+        Hs = shifted_copies(H, win, self.circular, out=self.Hs)
+        Hs = Hs.reshape(self.rank * win, T)
+        WZH = np.dot(WZ.reshape(F, self.rank * win), Hs)
+        logprob = self.compute_logprob(W, Z, H, WZH)
+
+        VdivWZH = self.V / (WZH + EPS)
+
+        # VRW[f,z,tau] = WZ[f,z,tau] sum_t VdivWZH[f,t] H[z,t-tau]
+        corr = np.dot(VdivWZH, Hs.T).reshape(F, self.rank, win)
+        np.multiply(WZ, corr, out=self.VRW)
+
+        # VRH[t,z] = H[z,t] sum_{f,tau} WZ[f,z,tau] VdivWZH[f,t+tau]
+        VdivWZHs = shifted_copies(VdivWZH, win, self.circular, sign=-1,
+                                  out=self.VdivWZHs)
+        corr = np.dot(WZ.transpose(1, 0, 2).reshape(self.rank, F * win),
+                      VdivWZHs.reshape(F * win, T))
+        np.multiply(H, corr, out=self.VRH.T)
 
         return logprob, WZH
 
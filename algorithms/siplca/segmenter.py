@@ -76,7 +76,10 @@ LICENSE: This module is licensed under the GNU GPL. See COPYING for details.
 """
 
 import logging
+import multiprocessing
 import numpy as np
+import time
+import traceback
 
 import msaf.input_output as io
 from msaf.algorithms.interface import SegmenterInterface
@@ -90,11 +93,75 @@ logging.basicConfig(level=logging.INFO,
 logger = logging.getLogger('segmenter')
 
 
+def _analyze_restart(args):
+    """Runs one restart of the SI-PLCA analysis, with its own seed."""
+    seq, seed, rank, win, kwargs = args
+    np.random.seed(seed)
+    return plca.SIPLCA.analyze(seq.copy(), rank=rank, win=win, **kwargs)
+
+
+def _restart_worker(args, conn):
+    """Runs one restart of the SI-PLCA analysis in its own process, sending
+    its output (or the error) through conn."""
+    try:
+        conn.send((True, _analyze_restart(args)))
+    except Exception:
+        conn.send((False, traceback.format_exc()))
+    conn.close()
+
+
+def _run_restarts(restarts, n_jobs, poll_time=0.01):
+    """Generates the outputs of the restarts of the SI-PLCA analysis in
+    order, running up to n_jobs of them at the same time, each one in its
+    own process. The restarts still running when the generator is closed
+    are terminated."""
+    pending = list(enumerate(restarts))
+    running = {}
+    outputs = {}
+    try:
+        for i in xrange(len(restarts)):
+            while i not in outputs:
+                # Start the next restarts in the idle workers
+                while len(pending) > 0 and len(running) < n_jobs:
+                    j, args = pending.pop(0)
+                    recv_conn, send_conn = multiprocessing.Pipe(False)
+                    proc = multiprocessing.Process(target=_restart_worker,
+                                                   args=(args, send_conn))
+                    proc.start()
+                    send_conn.close()
+                    running[j] = (proc, recv_conn)
+
+                # Collect the finished ones
+                for j, (proc, conn) in running.items():
+                    if not conn.poll():
+                        if proc.is_alive() or conn.poll():
+                            continue
+                        raise RuntimeError("SI-PLCA restart exited with "
+                                           "code %s" % proc.exitcode)
+                    success, output = conn.recv()
+                    proc.join()
+                    conn.close()
+                    del running[j]
+                    if not success:
+                        raise RuntimeError("SI-PLCA restart failed:\n%s" %
+                                           output)
+                    outputs[j] = output
+
+                if i not in outputs:
+                    time.sleep(poll_time)
+            yield outputs.pop(i)
+    finally:
+        for proc, conn in running.itervalues():
+            proc.terminate()
+            proc.join()
+            conn.close()
+
+
 def segment_song(seq, rank=4, win=32, seed=None,
                  nrep=1, minsegments=3, maxlowen=10, maxretries=5,
                  uninformativeWinit=False, uninformativeHinit=True,
                  normalize_frames=True, viterbi_segmenter=False,
-                 align_downbeats=False, **kwargs):
+                 align_downbeats=False, n_jobs=1, **kwargs):
     """Segment the given feature sequence using SI-PLCA
 
     Parameters
@@ -106,7 +173,9 @@ def segment_song(seq, rank=4, win=32, seed=None,
     win : int
         Length of patterns in frames.
     seed : int
-        Random number generator seed.  Defaults to None.
+        Random number generator seed.  Each repetition of the analysis
+        uses its own seed, drawn from this one, so the results only
+        depend on `seed` (and not on `n_jobs`).  Defaults to None.
     nrep : int
         Number of times to repeat the analysis.  The repetition with
         the lowest reconstrucion error is returned.  Defaults to 1.
@@ -139,6 +208,11 @@ def segment_song(seq, rank=4, win=32, seed=None,
         alignments of the components of W with V.  I.e. try to align
         the first column of W to the downbeats in the song.  Defaults
         to False.
+    n_jobs : int
+        Number of processes that run the repetitions (and retries) of
+        the analysis concurrently.  The pending ones are cancelled as
+        soon as a valid analysis is found.  Ignored (i.e. 1) inside
+        another pool of processes.  Defaults to 1.
     kwargs : dict
         Keyword arguments passed to plca.SIPLCA.analyze.  See
         plca.SIPLCA for more details.
@@ -185,11 +259,11 @@ def segment_song(seq, rank=4, win=32, seed=None,
     if uninformativeHinit:
         kwargs['initH'] = np.ones((rank, T)) / T
 
-    outputs = []
-    for n in xrange(nrep):
-        outputs.append(plca.SIPLCA.analyze(seq, rank=rank, win=win, **kwargs))
-    div = [x[-1] for x in outputs]
-    W, Z, H, norm, recon, div = outputs[np.argmin(div)]
+    # plca.SIPLCA.analyze normalizes seq in place.  Do it once here, so
+    # that all the repetitions (maybe in other processes) see the same
+    # data and their reconstructions have the scale of the input.
+    norm = seq.sum()
+    seq /= norm
 
     # Need to rerun segmentation if there are too few segments or
     # if there are too many gaps in recon (i.e. H)
@@ -197,19 +271,38 @@ def segment_song(seq, rank=4, win=32, seed=None,
     nlowen_seq = np.sum(seq.sum(0) <= lowen)
     if nlowen_seq > maxlowen:
         maxlowen = nlowen_seq
-    nlowen_recon = np.sum(recon.sum(0) <= lowen)
-    nretries = maxretries
-    while (len(Z) < minsegments or nlowen_recon > maxlowen) and nretries > 0:
-        nretries -= 1
-        logger.info('Redoing SIPLCA analysis (len(Z) = %d, number of '
-                    'low energy frames = %d).', len(Z), nlowen_recon)
-        outputs = []
-        for n in xrange(nrep):
-            outputs.append(plca.SIPLCA.analyze(seq, rank=rank, win=win,
-                                               **kwargs))
-        div = [x[-1] for x in outputs]
-        W, Z, H, norm, recon, div = outputs[np.argmin(div)]
-        nlowen_recon = np.sum(recon.sum(0) <= lowen)
+
+    # Seeds of the nrep repetitions of the first analysis and of all the
+    # possible retries
+    seeds = np.random.randint(2 ** 31 - 1, size=(maxretries + 1) * nrep)
+    restarts = [(seq, s, rank, win, kwargs) for s in seeds]
+
+    # Processes can't be started from a daemonic process (e.g. a worker of
+    # msaf.run.process)
+    if n_jobs <= 0:
+        n_jobs = multiprocessing.cpu_count()
+    if multiprocessing.current_process().daemon:
+        n_jobs = 1
+    if n_jobs == 1:
+        restart_outputs = (_analyze_restart(restart) for restart in restarts)
+    else:
+        restart_outputs = _run_restarts(restarts, n_jobs)
+    try:
+        for nretry in xrange(maxretries + 1):
+            if nretry > 0:
+                logger.info('Redoing SIPLCA analysis (len(Z) = %d, number '
+                            'of low energy frames = %d).', len(Z),
+                            nlowen_recon)
+            outputs = [restart_outputs.next() for n in xrange(nrep)]
+            div = [x[-1] for x in outputs]
+            W, Z, H, _, recon, div = outputs[np.argmin(div)]
+            recon *= norm
+            nlowen_recon = np.sum(recon.sum(0) <= lowen)
+            if len(Z) >= minsegments and nlowen_recon <= maxlowen:
+                break
+    finally:
+        # Cancels the restarts that are not needed
+        restart_outputs.close()
 
     if viterbi_segmenter:
         segmentation_function = nmf_analysis_to_segmentation_using_viterbi_path
@@ -488,6 +581,7 @@ class Segmenter(SegmenterInterface):
         self.config.pop("plotiter", None)
         self.config.pop("win", None)
         self.config.pop("rank", None)
+        self.config.pop("n_jobs", None)
 
         # Postprocess the estimations
         est_times, est_labels = self._postprocess(times, labels)
@@ -0,0 +1,177 @@
+"""
+Convex Non-negative Matrix Factorization (C-NMF) in NumPy:
+
+Ding, C., Li, T., & Jordan, M. I. (2010). Convex and Semi-Nonnegative
+Matrix Factorizations. IEEE Transactions on Pattern Analysis and Machine
+Intelligence, 32(1), 45-55.
+
+It follows the multiplicative updates of pymf.CNMF, with a convergence
+tolerance, warm starts (e.g. to add one more component to a previous
+factorization) and a Gram matrix that can be shared among factorizations
+of the same data.
+"""
+
+__author__ = "Oriol Nieto"
+__copyright__ = "Copyright 2014, Music and Audio Research Lab (MARL)"
+__license__ = "GPL"
+__version__ = "1.0"
+__email__ = "oriol@nyu.edu"
+
+import logging
+import numpy as np
+from scipy.cluster.vq import kmeans2
+
+# Avoids divisions by zero in the multiplicative updates (as in pymf)
+_EPS = 10 ** -9
+
+
+def compute_gram(X):
+    """Computes the positive and negative parts of the Gram matrix of X.
+
+    Parameters
+    ----------
+    X : np.array(p, N)
+        Data matrix, with N column observations of p features.
+
+    Returns
+    -------
+    gram : tuple(np.array(N, N), np.array(N, N))
+        Positive and negative parts of X.T * X (both non-negative).
+    """
+    XtX = np.dot(X.T, X)
+    XtX_abs = np.abs(XtX)
+    return (XtX_abs + XtX) / 2., (XtX_abs - XtX) / 2.
+
+
+def init_cnmf(X, rank, niter=10):
+    """Initializes the C-NMF matrices with k-means, as pymf.CNMF does.
+
+    Parameters
+    ----------
+    X : np.array(p, N)
+        Data matrix.
+    rank : int
+        Number of components.
+    niter : int
+        Iterations of k-means.
+
+    Returns
+    -------
+    W : np.array(N, rank)
+        Convex weights of the components (F = X * W).
+    G : np.array(rank, N)
+        Activation matrix.
+    """
+    N = X.shape[1]
+    _, assign = kmeans2(X.T, rank, iter=niter, minit="points")
+    W = np.zeros((N, rank))
+    W[np.arange(N), assign] = 1.0
+    G = W.T + 0.2
+    W += 0.01
+    W /= W.sum(axis=0)
+    return W, G
+
+
+def add_component(X, W, G):
+    """Adds one component to a factorization, to warm start a factorization
+    of higher rank. The new component is the observation that is worst
+    reconstructed.
+
+    Parameters
+    ----------
+    X : np.array(p, N)
+        Data matrix.
+    W : np.array(N, rank)
+        Convex weights of the components.
+    G : np.array(rank, N)
+        Activation matrix.
+
+    Returns
+    -------
+    W : np.array(N, rank + 1)
+        Convex weights, with the new component in the last column.
+    G : np.array(rank + 1, N)
+        Activation matrix, with the new component in the last row.
+    """
+    N = X.shape[1]
+    error = np.sum((X - np.dot(np.dot(X, W), G)) ** 2, axis=0)
+    w = np.ones(N) * 0.01
+    w[np.argmax(error)] += 1.0
+    g = np.ones(N) * 0.2
+    g[np.argmax(error)] += 1.0
+    return np.column_stack((W, w / w.sum())), np.vstack((G, g))
+
+
+def cnmf(X, rank, niter=500, tol=1e-4, gram=None, W=None, G=None):
+    """Convex Non-Negative Matrix Factorization of X, such that
+    X ~= F * G, where F = X * W.
+
+    Parameters
+    ----------
+    X : np.array(p, N)
+        Data matrix, with N column observations of p features.
+    rank : int
+        Number of components.
+    niter : int
+        Maximum number of iterations.
+    tol : float
+        Stops when the relative decrease of the reconstruction error in one
+        iteration is smaller than tol (0 to run all the iterations).
+    gram : tuple
+        Gram matrix of X, as returned by compute_gram (None to compute it).
+    W, G : np.array
+        Initial matrices, for warm starts (None to initialize them with
+        init_cnmf).
+
+    Returns
+    -------
+    F : np.array(p, rank)
+        Components (cluster centroids).
+    G : np.array(rank, N)
+        Activation matrix.
+    W : np.array(N, rank)
+        Convex weights of the components (F = X * W).
+    """
+    if gram is None:
+        gram = compute_gram(X)
+    XtX_pos, XtX_neg = gram
+    if W is None or G is None:
+        W, G = init_cnmf(X, rank)
+    W = np.array(W, dtype=np.float64)
+    G = np.array(G, dtype=np.float64)
+    if W.shape[1] != rank or G.shape[0] != rank:
+        raise ValueError("The initial matrices must have %d components" %
+                         rank)
+
+    # The products are regrouped so that nothing larger than N x rank is
+    # computed apart from the ones with the Gram matrix
+    trace = np.trace(XtX_pos) - np.trace(XtX_neg)
+    prev_error = None
+    for i in xrange(niter):
+        XtX_pos_W = np.dot(XtX_pos, W)
+        XtX_neg_W = np.dot(XtX_neg, W)
+
+        # Reconstruction error of the current factorization, from the Gram
+        # matrix products (to check convergence)
+        if tol > 0:
+            XtX_W = XtX_pos_W - XtX_neg_W
+            error = trace - 2 * np.sum(XtX_W * G.T) + \
+                np.sum(np.dot(W.T, XtX_W) * np.dot(G, G.T))
+            if prev_error is not None and \
+                    prev_error - error <= tol * abs(prev_error):
+                logging.debug("C-NMF converged after %d iterations" % i)
+                break
+            prev_error = error
+
+        # Update G
+        ha = XtX_pos_W + np.dot(G.T, np.dot(W.T, XtX_neg_W))
+        haa = XtX_neg_W + np.dot(G.T, np.dot(W.T, XtX_pos_W)) + _EPS
+        G = (G.T * np.sqrt(ha / haa)).T
+
+        # Update W
+        GGt = np.dot(G, G.T)
+        wa = np.dot(XtX_pos, G.T) + np.dot(XtX_neg_W, GGt)
+        wb = np.dot(XtX_neg, G.T) + np.dot(XtX_pos_W, GGt) + _EPS
+        W *= np.sqrt(wa / wb)
+
+    return np.dot(X, W), G, W
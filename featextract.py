@@ -20,60 +20,138 @@ import argparse
 import datetime
 import essentia
 import essentia.standard as ES
-from essentia.standard import YamlOutput
-from joblib import Parallel, delayed
+import essentia.streaming as ESS
+import functools
+import json
 import logging
+import multiprocessing
 import numpy as np
 import os
+import Queue
+import resource
+import sys
+import tempfile
 import time
+import traceback
+import wave
 
 # Local stuff
 import msaf
+from msaf import feature_cache
 from msaf import jams2
 from msaf import utils
 from msaf import input_output as io
 
+# Block-wise extraction (see compute_features_in_blocks)
+BLOCK_SIZE = 2 ** 18        # Samples of audio read at a time
+BLOCK_FRAMES = 2 ** 10      # Frames (or beats) of features computed at a time
+BEATS_WINDOW = 120.         # Seconds of audio per call to the beat tracker
+BEATS_OVERLAP = 20.         # Seconds of overlap between these calls
+
 
 class STFTFeature:
     """Class to easily compute the features that require a frame based
-        spectrum process (or STFT)."""
-    def __init__(self, frame_size, hop_size, window_type, feature, sample_rate,
-                 beats=None):
-        """STFTFeature constructor."""
+        spectrum process (or STFT). The spectrum of each frame is computed
+        only once and shared across all the features."""
+    def __init__(self, frame_size, hop_size, window_type, features):
+        """STFTFeature constructor.
+
+        Parameters
+        ----------
+        frame_size: int
+            Size of the frame in samples.
+        hop_size: int
+            Hop size in samples.
+        window_type: str
+            Essentia window type.
+        features: dict
+            Dictionary mapping each feature name to a function that computes
+            the feature coefficients from the spectrum of a frame.
+        """
         self.frame_size = frame_size
         self.hop_size = hop_size
         self.window_type = window_type
         self.w = ES.Windowing(type=window_type)
         self.spectrum = ES.Spectrum()
-        self.feature = feature  # Essentia feature object
-        self.beats = beats
-        self.sample_rate = sample_rate
+        self.features = features
 
     def compute_features(self, audio):
-        """Computes the specified Essentia features from the audio array."""
-        features = []
+        """Computes the specified features from the audio array.
+
+        Returns
+        -------
+        features: dict
+            Dictionary mapping each feature name to its framesync matrix.
+        """
+        features = dict((name, []) for name in self.features.keys())
 
         for frame in ES.FrameGenerator(audio,
                 frameSize=self.frame_size, hopSize=self.hop_size):
-            if self.feature.name() == "MFCC":
-                bands, coeffs = self.feature(self.spectrum(self.w(frame)))
-            elif self.feature.name() == "HPCP":
-                spectral_peaks = ES.SpectralPeaks()
-                freqs, mags = spectral_peaks(self.spectrum(self.w(frame)))
-                coeffs = self.feature(freqs, mags)
-            features.append(coeffs)
-
-        # Convert to Essentia Numpy array
-        features = essentia.array(features)
-
-        # Make beat-synchronous if we have the beats
-        if self.beats is not None and self.beats != []:
-            framerate = self.sample_rate / float(self.hop_size)
-            tframes = np.arange(features.shape[0]) / float(framerate)
-            features = utils.resample_mx(features.T, tframes, self.beats).T
+            for name, coeffs in self.compute_frame(frame).items():
+                features[name].append(coeffs)
+
+        # Convert to Essentia Numpy arrays
+        for name in features.keys():
+            features[name] = essentia.array(features[name])
 
         return features
 
+    def compute_frame(self, frame):
+        """Computes the specified features of a single frame.
+
+        Returns
+        -------
+        features: dict
+            Dictionary mapping each feature name to its coefficients.
+        """
+        spectrum = self.spectrum(self.w(frame))
+        return dict((name, compute_coeffs(spectrum))
+                    for name, compute_coeffs in self.features.items())
+
+    def compute_features_in_blocks(self, frames, block_frames):
+        """Computes the specified features of the frames (e.g. from
+        cut_frames) in blocks, so that only the features of block_frames
+        frames are kept in memory.
+
+        Yields
+        ------
+        features: dict
+            Dictionary mapping each feature name to its framesync matrix in
+            the current block.
+        """
+        features = dict((name, []) for name in self.features.keys())
+        for frame in frames:
+            for name, coeffs in self.compute_frame(frame).items():
+                features[name].append(coeffs)
+            if len(features.values()[0]) == block_frames:
+                yield dict((name, essentia.array(coeffs))
+                           for name, coeffs in features.items())
+                features = dict((name, []) for name in self.features.keys())
+        if len(features.values()[0]) > 0:
+            yield dict((name, essentia.array(coeffs))
+                       for name, coeffs in features.items())
+
+
+def mfcc_extractor(n_coeffs):
+    """Returns a function that computes the MFCC of a given spectrum."""
+    mfcc = ES.MFCC(numberCoefficients=n_coeffs)
+
+    def compute_mfcc(spectrum):
+        bands, coeffs = mfcc(spectrum)
+        return coeffs
+    return compute_mfcc
+
+
+def hpcp_extractor():
+    """Returns a function that computes the HPCP of a given spectrum."""
+    spectral_peaks = ES.SpectralPeaks()
+    hpcp = ES.HPCP()
+
+    def compute_hpcp(spectrum):
+        freqs, mags = spectral_peaks(spectrum)
+        return hpcp(freqs, mags)
+    return compute_hpcp
+
 
 def double_beats(beats):
     """Double the beats."""
@@ -84,54 +162,205 @@ def double_beats(beats):
     return essentia.array(new_beats)
 
 
-def compute_beats(audio):
-    """Computes the beats using Essentia."""
-    logging.info("Computing Beats...")
+def track_beats(audio):
+    """Tracks the beats of the audio using Essentia."""
     conf = 1.0
     beats, conf = ES.BeatTrackerMultiFeature()(audio)
     # beats = ES.BeatTrackerDegara()(audio)
     beats *= 44100 / msaf.Anal.sample_rate  # Essentia requires 44100 input
+    return beats, conf
 
-    # Double the beats if found beats are too little
+
+def fix_beats(beats, n_samples):
+    """Doubles the beats tracked in n_samples of audio if they are too
+        few."""
     th = 0.9  # 1 would equal to at least 1 beat per second
-    while beats.shape[0] / (audio.shape[0] / float(msaf.Anal.sample_rate)) < th \
+    while beats.shape[0] / (n_samples / float(msaf.Anal.sample_rate)) < th \
             and beats.shape[0] > 2:
         beats = double_beats(beats)
+    return beats
+
+
+def compute_beats(audio):
+    """Computes the beats using Essentia."""
+    logging.info("Computing Beats...")
+    beats, conf = track_beats(audio)
+
+    # Double the beats if found beats are too little
+    beats = fix_beats(beats, audio.shape[0])
     return beats, conf
 
 
+class BlockBeatTracker:
+    """Computes the beats of a recording from its blocks of audio, so that
+        it's never fully in memory. The beats are tracked in windows of
+        BEATS_WINDOW seconds that overlap by BEATS_OVERLAP seconds, and each
+        window only contributes the beats of its central part. Recordings
+        that fit in a single window get the same beats as compute_beats."""
+    def __init__(self, window=None, overlap=None):
+        """BlockBeatTracker constructor.
+
+        Parameters
+        ----------
+        window: float
+            Length of the windows in seconds (BEATS_WINDOW by default).
+        overlap: float
+            Overlap between windows in seconds (BEATS_OVERLAP by default).
+        """
+        if window is None:
+            window = BEATS_WINDOW
+        if overlap is None:
+            overlap = BEATS_OVERLAP
+        self.window = int(window * msaf.Anal.sample_rate)
+        self.overlap = int(overlap * msaf.Anal.sample_rate)
+        self.audio = np.zeros(0, dtype=np.float32)
+        self.start = 0          # Sample where self.audio starts
+        self.beats = []
+        self.confs = []         # (confidence, length in samples) per window
+
+    def track(self, blocks):
+        """Tracks the beats of the blocks of audio, passing them through."""
+        for block in blocks:
+            self.audio = np.concatenate((self.audio, block))
+            # The last window is only known when the audio ends
+            while self.audio.shape[0] > self.window:
+                self._track_window(self.audio[:self.window], last=False)
+                hop = self.window - self.overlap
+                self.audio = self.audio[hop:]
+                self.start += hop
+            yield block
+
+    def finish(self):
+        """Tracks the last window and returns the beats and their
+            confidence, as compute_beats."""
+        n_samples = self.start + self.audio.shape[0]
+        if self.audio.shape[0] > 0:
+            self._track_window(self.audio, last=True)
+        self.audio = np.zeros(0, dtype=np.float32)
+        beats = essentia.array(self.beats)
+        conf = 0
+        if len(self.confs) == 1:
+            conf = self.confs[0][0]
+        elif len(self.confs) > 1:
+            # Mean of the windows, weighted by the length of their parts
+            conf = sum(c * n for c, n in self.confs) / \
+                float(sum(n for c, n in self.confs))
+        return fix_beats(beats, n_samples), conf
+
+    def _track_window(self, audio, last):
+        """Tracks the beats of the window of audio starting at self.start,
+            keeping the ones in its central part."""
+        beats, conf = track_beats(audio)
+        sr = float(msaf.Anal.sample_rate)
+        lo = 0
+        if self.start > 0:
+            lo = (self.start + self.overlap / 2) / sr
+        hi = np.inf
+        if not last:
+            hi = (self.start + self.window - self.overlap / 2) / sr
+        beats = beats + self.start / sr
+        beats = beats[(beats >= lo) & (beats < hi)]
+
+        # Skip the beats already found by the previous window
+        if len(self.beats) > 1:
+            min_interval = np.median(np.diff(self.beats[-10:])) / 2.
+            beats = beats[beats - self.beats[-1] >= min_interval]
+        self.beats.extend(beats)
+        self.confs.append((conf, min(hi * sr, self.start + audio.shape[0]) -
+                           max(lo * sr, self.start)))
+
+
+def compute_framesync_features(audio):
+    """Computes the framesync MFCC, HPCP and Tonnetz features, computing the
+        spectrum of each frame only once."""
+    logging.info("Computing MFCCs and HPCPs...")
+    stft = STFTFeature(msaf.Anal.frame_size, msaf.Anal.hop_size,
+                       msaf.Anal.window_type,
+                       {"mfcc": mfcc_extractor(msaf.Anal.mfcc_coeff),
+                        "hpcp": hpcp_extractor()})
+    features = stft.compute_features(audio)
+    mfcc = features["mfcc"]
+    hpcp = features["hpcp"]
+    #plt.imshow(hpcp.T, interpolation="nearest", aspect="auto"); plt.show()
+    logging.info("Computing Tonnetz...")
+    tonnetz = utils.chroma_to_tonnetz(hpcp)
+    return mfcc, hpcp, tonnetz
+
+
+def sync_features(mfcc, hpcp, beats):
+    """Makes the framesync MFCC and HPCP beat-synchronous given a set of
+        beats (beats), and computes the Tonnetz from the beat-synchronous
+        HPCP."""
+    if beats is not None and len(beats) > 0:
+        logging.info("Computing Beat-synchronous features...")
+        framerate = msaf.Anal.sample_rate / float(msaf.Anal.hop_size)
+        tframes = np.arange(mfcc.shape[0]) / float(framerate)
+        mfcc, hpcp = utils.resample_mx([mfcc.T, hpcp.T], tframes, beats)
+        mfcc = mfcc.T
+        hpcp = hpcp.T
+    tonnetz = utils.chroma_to_tonnetz(hpcp)
+    return mfcc, hpcp, tonnetz
+
+
+def sync_features_in_blocks(mfcc, hpcp, beats, writer, key):
+    """Makes the framesync MFCC and HPCP beat-synchronous as sync_features,
+        in blocks of BLOCK_FRAMES beats, appending them (and the Tonnetz) to
+        the FeaturesWriter writer under the given key (e.g. "est_beatsync").
+        Only the frames of each block are read from mfcc and hpcp (e.g.
+        memory-mapped)."""
+    n_frames = mfcc.shape[0]
+    if beats is None or len(beats) == 0:
+        # As sync_features, the framesync features are kept
+        for i in xrange(0, max(n_frames, 1), BLOCK_FRAMES):
+            save_blocks(writer, key, *sync_features(
+                mfcc[i:i + BLOCK_FRAMES], hpcp[i:i + BLOCK_FRAMES], None))
+        return
+
+    logging.info("Computing Beat-synchronous features...")
+    framerate = msaf.Anal.sample_rate / float(msaf.Anal.hop_size)
+    tframes = np.arange(n_frames) / float(framerate)
+    for i in xrange(0, len(beats), BLOCK_FRAMES):
+        # The next beat ends the last beat of the block
+        outcolpos = beats[i:i + BLOCK_FRAMES + 1]
+
+        # Frames from the one where the block starts to the first one after
+        # the last beat, so that resample_mx sees the same columns
+        first = max(0, np.searchsorted(tframes, outcolpos[0], "right") - 1)
+        last = min(n_frames, np.searchsorted(tframes, outcolpos[-1],
+                                             "right") + 1)
+        bs_mfcc, bs_hpcp = utils.resample_mx(
+            [mfcc[first:last].T, hpcp[first:last].T], tframes[first:last],
+            outcolpos)
+        n_beats = min(BLOCK_FRAMES, len(beats) - i)
+        bs_mfcc = bs_mfcc[:, :n_beats].T
+        bs_hpcp = bs_hpcp[:, :n_beats].T
+        save_blocks(writer, key, bs_mfcc, bs_hpcp,
+                    utils.chroma_to_tonnetz(bs_hpcp))
+
+
 def compute_features(audio, beats=None):
     """Computes the HPCP and MFCC beat-synchronous features given a set
         of beats (beats)."""
-    beatsync_str = ""
+    mfcc, hpcp, tonnetz = compute_framesync_features(audio)
     if beats is not None:
-        beatsync_str = "Beat-synchronous "
-
-    MFCC = STFTFeature(msaf.Anal.frame_size, msaf.Anal.hop_size,
-                       msaf.Anal.window_type,
-                       ES.MFCC(numberCoefficients=msaf.Anal.mfcc_coeff),
-                       msaf.Anal.sample_rate, beats)
-    HPCP = STFTFeature(msaf.Anal.frame_size, msaf.Anal.hop_size,
-                       msaf.Anal.window_type, ES.HPCP(), msaf.Anal.sample_rate,
-                       beats)
-    logging.info("Computing %sMFCCs..." % beatsync_str)
-    mfcc = MFCC.compute_features(audio)
-    logging.info("Computing %sHPCPs..." % beatsync_str)
-    hpcp = HPCP.compute_features(audio)
-    #plt.imshow(hpcp.T, interpolation="nearest", aspect="auto"); plt.show()
-    logging.info("Computing %sTonnetz..." % beatsync_str)
-    tonnetz = utils.chroma_to_tonnetz(hpcp)
+        mfcc, hpcp, tonnetz = sync_features(mfcc, hpcp, beats)
     return mfcc, hpcp, tonnetz
 
 
-def save_features(key, pool, mfcc, hpcp, tonnetz):
-    """Saves the features into the specified pool under the given key."""
-    [pool.add(key + ".mfcc", essentia.array(mfcc_coeff))
-        for mfcc_coeff in mfcc]
-    [pool.add(key + ".hpcp", essentia.array(hpcp_coeff))
-        for hpcp_coeff in hpcp]
-    [pool.add(key + ".tonnetz", essentia.array(tonnetz_coeff))
-        for tonnetz_coeff in tonnetz]
+def save_features(key, out_features, mfcc, hpcp, tonnetz):
+    """Saves the features into the specified dictionary under the given
+    key."""
+    out_features[key + ".mfcc"] = mfcc
+    out_features[key + ".hpcp"] = hpcp
+    out_features[key + ".tonnetz"] = tonnetz
+
+
+def save_blocks(writer, key, mfcc, hpcp, tonnetz):
+    """Appends a block of features to the FeaturesWriter writer under the
+    given key."""
+    writer.append(key + ".mfcc", mfcc)
+    writer.append(key + ".hpcp", hpcp)
+    writer.append(key + ".tonnetz", tonnetz)
 
 
 def read_audio(audio_file, sample_rate):
@@ -141,7 +370,131 @@ def read_audio(audio_file, sample_rate):
     return audio
 
 
+def is_pcm_wav(audio_file, sample_rate):
+    """Checks whether the audio file is a 16 bit PCM wav file with the given
+    sample rate."""
+    try:
+        wav = wave.open(audio_file, "rb")
+    except (wave.Error, EOFError, IOError):
+        return False
+    try:
+        return wav.getsampwidth() == 2 and wav.getframerate() == sample_rate
+    finally:
+        wav.close()
+
+
+def read_audio_blocks(audio_file, sample_rate, block_size=None):
+    """Reads the audio file as read_audio, but in blocks of block_size
+        samples (BLOCK_SIZE by default), so that it is never fully in memory.
+
+        16 bit PCM wav files with the given sample rate are read directly.
+        Other files are first decoded into a temporary wav file by Essentia's
+        streaming MonoLoader, which only keeps a buffer of the audio in
+        memory."""
+    if block_size is None:
+        block_size = BLOCK_SIZE
+    tmp_file = None
+    if not is_pcm_wav(audio_file, sample_rate):
+        fd, tmp_file = tempfile.mkstemp(suffix=".wav")
+        os.close(fd)
+        loader = ESS.MonoLoader(filename=audio_file, sampleRate=sample_rate)
+        writer = ESS.MonoWriter(filename=tmp_file, sampleRate=sample_rate,
+                                format="wav")
+        loader.audio >> writer.audio
+        essentia.run(loader)
+        audio_file = tmp_file
+    try:
+        wav = wave.open(audio_file, "rb")
+        try:
+            n_channels = wav.getnchannels()
+            while True:
+                data = wav.readframes(block_size)
+                if len(data) == 0:
+                    break
+                block = np.frombuffer(data, dtype="<i2").reshape(
+                    -1, n_channels)
+                # Downmixed as MonoLoader
+                yield essentia.array(block.mean(axis=1) / 32768.)
+        finally:
+            wav.close()
+    finally:
+        if tmp_file is not None:
+            os.remove(tmp_file)
+
+
+def cut_frames(blocks, frame_size, hop_size):
+    """Cuts the blocks of audio into the same frames as ES.FrameGenerator
+        cuts the whole audio: the first frame is centered on the first
+        sample, the last one is the last that starts before the end of the
+        audio, and the frames are zero-padded beyond its limits. Only a block
+        and a frame of audio are kept in memory."""
+    start = -((frame_size + 1) // 2)   # Start of the next frame
+    buf = np.zeros(-start, dtype=np.float32)
+    buf_start = start                   # Start of buf
+    n_samples = 0
+    for block in blocks:
+        buf = np.concatenate((buf, block))
+        n_samples += block.shape[0]
+        while start + frame_size <= n_samples:
+            yield buf[start - buf_start:start - buf_start + frame_size]
+            start += hop_size
+        buf = buf[start - buf_start:]
+        buf_start = start
+
+    # Last frames, zero-padded
+    while 0 < n_samples and start < n_samples:
+        frame = np.zeros(frame_size, dtype=np.float32)
+        frame[:n_samples - start] = buf[start - buf_start:]
+        yield frame
+        start += hop_size
+
+
+def compute_features_in_blocks(audio_file, writer):
+    """Computes the features that only depend on the audio file (as
+        compute_audio_features) in blocks, appending them to the
+        FeaturesWriter writer as they are computed, so that memory doesn't
+        grow with the length of the track.
+
+        Returns
+        -------
+        analysis: dict
+            The analysis parameters stored in the features file.
+    """
+    logging.info("Computing the features of %s in blocks" %
+                 os.path.basename(audio_file))
+    beat_tracker = BlockBeatTracker()
+    blocks = beat_tracker.track(read_audio_blocks(audio_file,
+                                                  msaf.Anal.sample_rate))
+
+    # Framesync features
+    stft = STFTFeature(msaf.Anal.frame_size, msaf.Anal.hop_size,
+                       msaf.Anal.window_type,
+                       {"mfcc": mfcc_extractor(msaf.Anal.mfcc_coeff),
+                        "hpcp": hpcp_extractor()})
+    frames = cut_frames(blocks, msaf.Anal.frame_size, msaf.Anal.hop_size)
+    for features in stft.compute_features_in_blocks(frames, BLOCK_FRAMES):
+        save_blocks(writer, "framesync", features["mfcc"], features["hpcp"],
+                    utils.chroma_to_tonnetz(features["hpcp"]))
+
+    # Beats and beat-synchronous features
+    beats, conf = beat_tracker.finish()
+    writer["beats.times"] = beats
+    writer["beats.confidence"] = [conf]
+    sync_features_in_blocks(writer.get("framesync.mfcc"),
+                            writer.get("framesync.hpcp"), beats, writer,
+                            "est_beatsync")
+
+    analysis = get_analysis_params()
+    # Duration as covered by the framesync features
+    analysis["dur"] = writer.get("framesync.hpcp").shape[0] * \
+        msaf.Anal.hop_size / float(msaf.Anal.sample_rate)
+    writer["analysis"] = analysis
+    return analysis
+
+
 def compute_features_for_audio_file(audio_file):
+    """Computes the framesync and beatsync features of the given audio
+        file."""
     # Load Audio
     logging.info("Loading audio file %s" % os.path.basename(audio_file))
     audio = read_audio(audio_file, msaf.Anal.sample_rate)
@@ -151,14 +504,14 @@ def compute_features_for_audio_file(audio_file):
 
     # Compute framesync features
     features["mfcc"], features["hpcp"], features["tonnetz"] = \
-        compute_features(audio)
+        compute_framesync_features(audio)
 
     # Estimate Beats
     features["beats"], features["beats_conf"] = compute_beats(audio)
 
-    # Compute Beat-sync features
+    # Compute Beat-sync features from the framesync ones
     features["bs_mfcc"], features["bs_hpcp"], features["bs_tonnetz"] = \
-        compute_features(audio, features["beats"])
+        sync_features(features["mfcc"], features["hpcp"], features["beats"])
 
     # Analysis parameters
     features["anal"] = {}
@@ -172,73 +525,340 @@ def compute_features_for_audio_file(audio_file):
     return audio, features
 
 
-def compute_all_features(file_struct, audio_beats=False, overwrite=False):
+def get_analysis_params():
+    """Gets the current analysis parameters, as stored in the features
+        files."""
+    return {
+        "sample_rate": msaf.Anal.sample_rate,
+        "frame_rate": msaf.Anal.frame_size,
+        "hop_size": msaf.Anal.hop_size,
+        "window_type": msaf.Anal.window_type,
+        "mfcc_coeff": msaf.Anal.mfcc_coeff
+    }
+
+
+def has_same_analysis(features_file):
+    """Checks whether the given features file was computed using the current
+        analysis parameters."""
+    try:
+        analysis = io.read_features(features_file, ["analysis"])["analysis"]
+    except Exception as e:
+        logging.warning("Can't read the analysis parameters from %s (%s)" %
+                        (features_file, e))
+        return False
+    for key, value in get_analysis_params().iteritems():
+        if analysis.get(key) != value:
+            return False
+    return True
+
+
+def compute_audio_features(audio_file):
+    """Computes the features that only depend on the audio file (i.e. all
+        but the annotated beat-synchronous ones), in the format of the
+        features files."""
+    audio, features = compute_features_for_audio_file(audio_file)
+    out_features = {}
+    out_features["beats.times"] = features["beats"]
+    out_features["beats.confidence"] = [features["beats_conf"]]
+    out_features["analysis"] = get_analysis_params()
+    # Duration as covered by the framesync features (as read so far)
+    out_features["analysis"]["dur"] = features["hpcp"].shape[0] * \
+        msaf.Anal.hop_size / float(msaf.Anal.sample_rate)
+    save_features("framesync", out_features, features["mfcc"],
+                  features["hpcp"], features["tonnetz"])
+    save_features("est_beatsync", out_features, features["bs_mfcc"],
+                  features["bs_hpcp"], features["bs_tonnetz"])
+    return audio, out_features
+
+
+def read_annot_beats(ref_file):
+    """Reads the annotated beats of a JAMS file (None if there are none)."""
+    jam = jams2.load(ref_file)
+    if jam.beats == []:
+        return None
+    logging.info("Reading beat annotations from JAMS")
+    annot = jam.beats[0]
+    annot_beats = []
+    for data in annot.data:
+        annot_beats.append(data.time.value)
+    return essentia.array(np.unique(annot_beats).tolist())
+
+
+def get_timestamp():
+    """Gets the timestamp stored in the features files."""
+    return datetime.datetime.today().strftime("%Y/%m/%d %H:%M:%S")
+
+
+def compute_all_features(file_struct, audio_beats=False, overwrite=False,
+                         blocks=False):
     """Computes all the features for a specific audio file and its respective
         human annotations. It creates an audio file with the estimated
-        beats if needed."""
+        beats if needed.
+
+        The features that only depend on the audio are reused from the
+        features cache (msaf.FeatureCache) when possible, unless overwrite
+        is set, in which case they are recomputed and the cache is
+        updated.
+
+        With blocks, the features are computed and written in blocks (see
+        compute_features_in_blocks), for recordings that are too long to be
+        processed in memory. The features cache and audio_beats are not
+        available in this mode."""
 
     # Output file
     out_file = file_struct.features_file
 
     if os.path.isfile(out_file) and not overwrite:
-        return  # Do nothing, file already exist and we are not overwriting it
-
-    # Compute the features for the given audio file
-    audio, features = compute_features_for_audio_file(file_struct.audio_file)
+        if has_same_analysis(out_file):
+            return  # Already computed with the current analysis parameters
+        logging.info("Analysis parameters of %s changed, recomputing" %
+                     os.path.basename(out_file))
+
+    if blocks:
+        if audio_beats:
+            logging.warning("Can't save the beats as an audio file when "
+                            "computing the features in blocks")
+        with io.FeaturesWriter(out_file) as writer:
+            compute_features_in_blocks(file_struct.audio_file, writer)
+
+            # Annotated beat-synchronous features, if there are annotations
+            annot_beats = None
+            if os.path.isfile(file_struct.ref_file):
+                annot_beats = read_annot_beats(file_struct.ref_file)
+            if annot_beats is not None:
+                sync_features_in_blocks(writer.get("framesync.mfcc"),
+                                        writer.get("framesync.hpcp"),
+                                        annot_beats, writer, "ann_beatsync")
+
+            logging.info("Saving the features file in %s" % out_file)
+            writer["timestamp"] = get_timestamp()
+        return
+
+    # Get the features for the given audio file from the cache or compute them
+    audio = None
+    out_features = None
+    if msaf.FeatureCache.enabled:
+        audio_hash = feature_cache.hash_audio(file_struct.audio_file)
+        if not overwrite:
+            out_features = feature_cache.get(audio_hash,
+                                             get_analysis_params())
+    if out_features is None:
+        audio, out_features = compute_audio_features(file_struct.audio_file)
+        if msaf.FeatureCache.enabled:
+            feature_cache.put(audio_hash, get_analysis_params(), out_features)
+    else:
+        logging.info("Reusing cached features for %s" %
+                     os.path.basename(file_struct.audio_file))
 
     # Save output as audio file
     if audio_beats:
+        if audio is None:
+            audio = read_audio(file_struct.audio_file, msaf.Anal.sample_rate)
         logging.info("Saving Beats as an audio file")
-        marker = ES.AudioOnsetsMarker(onsets=features["beats"], type='beep',
-                                      sampleRate=msaf.Anal.sample_rate)
+        marker = ES.AudioOnsetsMarker(
+            onsets=essentia.array(out_features["beats.times"]), type='beep',
+            sampleRate=msaf.Anal.sample_rate)
         marked_audio = marker(audio)
         ES.MonoWriter(filename='beats.wav',
                       sampleRate=msaf.Anal.sample_rate)(marked_audio)
 
     # Read annotations if they exist in path/references_dir/file.jams
     if os.path.isfile(file_struct.ref_file):
-        jam = jams2.load(file_struct.ref_file)
+        annot_beats = read_annot_beats(file_struct.ref_file)
 
         # If beat annotations exist, compute also annotated beatsyn features
-        if jam.beats != []:
-            logging.info("Reading beat annotations from JAMS")
-            annot = jam.beats[0]
-            annot_beats = []
-            for data in annot.data:
-                annot_beats.append(data.time.value)
-            annot_beats = essentia.array(np.unique(annot_beats).tolist())
-            annot_mfcc, annot_hpcp, annot_tonnetz = compute_features(
-                audio, annot_beats)
-
-    # Save output as json file
-    logging.info("Saving the JSON file in %s" % out_file)
-    yaml = YamlOutput(filename=out_file, format='json')
-    pool = essentia.Pool()
-    pool.add("beats.times", features["beats"])
-    pool.add("beats.confidence", features["beats_conf"])
-    pool.set("analysis.sample_rate", msaf.Anal.sample_rate)
-    pool.set("analysis.frame_rate", msaf.Anal.frame_size)
-    pool.set("analysis.hop_size", msaf.Anal.hop_size)
-    pool.set("analysis.window_type", msaf.Anal.window_type)
-    pool.set("analysis.mfcc_coeff", msaf.Anal.mfcc_coeff)
-    pool.set("timestamp",
-             datetime.datetime.today().strftime("%Y/%m/%d %H:%M:%S"))
-    save_features("framesync", pool, features["mfcc"], features["hpcp"],
-                  features["tonnetz"])
-    save_features("est_beatsync", pool, features["bs_mfcc"],
-                  features["bs_hpcp"], features["bs_tonnetz"])
-    if os.path.isfile(file_struct.ref_file) and jam.beats != []:
-        save_features("ann_beatsync", pool, annot_mfcc, annot_hpcp,
-                      annot_tonnetz)
-    yaml(pool)
-
-
-def process(in_path, audio_beats=False, n_jobs=1, overwrite=False):
+        if annot_beats is not None:
+            annot_mfcc, annot_hpcp, annot_tonnetz = sync_features(
+                out_features["framesync.mfcc"],
+                out_features["framesync.hpcp"], annot_beats)
+            save_features("ann_beatsync", out_features, annot_mfcc,
+                          annot_hpcp, annot_tonnetz)
+
+    # Save output as binary file
+    logging.info("Saving the features file in %s" % out_file)
+    out_features["timestamp"] = get_timestamp()
+    io.write_features(out_file, out_features)
+
+
+def get_duration(audio_file):
+    """Gets the duration of the given audio file from its metadata, without
+        decoding it (0 if it can't be read)."""
+    try:
+        # The last outputs are: duration, bitrate, sample rate, channels
+        return float(ES.MetadataReader(filename=audio_file)()[-4])
+    except Exception as e:
+        logging.warning("Can't read the duration of %s (%s)" %
+                        (os.path.basename(audio_file), e))
+        return 0
+
+
+def read_manifest(manifest_file):
+    """Reads the manifest of a feature extraction run (empty if it doesn't
+        exist yet)."""
+    if not os.path.isfile(manifest_file):
+        return {}
+    with open(manifest_file, "r") as f:
+        return json.load(f)
+
+
+def write_manifest(manifest_file, manifest):
+    """Writes the manifest of a feature extraction run. The file is replaced
+        atomically, so that it's never left half-written."""
+    tmp_file = manifest_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.rename(tmp_file, manifest_file)
+
+
+def _extraction_worker(compute, file_struct, audio_beats, overwrite,
+                       max_memory, errors):
+    """Computes all the features of a track in its own process (calling
+        compute), reporting any error to the errors queue."""
+    if max_memory is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (max_memory, max_memory))
+    try:
+        compute(file_struct, audio_beats, overwrite)
+    except Exception:
+        errors.put((file_struct.audio_file, traceback.format_exc()))
+        sys.exit(1)
+
+
+def schedule_features(file_structs, manifest_file, audio_beats=False,
+                      n_jobs=1, overwrite=False, timeout=None,
+                      max_memory=None, retry_failed=False,
+                      poll_time=0.1, compute=compute_all_features):
+    """Computes the features of a set of tracks in a pool of processes.
+
+    Tracks are scheduled longest first, and each idle worker takes the next
+    pending track, so that the load is balanced across workers. Each track
+    runs in its own process, which is killed if it exceeds the timeout, and
+    it can't use more than max_memory. The outcome of each track is recorded
+    in the manifest, so that an interrupted run can be resumed.
+
+    Parameters
+    ----------
+    file_structs : list
+        List of FileStruct of the tracks to process.
+    manifest_file : str
+        Path to the JSON manifest of the run.
+    audio_beats : bool
+        Whether to output an audio file with the estimated beats.
+    n_jobs : int
+        Number of processes.
+    overwrite : bool
+        Whether to recompute the features of the tracks already processed.
+    timeout : float
+        Maximum time (in seconds) to process a track (None for no limit).
+    max_memory : int
+        Maximum memory (address space, in bytes) to process a track (None for
+        no limit).
+    retry_failed : bool
+        Whether to retry the tracks that failed in previous runs.
+    poll_time : float
+        Time (in seconds) between checks of the running processes.
+    compute : function
+        Function that computes the features of a track, called as
+        compute(file_struct, audio_beats, overwrite).
+
+    Returns
+    -------
+    manifest : dict
+        Dictionary with the outcome of each track, indexed by the name of its
+        audio file.
+    """
+    manifest = read_manifest(manifest_file)
+    analysis = get_analysis_params()
+
+    # Get the pending tracks
+    pending = []
+    for file_struct in file_structs:
+        entry = manifest.get(os.path.basename(file_struct.audio_file))
+        if entry is not None and not overwrite and \
+                entry.get("analysis") == analysis:
+            if entry["status"] == "done" and \
+                    os.path.isfile(file_struct.features_file):
+                continue
+            if entry["status"] == "failed" and not retry_failed:
+                logging.info("Skipping %s, failed in a previous run" %
+                             os.path.basename(file_struct.audio_file))
+                continue
+        pending.append(file_struct)
+
+    # Longest first, so that long tracks don't end up running alone
+    durations = dict((file_struct.audio_file,
+                      get_duration(file_struct.audio_file))
+                     for file_struct in pending)
+    pending.sort(key=lambda file_struct: durations[file_struct.audio_file],
+                 reverse=True)
+
+    errors = multiprocessing.Queue()
+    running = {}
+    error_msgs = {}
+    n_tracks = len(pending)
+    while len(pending) > 0 or len(running) > 0:
+        # Start the next tracks in the idle workers
+        while len(pending) > 0 and len(running) < n_jobs:
+            file_struct = pending.pop(0)
+            proc = multiprocessing.Process(
+                target=_extraction_worker,
+                args=(compute, file_struct, audio_beats, overwrite,
+                      max_memory, errors))
+            proc.start()
+            running[file_struct.audio_file] = (proc, time.time())
+
+        time.sleep(poll_time)
+
+        # Check the finished processes before reading their errors, so that
+        # all the errors of the finished ones have been sent
+        finished = [audio_file for audio_file, (proc, start) in
+                    running.iteritems() if not proc.is_alive()]
+        while True:
+            try:
+                audio_file, error_msg = errors.get_nowait()
+            except Queue.Empty:
+                break
+            error_msgs[audio_file] = error_msg
+
+        for audio_file, (proc, start) in running.items():
+            elapsed = time.time() - start
+            if audio_file not in finished:
+                if timeout is None or elapsed < timeout:
+                    continue
+                proc.terminate()
+                proc.join()
+                error_msg = "Timeout after %.2f seconds" % elapsed
+            else:
+                proc.join()
+                error_msg = error_msgs.pop(
+                    audio_file, "Process exited with code %d" % proc.exitcode)
+            del running[audio_file]
+
+            # Record the outcome of the track
+            entry = {
+                "status": "done" if proc.exitcode == 0 else "failed",
+                "duration": durations[audio_file],
+                "time": elapsed,
+                "analysis": analysis
+            }
+            if proc.exitcode != 0:
+                entry["error"] = error_msg
+                logging.error("Failed to compute the features of %s: %s" %
+                              (os.path.basename(audio_file), error_msg))
+            manifest[os.path.basename(audio_file)] = entry
+            write_manifest(manifest_file, manifest)
+            logging.info("%d/%d tracks processed" %
+                         (n_tracks - len(pending) - len(running), n_tracks))
+
+    return manifest
+
+
+def process(in_path, audio_beats=False, n_jobs=1, overwrite=False,
+            timeout=None, max_memory=None, retry_failed=False, blocks=False):
     """Main process."""
 
     # If in_path it's a file, we only compute one file
     if os.path.isfile(in_path):
-        compute_all_features(in_path, audio_beats, overwrite)
+        compute_all_features(in_path, audio_beats, overwrite, blocks)
 
     elif os.path.isdir(in_path):
         # Check that in_path exists
@@ -247,10 +867,19 @@ def process(in_path, audio_beats=False, n_jobs=1, overwrite=False):
         # Get files
         file_structs = io.get_dataset_files(in_path)
 
-        # Compute features using joblib
-        Parallel(n_jobs=n_jobs)(delayed(compute_all_features)(
-            file_struct, audio_beats, overwrite)
-            for file_struct in file_structs)
+        # Compute features in a pool of processes
+        manifest_file = os.path.join(in_path, msaf.Dataset.features_manifest)
+        manifest = schedule_features(
+            file_structs, manifest_file, audio_beats=audio_beats,
+            n_jobs=n_jobs, overwrite=overwrite, timeout=timeout, max_memory=max_memory,
+            retry_failed=retry_failed,
+            compute=functools.partial(compute_all_features, blocks=blocks))
+
+        failed = [audio_file for audio_file, entry in manifest.iteritems()
+                  if entry["status"] == "failed"]
+        if len(failed) > 0:
+            logging.warning("The features of %d tracks could not be "
+                            "computed (see %s)" % (len(failed), manifest_file))
 
 
 def main():
@@ -278,6 +907,38 @@ def main():
                         dest="overwrite",
                         help="Overwrite the previously computed features",
                         default=False)
+    parser.add_argument("-t",
+                        action="store",
+                        dest="timeout",
+                        type=float,
+                        help="Maximum time to process a track (in seconds)",
+                        default=None)
+    parser.add_argument("-m",
+                        action="store",
+                        dest="max_memory",
+                        type=int,
+                        help="Maximum memory to process a track (in MB)",
+                        default=None)
+    parser.add_argument("-rf",
+                        action="store_true",
+                        dest="retry_failed",
+                        help="Retry the tracks that failed in previous runs",
+                        default=False)
+    parser.add_argument("-c",
+                        action="store_true",
+                        dest="cache",
+                        help="Reuse and store the features in the features "
+                        "cache (%s, up to %d MB)" % (
+                            msaf.FeatureCache.cache_dir,
+                            msaf.FeatureCache.max_size / 2 ** 20),
+                        default=False)
+    parser.add_argument("-b",
+                        action="store_true",
+                        dest="blocks",
+                        help="Compute the features in blocks of audio, so "
+                        "that memory doesn't grow with the length of the "
+                        "tracks (for long recordings)",
+                        default=False)
     args = parser.parse_args()
     start_time = time.time()
 
@@ -286,8 +947,14 @@ def main():
         level=logging.INFO)
 
     # Run the algorithm
+    msaf.FeatureCache.enabled = args.cache
+    max_memory = None
+    if args.max_memory is not None:
+        max_memory = args.max_memory * 2 ** 20
     process(args.in_path, args.audio_beats, n_jobs=args.n_jobs,
-            overwrite=args.overwrite)
+            overwrite=args.overwrite, timeout=args.timeout,
+            max_memory=max_memory, retry_failed=args.retry_failed,
+            blocks=args.blocks)
 
     # Done!
     logging.info("Done! Took %.2f seconds." % (time.time() - start_time))
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+"""
+Content-addressed cache of the features computed by MSAF.
+
+Each entry contains the features that only depend on the audio (i.e. the
+framesync and estimated beat-synchronous features, and the estimated beats),
+and it is keyed by the hash of the content of the audio file plus the hash of
+the analysis parameters. This way, features computed with different analysis
+parameters can coexist, and they can be reused across datasets and copies of
+the same audio file.
+
+The cache is bounded in size: the least recently used entries are removed
+once it grows beyond msaf.FeatureCache.max_size. The size of the cache is
+kept in a counter file, so that the entries are only listed when it has to
+be pruned.
+
+Usage:
+
+    ./feature_cache.py stats
+    ./feature_cache.py prune -s 1024
+"""
+
+__author__ = "Oriol Nieto"
+__copyright__ = "Copyright 2014, Music and Audio Research Lab (MARL)"
+__license__ = "GPL"
+__version__ = "1.0"
+__email__ = "oriol@nyu.edu"
+
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+# Local stuff
+import msaf
+from msaf import input_output as io
+from msaf import utils
+
+# Counter with the size of the cache in bytes (approximate between prunes)
+SIZE_FILE = ".size"
+
+# Suffix of the files being written, so that they are not taken as entries
+TMP_EXT = ".tmp"
+
+
+def hash_audio(audio_file, block_size=2 ** 20):
+    """Computes the SHA-1 hash of the content of the given audio file."""
+    sha1 = hashlib.sha1()
+    with open(audio_file, "rb") as f:
+        block = f.read(block_size)
+        while block:
+            sha1.update(block)
+            block = f.read(block_size)
+    return sha1.hexdigest()
+
+
+def hash_params(params):
+    """Computes the SHA-1 hash of the given analysis parameters."""
+    return hashlib.sha1(json.dumps(params, sort_keys=True)).hexdigest()
+
+
+def get_cache_file(audio_hash, params, cache_dir=None):
+    """Gets the path to the cache entry of the given audio hash and analysis
+    parameters."""
+    if cache_dir is None:
+        cache_dir = msaf.FeatureCache.cache_dir
+    return os.path.join(cache_dir, audio_hash[:2], "%s_%s%s" % (
+        audio_hash, hash_params(params)[:16], msaf.Dataset.features_ext))
+
+
+def get(audio_hash, params, cache_dir=None):
+    """Gets the cached features of an audio file.
+
+    Parameters
+    ----------
+    audio_hash : str
+        Hash of the content of the audio file (see hash_audio).
+    params : dict
+        Analysis parameters used to compute the features.
+    cache_dir : str
+        Cache directory (None to use msaf.FeatureCache.cache_dir).
+
+    Returns
+    -------
+    features : dict
+        Dictionary with the cached features (see io.write_features), or None
+        if they are not in the cache.
+    """
+    cache_file = get_cache_file(audio_hash, params, cache_dir)
+    if not os.path.isfile(cache_file):
+        return None
+    try:
+        features = io.read_features(cache_file)
+    except Exception as e:
+        logging.warning("Corrupt cache entry %s (%s)" % (cache_file, e))
+        return None
+
+    # Mark as recently used
+    try:
+        os.utime(cache_file, None)
+    except OSError:
+        pass  # Removed by another process after reading it
+    return features
+
+
+def read_size(cache_dir):
+    """Reads the size counter of the cache (None if it doesn't exist)."""
+    try:
+        with open(os.path.join(cache_dir, SIZE_FILE), "r") as f:
+            return int(f.read())
+    except (IOError, ValueError):
+        return None
+
+
+def write_size(cache_dir, size):
+    """Writes the size counter of the cache. The file is replaced
+    atomically."""
+    fd, tmp_file = tempfile.mkstemp(suffix=TMP_EXT, dir=cache_dir)
+    with os.fdopen(fd, "w") as f:
+        f.write(str(size))
+    os.rename(tmp_file, os.path.join(cache_dir, SIZE_FILE))
+
+
+def put(audio_hash, params, features, cache_dir=None, max_size=None):
+    """Stores the features of an audio file in the cache, and removes the
+    least recently used entries if the size counter says that the cache got
+    too large.
+
+    Parameters
+    ----------
+    audio_hash : str
+        Hash of the content of the audio file (see hash_audio).
+    params : dict
+        Analysis parameters used to compute the features.
+    features : dict
+        Features to be stored (see io.write_features).
+    cache_dir : str
+        Cache directory (None to use msaf.FeatureCache.cache_dir).
+    max_size : int
+        Maximum size of the cache in bytes (None to use
+        msaf.FeatureCache.max_size).
+    """
+    if cache_dir is None:
+        cache_dir = msaf.FeatureCache.cache_dir
+    if max_size is None:
+        max_size = msaf.FeatureCache.max_size
+    cache_file = get_cache_file(audio_hash, params, cache_dir)
+    utils.ensure_dir(os.path.dirname(cache_file))
+
+    # Write in a temporary file first, so that concurrent processes never
+    # read half-written entries (nor take it as an entry)
+    fd, tmp_file = tempfile.mkstemp(suffix=TMP_EXT,
+                                    dir=os.path.dirname(cache_file))
+    os.close(fd)
+    try:
+        io.write_features(tmp_file, features)
+        size = os.path.getsize(tmp_file)
+        os.rename(tmp_file, cache_file)
+    finally:
+        if os.path.isfile(tmp_file):
+            os.remove(tmp_file)
+
+    # Concurrent updates of the counter may be lost, but the next prune
+    # counts the actual size again
+    cache_size = read_size(cache_dir)
+    if cache_size is None or cache_size + size > max_size:
+        prune(cache_dir, max_size)
+    else:
+        write_size(cache_dir, cache_size + size)
+
+
+def get_entries(cache_dir=None):
+    """Gets all the cache entries, sorted from least to most recently used.
+
+    Returns
+    -------
+    entries : list
+        List of (path, size in bytes, last used timestamp) tuples.
+    """
+    if cache_dir is None:
+        cache_dir = msaf.FeatureCache.cache_dir
+    entries = []
+    for cache_file in glob.glob(os.path.join(
+            cache_dir, "*", "*" + msaf.Dataset.features_ext)):
+        try:
+            stat = os.stat(cache_file)
+        except OSError:
+            continue  # Removed by another process
+        entries.append((cache_file, stat.st_size, stat.st_mtime))
+    return sorted(entries, key=lambda entry: entry[2])
+
+
+def prune(cache_dir=None, max_size=None):
+    """Removes the least recently used entries until the cache is not larger
+    than max_size bytes (None to use msaf.FeatureCache.max_size), and
+    updates the size counter.
+
+    Returns
+    -------
+    n_removed : int
+        Number of removed entries.
+    """
+    if cache_dir is None:
+        cache_dir = msaf.FeatureCache.cache_dir
+    if max_size is None:
+        max_size = msaf.FeatureCache.max_size
+    entries = get_entries(cache_dir)
+    total_size = sum(entry[1] for entry in entries)
+    n_removed = 0
+    for cache_file, size, last_used in entries:
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(cache_file)
+        except OSError:
+            pass  # Already removed by another process
+        total_size -= size
+        n_removed += 1
+
+    if os.path.isdir(cache_dir):
+        write_size(cache_dir, total_size)
+    return n_removed
+
+
+def stats(cache_dir=None):
+    """Computes statistics of the cache.
+
+    Returns
+    -------
+    cache_stats : dict
+        Number of entries, number of distinct audio files, total size in
+        bytes, and oldest and newest usage timestamps.
+    """
+    entries = get_entries(cache_dir)
+    audio_hashes = set(os.path.basename(entry[0]).split("_")[0]
+                       for entry in entries)
+    cache_stats = {}
+    cache_stats["n_entries"] = len(entries)
+    cache_stats["n_audio_files"] = len(audio_hashes)
+    cache_stats["size"] = sum(entry[1] for entry in entries)
+    cache_stats["oldest"] = entries[0][2] if entries else None
+    cache_stats["newest"] = entries[-1][2] if entries else None
+    return cache_stats
+
+
+def main():
+    """Main function to parse the arguments and call the cache commands."""
+    parser = argparse.ArgumentParser(description=
+        "Manages the MSAF features cache.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("command",
+                        action="store",
+                        choices=["stats", "prune"],
+                        help="Show statistics of the cache or prune it")
+    parser.add_argument("-d",
+                        action="store",
+                        dest="cache_dir",
+                        default=msaf.FeatureCache.cache_dir,
+                        help="Cache directory")
+    parser.add_argument("-s",
+                        action="store",
+                        dest="max_size",
+                        type=int,
+                        default=msaf.FeatureCache.max_size / 2 ** 20,
+                        help="Maximum size of the cache in MB (prune only)")
+    args = parser.parse_args()
+
+    # Setup the logger
+    logging.basicConfig(format='%(asctime)s: %(levelname)s: %(message)s',
+        level=logging.INFO)
+
+    if args.command == "prune":
+        n_removed = prune(args.cache_dir, args.max_size * 2 ** 20)
+        logging.info("Removed %d entries" % n_removed)
+
+    cache_stats = stats(args.cache_dir)
+    time_fmt = "%Y/%m/%d %H:%M:%S"
+    logging.info("Cache directory: %s" % args.cache_dir)
+    logging.info("Entries: %d (%d audio files)" %
+                 (cache_stats["n_entries"], cache_stats["n_audio_files"]))
+    logging.info("Size: %.2f MB" % (cache_stats["size"] / float(2 ** 20)))
+    if cache_stats["n_entries"] > 0:
+        logging.info("Least recently used: %s" % time.strftime(
+            time_fmt, time.localtime(cache_stats["oldest"])))
+        logging.info("Most recently used: %s" % time.strftime(
+            time_fmt, time.localtime(cache_stats["newest"])))
+
+if __name__ == '__main__':
+    main()
@@ -12,10 +12,15 @@ __email__ = "oriol@nyu.edu"
 import datetime
 import json
 import glob
+import hashlib
 import logging
 import numpy as np
 from threading import Thread
 import os
+import shutil
+import struct
+import tempfile
+import zipfile
 
 # Local stuff
 import msaf
@@ -34,6 +39,8 @@ class FileStruct:
                                                     msaf.Dataset.features_ext)
         self.ref_file = self._get_dataset_file(msaf.Dataset.references_dir,
                                                msaf.Dataset.references_ext)
+        self.ledger_file = self._get_dataset_file(msaf.Dataset.ledger_dir,
+                                                  msaf.Dataset.ledger_ext)
 
     def _get_dataset_file(self, dir, ext):
         """Gets the desired dataset file."""
@@ -45,9 +52,9 @@ class FileStruct:
     def __repr__(self):
         """Prints the file structure."""
         return "FileStruct(\n\tds_path=%s,\n\taudio_file=%s,\n\test_file=%s," \
-            "\n\tfeatures_file=%s,\n\tref_file=%s\n)" % (
+            "\n\tfeatures_file=%s,\n\tref_file=%s,\n\tledger_file=%s\n)" % (
                 self.ds_path, self.audio_file, self.est_file,
-                self.features_file, self.ref_file)
+                self.features_file, self.ref_file, self.ledger_file)
 
 
 def has_same_parameters(est_params, boundaries_id, labels_id, params):
@@ -245,6 +252,386 @@ def read_ref_bound_frames(audio_path, beats):
     return bound_frames
 
 
+def write_features(out_file, features):
+    """Writes the features into a binary (uncompressed npz) file.
+
+    Parameters
+    ----------
+    out_file : str
+        Path to the output features file.
+    features : dict
+        Dictionary containing the features, using the same key names as the
+        Essentia pools (e.g. "framesync.hpcp", "beats.times").
+        Feature matrices are stored as float32 arrays, and beats as float64
+        arrays. The "analysis" dictionary and the "timestamp" string are
+        stored as JSON strings.
+    """
+    arrays = {}
+    for key, value in features.items():
+        arrays[key] = _features_array(key, value)
+    with open(out_file, "wb") as f:
+        np.savez(f, **arrays)
+
+
+def _features_array(key, value):
+    """Converts a feature into the array stored in the features files (see
+    write_features)."""
+    if key in ["analysis", "timestamp"]:
+        return np.asarray(json.dumps(value))
+    elif key.startswith("beats."):
+        return np.asarray(value, dtype=np.float64)
+    return np.asarray(value, dtype=np.float32)
+
+
+# Size of the npy headers of the arrays of FeaturesWriter
+_NPY_HEADER_SIZE = 128
+
+
+def _write_npy_header(f, dtype, shape):
+    """Writes an npy (1.0) header of fixed size, so that it can be rewritten
+    in place once the final shape of the array is known."""
+    header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (
+        np.lib.format.dtype_to_descr(np.dtype(dtype)),
+        tuple(int(n) for n in shape))
+    header = header.ljust(_NPY_HEADER_SIZE - 11) + "\n"
+    f.write(np.lib.format.magic(1, 0))
+    f.write(struct.pack("<H", len(header)))
+    f.write(header)
+
+
+class FeaturesWriter:
+    """Writes a binary features file (see write_features) incrementally, so
+    that the feature matrices never need to be fully in memory: their rows
+    are appended to temporary npy files as they are computed, and these are
+    packed into the (uncompressed npz) features file when closing the
+    writer.
+
+    It can be used as a context manager, in which case the features file is
+    only written if no exception is raised.
+    """
+    def __init__(self, out_file):
+        """Inits the writer of the features file out_file."""
+        self.out_file = out_file
+        self.tmp_dir = tempfile.mkdtemp(
+            suffix=".tmp", dir=os.path.dirname(os.path.abspath(out_file)))
+        self.arrays = {}    # key -> [npy file, dtype, row shape, n_rows]
+        self.values = {}
+
+    def _get_tmp_file(self, key):
+        return os.path.join(self.tmp_dir, key + ".npy")
+
+    def append(self, key, rows):
+        """Appends the given rows (first axis) to the feature matrix key
+        (e.g. "framesync.hpcp")."""
+        if key in self.values:
+            raise ValueError("Feature %s has already been set" % key)
+        rows = _features_array(key, rows)
+        if key not in self.arrays:
+            f = open(self._get_tmp_file(key), "w+b")
+            _write_npy_header(f, rows.dtype, (0,) + rows.shape[1:])
+            self.arrays[key] = [f, rows.dtype, rows.shape[1:], 0]
+        f, dtype, row_shape, n_rows = self.arrays[key]
+        if rows.shape[1:] != row_shape:
+            raise ValueError("Rows of shape %s can't be appended to %s, "
+                             "whose rows have shape %s" %
+                             (rows.shape[1:], key, row_shape))
+        rows.tofile(f)
+        self.arrays[key][3] += rows.shape[0]
+
+    def __setitem__(self, key, value):
+        """Sets a feature that is written as a whole (e.g. "beats.times" or
+        "analysis")."""
+        if key in self.arrays:
+            raise ValueError("Feature %s has already been appended" % key)
+        self.values[key] = value
+
+    def get(self, key):
+        """Gets the rows appended so far to the feature matrix key,
+        memory-mapped (read-only)."""
+        f, dtype, row_shape, n_rows = self.arrays[key]
+        f.flush()
+        shape = (n_rows,) + row_shape
+        if np.prod(shape) == 0:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(self._get_tmp_file(key), dtype=dtype, mode="r",
+                         offset=_NPY_HEADER_SIZE, shape=shape)
+
+    def close(self):
+        """Writes the features file (replacing it atomically) and removes the
+        temporary files."""
+        try:
+            for key, (f, dtype, row_shape, n_rows) in self.arrays.items():
+                f.seek(0)
+                _write_npy_header(f, dtype, (n_rows,) + row_shape)
+                f.close()
+            for key, value in self.values.items():
+                np.save(self._get_tmp_file(key), _features_array(key, value))
+
+            tmp_file = os.path.join(self.tmp_dir, "features.npz.tmp")
+            zf = zipfile.ZipFile(tmp_file, "w", zipfile.ZIP_STORED,
+                                 allowZip64=True)
+            try:
+                for key in sorted(self.arrays.keys() + self.values.keys()):
+                    zf.write(self._get_tmp_file(key), key + ".npy")
+            finally:
+                zf.close()
+            os.rename(tmp_file, self.out_file)
+        finally:
+            self.discard()
+
+    def discard(self):
+        """Removes the temporary files, without writing the features
+        file."""
+        for f, dtype, row_shape, n_rows in self.arrays.values():
+            f.close()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+def read_json_features(features_file):
+    """Reads a (legacy) JSON features file computed with Essentia's
+    YamlOutput and returns its contents using the binary file key names.
+
+    Parameters
+    ----------
+    features_file : str
+        Path to the JSON features file.
+
+    Returns
+    -------
+    features : dict
+        Dictionary containing all the features of the file.
+    """
+    with open(features_file, "r") as f:
+        feats = json.load(f)
+
+    features = {}
+    features["beats.times"] = np.asarray(feats["beats"]["times"])[0]
+    features["beats.confidence"] = np.asarray(
+        feats["beats"]["confidence"]).flatten()
+    features["analysis"] = feats["analysis"]
+    if "timestamp" in feats:
+        features["timestamp"] = feats["timestamp"]
+    for block in msaf.feat_blocks:
+        if block not in feats:
+            continue
+        for feat_name in msaf.feat_names:
+            features["%s.%s" % (block, feat_name)] = \
+                np.asarray(feats[block][feat_name])
+    return features
+
+
+def mmap_features(features_file, key):
+    """Memory-maps a single array of a binary features file, so that only
+    the pages that are actually used are read from disk.
+
+    The map is copy-on-write: in-place operations on the returned array
+    never modify the file. Compressed members (and npy formats other than
+    1.0 and 2.0) can not be mapped, so they are simply loaded.
+
+    Parameters
+    ----------
+    features_file : str
+        Path to the binary features file.
+    key : str
+        Key of the array to map (e.g. "framesync.hpcp").
+
+    Returns
+    -------
+    X : np.memmap
+        The memory-mapped array.
+    """
+    zf = zipfile.ZipFile(features_file, "r")
+    try:
+        info = zf.getinfo(key + ".npy")
+        if info.compress_type != zipfile.ZIP_STORED:
+            return np.load(features_file)[key]
+    finally:
+        zf.close()
+
+    with open(features_file, "rb") as f:
+        # Skip the local header of the zip member
+        f.seek(info.header_offset)
+        local_header = struct.unpack(zipfile.structFileHeader,
+                                     f.read(zipfile.sizeFileHeader))
+        f.seek(info.header_offset + zipfile.sizeFileHeader +
+               local_header[zipfile._FH_FILENAME_LENGTH] +
+               local_header[zipfile._FH_EXTRA_FIELD_LENGTH])
+
+        # Read the npy header
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = \
+                np.lib.format.read_array_header_1_0(f)
+        elif version == (2, 0):
+            shape, fortran_order, dtype = \
+                np.lib.format.read_array_header_2_0(f)
+        else:
+            # Newer header versions are not mapped
+            return np.load(features_file)[key]
+        offset = f.tell()
+
+    order = "F" if fortran_order else "C"
+    if np.prod(shape) == 0:
+        return np.zeros(shape, dtype=dtype, order=order)
+    return np.memmap(features_file, dtype=dtype, mode="c", offset=offset,
+                     shape=shape, order=order)
+
+
+def read_features(features_file, keys=None, mmap=False):
+    """Reads only the given keys from a features file.
+
+    Binary files are read lazily, so only the arrays of the requested keys
+    are actually loaded. Legacy JSON files must be fully parsed.
+
+    Parameters
+    ----------
+    features_file : str
+        Path to the features file (npz or legacy JSON).
+    keys : list
+        List of keys to read (e.g. ["framesync.hpcp", "analysis"]), or None
+        to read all of them.
+    mmap : bool
+        Whether to memory-map the arrays instead of loading them (only
+        available for binary files).
+
+    Returns
+    -------
+    features : dict
+        Dictionary containing the requested features.
+    """
+    if features_file.endswith(".json"):
+        all_features = read_json_features(features_file)
+        if keys is None:
+            return all_features
+        return dict((key, all_features[key]) for key in keys)
+
+    features = {}
+    npz = np.load(features_file)
+    try:
+        if keys is None:
+            keys = npz.files
+        for key in keys:
+            if key in ["analysis", "timestamp"]:
+                features[key] = json.loads(str(npz[key]))
+            elif mmap:
+                features[key] = mmap_features(features_file, key)
+            else:
+                features[key] = npz[key]
+    finally:
+        npz.close()
+    return features
+
+
+def get_features_file(audio_path):
+    """Gets the path to the features file of the given audio file. If the
+    binary file does not exist but a legacy JSON file does, the latter is
+    returned."""
+    ds_path = os.path.dirname(os.path.dirname(audio_path))
+    features_path = os.path.join(ds_path, msaf.Dataset.features_dir,
+        os.path.basename(audio_path)[:-4] + msaf.Dataset.features_ext)
+    json_path = features_path[:-len(msaf.Dataset.features_ext)] + ".json"
+    if not os.path.isfile(features_path) and os.path.isfile(json_path):
+        logging.warning("Using legacy JSON features file %s. Run "
+                        "migrate_features.py to speed up reading." % json_path)
+        return json_path
+    return features_path
+
+
+class FeatureHandle:
+    def __init__(self, audio_path, annot_beats=False, framesync=False):
+        """Lazy access to the features of an audio file.
+
+        Only the analysis parameters and the beats are read when creating
+        the handle. Each feature matrix is memory-mapped the first time it
+        is requested (e.g. handle["hpcp"]), and the duration is read from
+        the stored analysis parameters.
+
+        Parameters
+        ----------
+        audio_path: str
+            Path to the audio file.
+        annot_beats: bool
+            Whether to use annotated beats or not.
+        framesync: bool
+            Whether to use framesync features or not.
+        """
+        self.audio_path = audio_path
+        self.features_file = get_features_file(audio_path)
+        self._features = {}
+        self._all_features = None
+        if self.features_file.endswith(".json"):
+            # Legacy files can only be parsed as a whole
+            self._all_features = read_json_features(self.features_file)
+
+        # Dataset path
+        ds_path = os.path.dirname(os.path.dirname(audio_path))
+
+        # Beat Synchronous Feats
+        if framesync:
+            self.feat_str = "framesync"
+            self.beats = None
+        else:
+            if annot_beats:
+                # Read references
+                try:
+                    annotation_path = os.path.join(
+                        ds_path, msaf.Dataset.references_dir,
+                        os.path.basename(audio_path)[:-4] +
+                        msaf.Dataset.references_ext)
+                    jam = jams2.load(annotation_path)
+                except:
+                    raise RuntimeError("No references found in file %s" %
+                                       annotation_path)
+
+                self.feat_str = "ann_beatsync"
+                beats = []
+                beat_data = jam.beats[0].data
+                if beat_data == []:
+                    raise ValueError
+                for data in beat_data:
+                    beats.append(data.time.value)
+                self.beats = np.unique(beats)
+            else:
+                self.feat_str = "est_beatsync"
+                self.beats = self._read("beats.times")
+
+        # Analysis parameters
+        self.analysis = self._read("analysis")
+
+        # Duration
+        if "dur" in self.analysis:
+            self.dur = self.analysis["dur"]
+        else:
+            # TODO: Essentia fix!
+            # Only the header of the framesync features is actually read
+            feat_frames = self._read("framesync.hpcp")
+            self.dur = feat_frames.shape[0] * self.analysis["hop_size"] / \
+                float(self.analysis["sample_rate"])
+
+    def _read(self, key):
+        """Reads (or memory-maps) the given key from the features file."""
+        if self._all_features is not None:
+            return self._all_features[key]
+        return read_features(self.features_file, [key], mmap=True)[key]
+
+    def __getitem__(self, feat_name):
+        """Gets the given feature matrix (e.g. "hpcp") of the current block,
+        memory-mapping it the first time it is requested."""
+        if feat_name not in self._features:
+            self._features[feat_name] = self._read(
+                "%s.%s" % (self.feat_str, feat_name))
+        return self._features[feat_name]
+
+
 def get_features(audio_path, annot_beats=False, framesync=False):
     """
     Gets the features of an audio file given the audio_path.
@@ -273,56 +660,13 @@ def get_features(audio_path, annot_beats=False, framesync=False):
     analysis : dict
         Parameters of analysis of track (e.g. sampling rate)
     """
-    # Dataset path
-    ds_path = os.path.dirname(os.path.dirname(audio_path))
+    feats = FeatureHandle(audio_path, annot_beats=annot_beats,
+                          framesync=framesync)
+    C = feats["hpcp"]
+    M = feats["mfcc"]
+    T = feats["tonnetz"]
 
-    # Read Estimations
-    features_path = os.path.join(ds_path, msaf.Dataset.features_dir,
-        os.path.basename(audio_path)[:-4] + msaf.Dataset.features_ext)
-    with open(features_path, "r") as f:
-        feats = json.load(f)
-
-    # Beat Synchronous Feats
-    if framesync:
-        feat_str = "framesync"
-        beats = None
-    else:
-        if annot_beats:
-            # Read references
-            try:
-                annotation_path = os.path.join(
-                    ds_path, msaf.Dataset.references_dir,
-                    os.path.basename(audio_path)[:-4] +
-                    msaf.Dataset.references_ext)
-                jam = jams2.load(annotation_path)
-            except:
-                raise RuntimeError("No references found in file %s" %
-                                   annotation_path)
-
-            feat_str = "ann_beatsync"
-            beats = []
-            beat_data = jam.beats[0].data
-            if beat_data == []:
-                raise ValueError
-            for data in beat_data:
-                beats.append(data.time.value)
-            beats = np.unique(beats)
-        else:
-            feat_str = "est_beatsync"
-            beats = np.asarray(feats["beats"]["times"])[0]
-    C = np.asarray(feats[feat_str]["hpcp"])
-    M = np.asarray(feats[feat_str]["mfcc"])
-    T = np.asarray(feats[feat_str]["tonnetz"])
-    analysis = feats["analysis"]
-
-    # Duration
-    # TODO: Essentia fix!
-    feat_frames = np.asarray(feats["framesync"]["hpcp"])
-    dur = feat_frames.shape[0] * analysis["hop_size"] / \
-        float(analysis["sample_rate"])
-    #dur = jam.metadata.duration
-
-    return C, M, T, beats, dur, analysis
+    return C, M, T, feats.beats, feats.dur, feats.analysis
 
 
 def safe_write(jam, out_file):
@@ -417,6 +761,49 @@ def save_estimations(out_file, boundaries, labels, boundaries_id, labels_id,
     my_thread.join()
 
 
+def get_config_hash(config):
+    """Gets the hash of the configuration parameters of the algorithms."""
+    return hashlib.sha1(json.dumps(config, sort_keys=True,
+                                   default=str)).hexdigest()
+
+
+def get_features_fingerprint(features_file):
+    """Gets the fingerprint of a features file, based on its analysis
+    parameters and the time when it was computed (None if it doesn't
+    exist)."""
+    if not os.path.isfile(features_file):
+        return None
+    features = read_features(features_file, ["analysis", "timestamp"])
+    return hashlib.sha1(json.dumps(features, sort_keys=True)).hexdigest()
+
+
+def get_ledger_key(boundaries_id, labels_id, config_hash,
+                   features_fingerprint):
+    """Gets the key of an estimation in the run ledger of a track."""
+    return "%s_%s_%s_%s" % (boundaries_id, labels_id, config_hash,
+                            features_fingerprint)
+
+
+def read_ledger(ledger_file):
+    """Reads the run ledger of a track, i.e. the dictionary of estimations
+    already computed (empty if it doesn't exist yet)."""
+    if not os.path.isfile(ledger_file):
+        return {}
+    with open(ledger_file, "r") as f:
+        return json.load(f)
+
+
+def update_ledger(ledger_file, key, entry):
+    """Adds an entry to the run ledger of a track. The file is replaced
+    atomically, so that it's never left half-written."""
+    ledger = read_ledger(ledger_file)
+    ledger[key] = entry
+    tmp_file = ledger_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(ledger, f, indent=2, sort_keys=True)
+    os.rename(tmp_file, ledger_file)
+
+
 def get_all_est_boundaries(est_file, annot_beats, algo_ids=None):
     """Gets all the estimated boundaries for all the algorithms.
 
@@ -594,6 +981,7 @@ def get_dataset_files(in_path, ds_name="*"):
     utils.ensure_dir(os.path.join(in_path, msaf.Dataset.features_dir))
     utils.ensure_dir(os.path.join(in_path, msaf.Dataset.estimations_dir))
     utils.ensure_dir(os.path.join(in_path, msaf.Dataset.references_dir))
+    utils.ensure_dir(os.path.join(in_path, msaf.Dataset.ledger_dir))
 
     # Get the file structs
     file_structs = []
@@ -0,0 +1,194 @@
+"""
+Signal processing kernels shared by the segmenters: filtering of feature
+matrices along time, adaptive thresholds, peak picking of novelty curves and
+Gaussian costs of candidate segmentations.
+
+All of them operate on whole arrays (no loops over frames or features), and
+only depend on numpy and scipy, so that they can also be used by the
+standalone scripts of the algorithms.
+"""
+
+__author__ = "Oriol Nieto"
+__copyright__ = "Copyright 2014, Music and Audio Research Lab (MARL)"
+__license__ = "GPL"
+__version__ = "1.0"
+__email__ = "oriol@nyu.edu"
+
+import numpy as np
+from scipy.ndimage import filters
+
+
+def median_filter(X, M=8, axis=0):
+    """Median filter of size M along the given axis of X.
+
+    Each row (axis=1) or column (axis=0) of X is filtered independently, as
+    in scipy.ndimage.filters.median_filter(X[:, i], size=M).
+
+    Parameters
+    ----------
+    X : np.array
+        Matrix to filter (e.g. features, with frames along axis 0).
+    M : int
+        Size of the median filter.
+    axis : int
+        Axis along which to filter.
+
+    Returns
+    -------
+    Y : np.array
+        Filtered copy of X (with the same dtype).
+    """
+    X = np.asarray(X)
+    if M <= 1:
+        return X.copy()
+    size = [1] * X.ndim
+    size[axis] = M
+    return filters.median_filter(X, size=size)
+
+
+def gaussian_filter(X, M=8, axis=0):
+    """Gaussian filter (with sigma M / 2) along the given axis of X.
+
+    Parameters
+    ----------
+    X : np.array
+        Matrix to filter.
+    M : int
+        Size of the gaussian filter (twice its standard deviation).
+    axis : int
+        Axis along which to filter.
+
+    Returns
+    -------
+    Y : np.array
+        Filtered copy of X.
+    """
+    return filters.gaussian_filter1d(X, sigma=M / 2., axis=axis)
+
+
+def adaptive_threshold(x, L=16, offset_coef=0.5):
+    """Adaptive threshold for a novelty curve: the median of x in a window
+    of L samples, plus an offset relative to the mean of x.
+
+    Parameters
+    ----------
+    x : np.array(N)
+        Novelty curve.
+    L : int
+        Size of the median filter.
+    offset_coef : float
+        The offset is offset_coef times the mean of x.
+
+    Returns
+    -------
+    th : np.array(N)
+        Threshold for each sample of x.
+    """
+    x = np.asarray(x)
+    return filters.median_filter(x, size=L) + x.mean() * float(offset_coef)
+
+
+def pick_peaks(x, th=None, flat_hills=False):
+    """Finds the peaks of a novelty curve that are above a threshold.
+
+    A peak is a sample strictly greater than both of its neighbors.
+    Optionally, flat hills (runs of equal samples above the threshold) are
+    also detected, and reported in their middle once the curve goes below
+    the threshold again.
+
+    Parameters
+    ----------
+    x : np.array(N)
+        Novelty curve.
+    th : np.array(N) or float
+        Threshold (e.g. from adaptive_threshold). None for no threshold.
+    flat_hills : boolean
+        Whether to report flat hills too.
+
+    Returns
+    -------
+    peaks : np.array
+        Sorted indices of the peaks.
+    """
+    x = np.asarray(x)
+    if th is None:
+        th = -np.inf
+    th = np.asarray(th)
+    if th.ndim > 0:
+        th = th[1:-1]
+
+    # Everything is relative to x[1:-1], the samples with two neighbors
+    mid = x[1:-1]
+    above = mid > th
+    is_peak = above & (x[:-2] < mid) & (mid > x[2:])
+    peaks = np.flatnonzero(is_peak) + 1
+    if not flat_hills:
+        return peaks
+
+    # The length of a hill is the number of samples above the threshold and
+    # equal to the previous one since the last peak or sample below the
+    # threshold, and it is reported when the curve goes below the threshold
+    is_flat = above & (x[:-2] == mid)
+    ends = np.flatnonzero(is_peak | ~above)
+    n_flat = np.cumsum(is_flat)[ends]
+    lengths = np.diff(np.concatenate(([0], n_flat)))
+    hills = (~above[ends]) & (lengths > 0)
+    hills = ends[hills] + 1 - lengths[hills] // 2
+    return np.sort(np.concatenate((peaks, hills)))
+
+
+def segment_moments(X):
+    """Cumulative sums of the frames of X and of their squares, to compute
+    the statistics of any segment of X in constant time (see
+    gaussian_segment_costs).
+
+    Parameters
+    ----------
+    X : np.array(d, N)
+        Feature matrix, with N frames of d features.
+
+    Returns
+    -------
+    moments : tuple(np.array(d, N + 1), np.array(N + 1))
+        Cumulative sums of the (centered) frames and of their squared
+        norms, starting with 0.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    # Centering reduces the cancellation in the variances of long tracks
+    X = X - X.mean(axis=1)[:, np.newaxis]
+    S1 = np.zeros((X.shape[0], X.shape[1] + 1))
+    np.cumsum(X, axis=1, out=S1[:, 1:])
+    S2 = np.concatenate(([0], np.cumsum(np.sum(X ** 2, axis=0))))
+    return S1, S2
+
+
+def gaussian_segment_costs(moments, boundaries):
+    """Log-likelihood of each segment of a segmentation under a Gaussian
+    with the variances of the segment, as the gaussian_cost of OLDA
+    (0 for segments shorter than 2 frames).
+
+    Parameters
+    ----------
+    moments : tuple
+        Cumulative sums of the features, as returned by segment_moments.
+    boundaries : np.array(k + 1)
+        Frame indices of the boundaries, including the first and last ones.
+
+    Returns
+    -------
+    costs : np.array(k)
+        Log-likelihood of each segment.
+    """
+    S1, S2 = moments
+    boundaries = np.asarray(boundaries, dtype=int)
+    d = S1.shape[0]
+    starts, ends = boundaries[:-1], boundaries[1:]
+    n = (ends - starts).astype(np.float64)
+    valid = n >= 2
+    n_valid = np.where(valid, n, 1)
+
+    # (n - 1) times the sum of the unbiased variances of the features
+    sums = S1[:, ends] - S1[:, starts]
+    scatter = S2[ends] - S2[starts] - np.sum(sums ** 2, axis=0) / n_valid
+    costs = -0.5 * d * n * np.log(2. * np.pi) - 0.5 * scatter
+    return np.where(valid, costs, 0)
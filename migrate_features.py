@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""
+This script migrates the (legacy) JSON features files of an MSAF dataset to
+the binary features files, so that they can be read much faster by the
+segmenters.
+"""
+
+__author__ = "Oriol Nieto"
+__copyright__ = "Copyright 2014, Music and Audio Research Lab (MARL)"
+__license__ = "GPL"
+__version__ = "1.0"
+__email__ = "oriol@nyu.edu"
+
+import argparse
+import glob
+from joblib import Parallel, delayed
+import logging
+import os
+import time
+
+# Local stuff
+import msaf
+from msaf import input_output as io
+
+
+def migrate_features_file(json_file, overwrite=False, remove=False):
+    """Converts the given JSON features file into a binary one placed in
+    the same folder."""
+    out_file = json_file[:-len(".json")] + msaf.Dataset.features_ext
+
+    if os.path.isfile(out_file) and not overwrite:
+        return  # Do nothing, file already exist and we are not overwriting it
+
+    logging.info("Migrating %s" % os.path.basename(json_file))
+    features = io.read_json_features(json_file)
+    io.write_features(out_file, features)
+
+    if remove:
+        os.remove(json_file)
+
+
+def process(in_path, overwrite=False, remove=False, n_jobs=1):
+    """Main process."""
+
+    # If in_path it's a file, we only migrate one file
+    if os.path.isfile(in_path):
+        migrate_features_file(in_path, overwrite, remove)
+
+    elif os.path.isdir(in_path):
+        # Get files
+        json_files = glob.glob(os.path.join(in_path, msaf.Dataset.features_dir,
+                                            "*.json"))
+
+        # Migrate features using joblib
+        Parallel(n_jobs=n_jobs)(delayed(migrate_features_file)(
+            json_file, overwrite, remove) for json_file in json_files)
+
+
+def main():
+    """Main function to parse the arguments and call the main process."""
+    parser = argparse.ArgumentParser(description=
+        "Migrates the JSON features files of the Segmentation dataset or a "
+        "given JSON features file to the binary features format",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("in_path",
+                        action="store",
+                        help="Input dataset dir or JSON features file")
+    parser.add_argument("-j",
+                        action="store",
+                        dest="n_jobs",
+                        type=int,
+                        help="Number of jobs (threads)",
+                        default=4)
+    parser.add_argument("-ow",
+                        action="store_true",
+                        dest="overwrite",
+                        help="Overwrite the previously migrated features",
+                        default=False)
+    parser.add_argument("-rm",
+                        action="store_true",
+                        dest="remove",
+                        help="Remove the JSON files once migrated",
+                        default=False)
+    args = parser.parse_args()
+    start_time = time.time()
+
+    # Setup the logger
+    logging.basicConfig(format='%(asctime)s: %(levelname)s: %(message)s',
+        level=logging.INFO)
+
+    # Run the migration
+    process(args.in_path, overwrite=args.overwrite, remove=args.remove,
+            n_jobs=args.n_jobs)
+
+    # Done!
+    logging.info("Done! Took %.2f seconds." % (time.time() - start_time))
+
+if __name__ == '__main__':
+    main()
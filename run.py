@@ -11,13 +11,14 @@ __version__ = "1.0"
 __email__ = "oriol@nyu.edu"
 
 import argparse
+import datetime
+import itertools
 import time
 import logging
+import multiprocessing
 import os
 import numpy as np
 
-from joblib import Parallel, delayed
-
 import msaf
 from msaf import jams2
 from msaf import input_output as io
@@ -79,6 +80,29 @@ def run_algorithms(audio_file, boundaries_id, labels_id, config):
     return est_times, est_labels
 
 
+def get_run_key(file_struct, boundaries_id, labels_id, config):
+    """Gets the key of the estimation of the given track in its run ledger,
+    which depends on the algorithms, their configuration and the features."""
+    return io.get_ledger_key(
+        boundaries_id, labels_id, io.get_config_hash(config),
+        io.get_features_fingerprint(file_struct.features_file))
+
+
+def is_computed(file_struct, boundaries_id, labels_id, config):
+    """Checks whether the estimation of the given track has already been
+    computed in a previous run."""
+    if not os.path.isfile(file_struct.est_file) or \
+            not os.path.isfile(file_struct.features_file):
+        return False
+    return get_run_key(file_struct, boundaries_id, labels_id, config) in \
+        io.read_ledger(file_struct.ledger_file)
+
+
+def format_time(secs):
+    """Formats the given number of seconds as H:MM:SS."""
+    return str(datetime.timedelta(seconds=int(secs)))
+
+
 def process_track(file_struct, boundaries_id, labels_id, config):
     # Only analize files with annotated beats
     if config["annot_beats"]:
@@ -106,12 +130,29 @@ def process_track(file_struct, boundaries_id, labels_id, config):
     io.save_estimations(file_struct.est_file, est_inters, est_labels,
                         boundaries_id, labels_id, **config)
 
+    # Record it in the run ledger
+    entry = {
+        "track": os.path.basename(file_struct.audio_file),
+        "boundaries_id": boundaries_id,
+        "labels_id": labels_id,
+        "timestamp": datetime.datetime.today().strftime("%Y/%m/%d %H:%M:%S")
+    }
+    io.update_ledger(file_struct.ledger_file,
+                     get_run_key(file_struct, boundaries_id, labels_id, config),
+                     entry)
+
     return est_times, est_labels
 
 
+def _process_track_star(args):
+    """Calls process_track with the given (index, arguments), returning the
+    index of the track too (to be used with imap_unordered)."""
+    return args[0], process_track(*args[1:])
+
+
 def process(in_path, annot_beats=False, feature="mfcc", ds_name="*",
             framesync=False, boundaries_id="gt", labels_id=None,
-            out_audio=False, plot=False, n_jobs=4, config=None):
+            out_audio=False, plot=False, n_jobs=4, config=None, force=False):
     """Main process to segment a file or a collection of files.
 
     Parameters
@@ -143,6 +184,9 @@ def process(in_path, annot_beats=False, feature="mfcc", ds_name="*",
     config: dict
         Dictionary containing custom configuration parameters for the
         algorithms.  If None, the default parameters are used.
+    force: bool
+        Whether to recompute the estimations already computed in previous
+        runs (only in collection mode).
 
     Returns
     -------
@@ -188,10 +232,44 @@ def process(in_path, annot_beats=False, feature="mfcc", ds_name="*",
         # Collection mode
         file_structs = io.get_dataset_files(in_path, ds_name)
 
+        # Skip the tracks already computed in previous runs
+        results = [None] * len(file_structs)
+        pending = []
+        for i, file_struct in enumerate(file_structs):
+            if not force and is_computed(file_struct, boundaries_id,
+                                         labels_id, config):
+                est_inters, est_labels = io.read_estimations(
+                    file_struct.est_file, boundaries_id, labels_id, **config)
+                results[i] = (utils.intervals_to_times(est_inters),
+                              est_labels)
+            else:
+                pending.append(i)
+        logging.info("%d tracks already computed, %d tracks to go" %
+                     (len(file_structs) - len(pending), len(pending)))
+
         # Call in parallel
-        return Parallel(n_jobs=n_jobs)(delayed(process_track)(
-            file_struct, boundaries_id, labels_id, config)
-            for file_struct in file_structs[:])
+        args = [(i, file_structs[i], boundaries_id, labels_id, config)
+                for i in pending]
+        pool = None
+        if n_jobs > 1:
+            pool = multiprocessing.Pool(n_jobs)
+            tracks = pool.imap_unordered(_process_track_star, args)
+        else:
+            tracks = itertools.imap(_process_track_star, args)
+
+        # Report progress as the tracks are done
+        start_time = time.time()
+        for n_done, (i, result) in enumerate(tracks, 1):
+            results[i] = result
+            elapsed = time.time() - start_time
+            logging.info("Progress: %d/%d tracks, elapsed: %s, ETA: %s" % (
+                n_done, len(pending), format_time(elapsed),
+                format_time(elapsed / n_done * (len(pending) - n_done))))
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        return results
 
 
 def main():
@@ -255,6 +333,12 @@ def main():
                         default="*",
                         help="The prefix of the dataset to use "
                         "(e.g. Isophonics, SALAMI)")
+    parser.add_argument("--force",
+                        action="store_true",
+                        dest="force",
+                        help="Recompute the estimations already computed in "
+                        "previous runs",
+                        default=False)
     args = parser.parse_args()
     start_time = time.time()
 
@@ -266,7 +350,8 @@ def main():
     process(args.in_path, annot_beats=args.annot_beats, feature=args.feature,
             ds_name=args.ds_name, framesync=args.framesync,
             boundaries_id=args.boundaries_id, labels_id=args.labels_id,
-            n_jobs=args.n_jobs, out_audio=args.out_audio, plot=args.plot)
+            n_jobs=args.n_jobs, out_audio=args.out_audio, plot=args.plot,
+            force=args.force)
 
     # Done!
     logging.info("Done! Took %.2f seconds." % (time.time() - start_time))
@@ -0,0 +1,141 @@
+"""
+Cache of the pairwise distances between the frames of the features, from
+which the segmenters derive their self-similarity and recurrence matrices,
+so that they are not recomputed when running several algorithms (or several
+configurations of an algorithm) on the same track.
+
+The cache is disabled by default (see msaf.SSMCache.enabled). When enabled,
+the distances are kept in memory (the most recently used, up to
+msaf.SSMCache.max_size bytes), and optionally on disk (if
+msaf.SSMCache.cache_dir is set). They are returned read-only, so that callers
+that modify them must copy them first. They are keyed by the content of the
+features plus the parameters that describe them (feature, synchronization,
+preprocessing) and the metric, so the parameters of each segmenter (kernel
+sizes, number of neighbors...) never take part in the key.
+"""
+
+__author__ = "Oriol Nieto"
+__copyright__ = "Copyright 2014, Music and Audio Research Lab (MARL)"
+__license__ = "GPL"
+__version__ = "1.0"
+__email__ = "oriol@nyu.edu"
+
+import collections
+import hashlib
+import json
+import logging
+import numpy as np
+import os
+from scipy.spatial import distance
+import tempfile
+
+# Local stuff
+import msaf
+from msaf import utils
+
+# Most recently used distances
+_memory = collections.OrderedDict()
+
+
+def get_key(X, params):
+    """Gets the cache key of the distances between the rows of X with the
+    given parameters."""
+    X = np.ascontiguousarray(X)
+    sha1 = hashlib.sha1(json.dumps(params, sort_keys=True, default=str))
+    sha1.update(str(X.shape) + str(X.dtype))
+    sha1.update(X.data)
+    return sha1.hexdigest()
+
+
+def compute_distances(X, metric):
+    """Computes the distances between the rows of X, in the condensed form
+    of scipy.spatial.distance.pdist."""
+    return distance.pdist(X, metric=metric)
+
+
+def _read(key):
+    """Reads distances from memory or disk (None if they're not cached)."""
+    if key in _memory:
+        D = _memory.pop(key)
+        _memory[key] = D
+        return D
+    if msaf.SSMCache.cache_dir is not None:
+        cache_file = os.path.join(msaf.SSMCache.cache_dir, key + ".npy")
+        if os.path.isfile(cache_file):
+            try:
+                D = np.load(cache_file)
+            except Exception as e:
+                logging.warning("Corrupt cache entry %s (%s)" %
+                                (cache_file, e))
+                return None
+            D.flags.writeable = False
+            _store(key, D, disk=False)
+            return D
+    return None
+
+
+def _store(key, D, disk=True):
+    """Stores distances in memory and, if enabled, on disk."""
+    _memory[key] = D
+    size = sum(D_mem.nbytes for D_mem in _memory.values())
+    while size > msaf.SSMCache.max_size:
+        size -= _memory.popitem(last=False)[1].nbytes
+    if disk and msaf.SSMCache.cache_dir is not None:
+        utils.ensure_dir(msaf.SSMCache.cache_dir)
+        fd, tmp_file = tempfile.mkstemp(suffix=".tmp",
+                                        dir=msaf.SSMCache.cache_dir)
+        os.close(fd)
+        try:
+            with open(tmp_file, "wb") as f:
+                np.save(f, D)
+            os.rename(tmp_file, os.path.join(msaf.SSMCache.cache_dir,
+                                             key + ".npy"))
+        finally:
+            if os.path.isfile(tmp_file):
+                os.remove(tmp_file)
+
+
+def find_distances(X, metric, **params):
+    """Gets the distances between the rows of X from the cache, without
+    computing them (None if they are not cached, or the cache is
+    disabled). See get_distances."""
+    if not msaf.SSMCache.enabled:
+        return None
+    return _read(get_key(X, dict(params, metric=metric)))
+
+
+def get_distances(X, metric, **params):
+    """Gets the distances between the rows of X from the cache, computing
+    them if needed.
+
+    Parameters
+    ----------
+    X : np.array((N, F))
+        Input matrix, one frame per row (e.g. the preprocessed features).
+    metric : str
+        Distance metric (see scipy.spatial.distance.pdist).
+    params : dict
+        Parameters that describe X (i.e. feature, synchronization and
+        preprocessing). Distances of the same X with different parameters
+        are cached separately.
+
+    Returns
+    -------
+    D : np.array(N * (N - 1) / 2)
+        Condensed distances (see scipy.spatial.distance.squareform),
+        read-only if the cache is enabled.
+    """
+    if not msaf.SSMCache.enabled:
+        return compute_distances(X, metric)
+    key = get_key(X, dict(params, metric=metric))
+    D = _read(key)
+    if D is None:
+        D = compute_distances(X, metric)
+        D.flags.writeable = False
+        _store(key, D)
+    return D
+
+
+def clear():
+    """Removes all the distances kept in memory."""
+    _memory.clear()
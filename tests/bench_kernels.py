@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark of the signal kernels (filtering and peak picking) used by
+the segmenters: for each algorithm, it times the steps it delegates to the
+kernels module against the original (loop-based) implementations, on random
+features and novelty curves.
+
+Usage:
+    ./bench_kernels.py [-n 5000] [-f 12] [-r 20]
+"""
+
+import argparse
+import timeit
+import numpy as np
+from scipy.ndimage import filters
+
+import msaf.kernels as K
+
+
+# Original (loop-based) implementations
+def median_filter_loop(X, M=8):
+    for i in xrange(X.shape[1]):
+        X[:, i] = filters.median_filter(X[:, i], size=M)
+    return X
+
+
+def pick_peaks_loop(nc, th):
+    peaks = []
+    for i in xrange(1, nc.shape[0] - 1):
+        if nc[i - 1] < nc[i] and nc[i] > nc[i + 1]:
+            if nc[i] > th[i]:
+                peaks.append(i)
+    return peaks
+
+
+def pick_peaks_hills_loop(nc, th):
+    peaks = []
+    k_hill = 0
+    hill = False
+    for i in xrange(1, nc.shape[0] - 1):
+        if nc[i] > th[i]:
+            if nc[i - 1] < nc[i] and nc[i] > nc[i + 1]:
+                k_hill = 0
+                hill = False
+                peaks.append(i)
+            if nc[i - 1] == nc[i]:
+                hill = True
+                k_hill += 1
+        elif hill:
+            peaks.append(i - k_hill / 2)
+            k_hill = 0
+            hill = False
+    return peaks
+
+
+def get_steps(F, nc, act):
+    """Returns, for each algorithm, the (old, new) functions that perform
+    the filtering and peak picking steps, with the default parameters of the
+    algorithm."""
+    def foote_old():
+        median_filter_loop(F.copy(), 1)
+        x = filters.gaussian_filter1d(nc, sigma=2)
+        pick_peaks_loop(x, np.zeros(len(x)))
+
+    def foote_new():
+        K.median_filter(F, 1)
+        x = K.gaussian_filter(nc, M=4)
+        K.pick_peaks(x, np.zeros(len(x)))
+
+    def sf_old():
+        th = filters.median_filter(nc, size=24) + nc.mean() * 0.04
+        pick_peaks_loop(nc, th)
+
+    def sf_new():
+        K.pick_peaks(nc, K.adaptive_threshold(nc, L=24, offset_coef=0.04))
+
+    def cnmf_old():
+        median_filter_loop(F.copy(), 13)
+        th = filters.median_filter(nc, size=15) + nc.mean() / 2.
+        pick_peaks_hills_loop(nc, th)
+
+    def cnmf_new():
+        K.median_filter(F, 13)
+        th = K.adaptive_threshold(nc, L=15, offset_coef=0.5)
+        K.pick_peaks(nc, th, flat_hills=True)
+
+    def cnmf3_old():
+        median_filter_loop(F.copy(), 8)
+        median_filter_loop(act[:, np.newaxis].copy(), 15)
+
+    def cnmf3_new():
+        K.median_filter(F, 8)
+        K.median_filter(act[:, np.newaxis], 15)
+
+    # kmeans shares its steps with cnmf, and cnmf2 with cnmf3
+    return [("foote", foote_old, foote_new),
+            ("sf", sf_old, sf_new),
+            ("cnmf", cnmf_old, cnmf_new),
+            ("kmeans", cnmf_old, cnmf_new),
+            ("cnmf2", cnmf3_old, cnmf3_new),
+            ("cnmf3", cnmf3_old, cnmf3_new)]
+
+
+def main():
+    """Main function to run the benchmark."""
+    parser = argparse.ArgumentParser(description=
+        "Benchmarks the signal kernels used by the segmenters.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-n", action="store", dest="n_frames", type=int,
+                        default=5000, help="Number of frames")
+    parser.add_argument("-f", action="store", dest="n_features", type=int,
+                        default=12, help="Number of features per frame")
+    parser.add_argument("-r", action="store", dest="repeat", type=int,
+                        default=20, help="Number of runs per measure")
+    args = parser.parse_args()
+
+    np.random.seed(123)
+    F = np.random.random((args.n_frames, args.n_features))
+    nc = np.round(np.random.random(args.n_frames) * 8) / 8.
+    act = np.random.randint(1, 4, args.n_frames).astype(float)
+
+    print "%-8s %12s %12s %8s" % ("algo", "old (ms)", "new (ms)", "speedup")
+    for algo_id, old, new in get_steps(F, nc, act):
+        t_old = min(timeit.repeat(old, number=args.repeat, repeat=3)) / \
+            args.repeat
+        t_new = min(timeit.repeat(new, number=args.repeat, repeat=3)) / \
+            args.repeat
+        print "%-8s %12.3f %12.3f %7.1fx" % (algo_id, t_old * 1e3,
+                                             t_new * 1e3, t_old / t_new)
+
+
+if __name__ == '__main__':
+    main()
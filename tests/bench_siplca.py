@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark of the SI-PLCA E-step: times plca.SIPLCA.do_estep against
+the original implementation (one shifted copy of H per shift) for several
+lengths of the bases (win) and ranks, on random data.
+
+Usage:
+    ./bench_siplca.py [-n 2000] [-w 10 30 60 120] [-k 2 4 8]
+"""
+
+import argparse
+import timeit
+import numpy as np
+
+from msaf.algorithms.siplca import plca
+
+# Reference implementation shared with the unit tests
+from test_siplca import estep_loop
+
+
+def main():
+    """Main function to run the benchmark."""
+    parser = argparse.ArgumentParser(description=
+        "Benchmarks the E-step of SI-PLCA.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-n", action="store", dest="n_frames", type=int,
+                        default=2000, help="Number of frames")
+    parser.add_argument("-f", action="store", dest="n_features", type=int,
+                        default=12, help="Number of features per frame")
+    parser.add_argument("-w", action="store", dest="wins", type=int,
+                        nargs="+", default=[10, 30, 60, 120],
+                        help="Lengths of the bases")
+    parser.add_argument("-k", action="store", dest="ranks", type=int,
+                        nargs="+", default=[2, 4, 8], help="Ranks")
+    parser.add_argument("-r", action="store", dest="repeat", type=int,
+                        default=5, help="Number of runs per measure")
+    args = parser.parse_args()
+
+    np.random.seed(123)
+    F, T = args.n_features, args.n_frames
+    V = plca.normalize(np.random.rand(F, T))
+
+    print "%5s %5s %12s %12s %8s" % ("win", "rank", "old (ms)", "new (ms)",
+                                     "speedup")
+    for win in args.wins:
+        for rank in args.ranks:
+            W = plca.normalize(np.random.rand(F, rank, win), [0, 2])
+            Z = plca.normalize(np.random.rand(rank))
+            H = plca.normalize(np.random.rand(rank, T), 1)
+            model = plca.SIPLCA(V, rank, win=win)
+            t_old = min(timeit.repeat(lambda: estep_loop(V, W, Z, H),
+                                      number=args.repeat, repeat=3))
+            t_new = min(timeit.repeat(lambda: model.do_estep(W, Z, H),
+                                      number=args.repeat, repeat=3))
+            print "%5d %5d %12.3f %12.3f %7.1fx" % (
+                win, rank, t_old * 1e3 / args.repeat,
+                t_new * 1e3 / args.repeat, t_old / t_new)
+
+
+if __name__ == '__main__':
+    main()
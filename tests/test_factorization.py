@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+Unit tests for the MSAF C-NMF implementation.
+"""
+
+import unittest
+import numpy as np
+
+import msaf.factorization as NMF
+
+
+def cnmf_pymf(X, W, G, niter):
+    """Multiplicative updates as implemented in pymf.CNMF, used as
+    reference."""
+    XtX = np.dot(X.T, X)
+    XtX_pos = (np.abs(XtX) + XtX) / 2.0
+    XtX_neg = (np.abs(XtX) - XtX) / 2.0
+    W = W.copy()
+    G = G.copy()
+    for i in xrange(niter):
+        XtX_neg_x_W = np.dot(XtX_neg, W)
+        XtX_pos_x_W = np.dot(XtX_pos, W)
+        G_x_WT = np.dot(G.T, W.T)
+        ha = XtX_pos_x_W + np.dot(G_x_WT, XtX_neg_x_W)
+        haa = XtX_neg_x_W + np.dot(G_x_WT, XtX_pos_x_W) + 10 ** -9
+        G = (G.T * np.sqrt(ha / haa)).T
+        GT_x_G = np.dot(G, G.T)
+        wa = np.dot(XtX_pos, G.T) + np.dot(XtX_neg_x_W, GT_x_G)
+        wb = np.dot(XtX_neg, G.T) + np.dot(XtX_pos_x_W, GT_x_G) + 10 ** -9
+        W *= np.sqrt(wa / wb)
+    return np.dot(X, W), G, W
+
+
+def reconstruction_error(X, F, G):
+    return np.sum((X - np.dot(F, G)) ** 2)
+
+
+class TestFactorization(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(123)
+        self.X = np.random.random((12, 150)) - 0.2
+
+    def test_cnmf(self):
+        W0, G0 = NMF.init_cnmf(self.X, 3)
+        F, G, W = NMF.cnmf(self.X, 3, niter=50, tol=0, W=W0, G=G0)
+        F_ref, G_ref, W_ref = cnmf_pymf(self.X, W0, G0, niter=50)
+        self.assertTrue(np.allclose(F, F_ref))
+        self.assertTrue(np.allclose(G, G_ref))
+        self.assertTrue(np.allclose(W, W_ref))
+        self.assertTrue(np.allclose(F, np.dot(self.X, W)))
+
+    def test_tolerance(self):
+        W0, G0 = NMF.init_cnmf(self.X, 3)
+        gram = NMF.compute_gram(self.X)
+        F, G, W = NMF.cnmf(self.X, 3, niter=300, tol=0, gram=gram,
+                           W=W0, G=G0)
+        F_tol, G_tol, W_tol = NMF.cnmf(self.X, 3, niter=300, tol=1e-4,
+                                       gram=gram, W=W0, G=G0)
+        error = reconstruction_error(self.X, F, G)
+        error_tol = reconstruction_error(self.X, F_tol, G_tol)
+        self.assertTrue(error_tol >= error)
+        self.assertTrue(error_tol <= error * 1.05)
+
+    def test_add_component(self):
+        F, G, W = NMF.cnmf(self.X, 3, niter=100)
+        W1, G1 = NMF.add_component(self.X, W, G)
+        self.assertEqual(W1.shape, (150, 4))
+        self.assertEqual(G1.shape, (4, 150))
+        self.assertTrue(np.array_equal(W1[:, :3], W))
+        self.assertTrue(np.array_equal(G1[:3], G))
+
+        # The warm start does not increase the error of the previous rank
+        F1, G1, W1 = NMF.cnmf(self.X, 4, niter=100, W=W1, G=G1)
+        self.assertTrue(reconstruction_error(self.X, F1, G1) <=
+                        reconstruction_error(self.X, F, G))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+"""
+Unit tests for the feature extraction.
+"""
+
+import os
+import resource
+import shutil
+import tempfile
+import time
+import unittest
+import wave
+import numpy as np
+
+import essentia.standard as ES
+import msaf
+from msaf import featextract as FE
+from msaf import input_output as io
+
+
+def address_space():
+    """Current size of the address space of the process (in bytes)."""
+    with open("/proc/self/statm", "r") as f:
+        return int(f.read().split()[0]) * resource.getpagesize()
+
+
+def dummy_compute(file_struct, audio_beats, overwrite):
+    """Fake feature extraction, which hangs or allocates too much memory
+    depending on the name of the track."""
+    name = os.path.basename(file_struct.audio_file)
+    with open(os.path.join(file_struct.ds_path, "order.txt"), "a") as f:
+        f.write(name + "\n")
+    if name.startswith("hang"):
+        time.sleep(60)
+    elif name.startswith("hog"):
+        np.ones(2 ** 30)    # 8 GB
+    open(file_struct.features_file, "w").close()
+
+
+def write_wav(audio_file, audio, sample_rate):
+    """Writes the audio (one column per channel) as a 16 bit wav file."""
+    audio = np.asarray(audio).reshape(len(audio), -1)
+    wav = wave.open(audio_file, "wb")
+    wav.setnchannels(audio.shape[1])
+    wav.setsampwidth(2)
+    wav.setframerate(sample_rate)
+    wav.writeframes((np.clip(audio, -1, 1) * 32767).astype("<i2").tostring())
+    wav.close()
+
+
+def synth_track(dur, sample_rate, bpm=120.):
+    """Synthesizes a track with clicks on the beats and a chord that changes
+    every four beats."""
+    t = np.arange(int(dur * sample_rate)) / float(sample_rate)
+    period = 60. / bpm
+    audio = 0.5 * np.exp(-50 * (t % period)) * np.sin(2 * np.pi * 2000 * t)
+    chords = [[261.6, 329.6, 392.0], [220.0, 261.6, 329.6],
+              [174.6, 220.0, 261.6], [196.0, 246.9, 293.7]]
+    chord_idxs = (t // (4 * period)).astype(int) % len(chords)
+    for i, chord in enumerate(chords):
+        for freq in chord:
+            audio += 0.1 * (chord_idxs == i) * np.sin(2 * np.pi * freq * t)
+    return audio + 0.01 * np.random.randn(len(t))
+
+
+class TestScheduleFeatures(unittest.TestCase):
+
+    def setUp(self):
+        self.ds_path = tempfile.mkdtemp()
+        for dir in [msaf.Dataset.audio_dir, msaf.Dataset.features_dir]:
+            os.mkdir(os.path.join(self.ds_path, dir))
+        self.durations = {"good1.wav": 20, "good2.wav": 10, "hang.wav": 30,
+                          "hog.wav": 40}
+        self.file_structs = []
+        for name in sorted(self.durations.keys()):
+            audio_file = os.path.join(self.ds_path, msaf.Dataset.audio_dir,
+                                      name)
+            open(audio_file, "w").close()
+            self.file_structs.append(io.FileStruct(audio_file))
+        self.manifest_file = os.path.join(self.ds_path, "manifest.json")
+
+        self.get_duration = FE.get_duration
+        FE.get_duration = lambda audio_file: \
+            self.durations[os.path.basename(audio_file)]
+
+    def tearDown(self):
+        FE.get_duration = self.get_duration
+        shutil.rmtree(self.ds_path)
+
+    def schedule(self, n_jobs):
+        return FE.schedule_features(
+            self.file_structs, self.manifest_file, n_jobs=n_jobs, timeout=2,
+            max_memory=address_space() + 2 ** 29, poll_time=0.01,
+            compute=dummy_compute)
+
+    def read_order(self):
+        with open(os.path.join(self.ds_path, "order.txt"), "r") as f:
+            return f.read().split()
+
+    def test_schedule(self):
+        start = time.time()
+        manifest = self.schedule(n_jobs=1)
+        self.assertTrue(time.time() - start < 30)
+
+        # Longest first
+        self.assertEqual(self.read_order(),
+                         ["hog.wav", "hang.wav", "good1.wav", "good2.wav"])
+
+        self.assertEqual(manifest, FE.read_manifest(self.manifest_file))
+        self.assertEqual(manifest["good1.wav"]["status"], "done")
+        self.assertEqual(manifest["good2.wav"]["status"], "done")
+        self.assertEqual(manifest["hang.wav"]["status"], "failed")
+        self.assertTrue("Timeout" in manifest["hang.wav"]["error"])
+        self.assertEqual(manifest["hog.wav"]["status"], "failed")
+        self.assertTrue("MemoryError" in manifest["hog.wav"]["error"])
+        for name, entry in manifest.iteritems():
+            self.assertEqual(entry["duration"], self.durations[name])
+            self.assertEqual(entry["analysis"], FE.get_analysis_params())
+
+        # Resumed runs skip the done and failed tracks
+        self.schedule(n_jobs=1)
+        self.assertEqual(len(self.read_order()), 4)
+
+    def test_schedule_parallel(self):
+        manifest = self.schedule(n_jobs=3)
+        self.assertEqual(sorted(self.read_order()), sorted(self.durations))
+        self.assertEqual(sorted(name for name, entry in manifest.iteritems()
+                                if entry["status"] == "done"),
+                         ["good1.wav", "good2.wav"])
+        for file_struct in self.file_structs[:2]:
+            self.assertTrue(os.path.isfile(file_struct.features_file))
+
+
+class TestBlocks(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(123)
+        self.ds_path = tempfile.mkdtemp()
+        for dir in [msaf.Dataset.audio_dir, msaf.Dataset.features_dir]:
+            os.mkdir(os.path.join(self.ds_path, dir))
+        self.sr = msaf.Anal.sample_rate
+        self.audio_file = os.path.join(self.ds_path, msaf.Dataset.audio_dir,
+                                       "track.wav")
+        write_wav(self.audio_file, synth_track(30, self.sr), self.sr)
+        self.file_struct = io.FileStruct(self.audio_file)
+
+        # Small blocks, so that there are many of them
+        self.block_params = (FE.BLOCK_SIZE, FE.BLOCK_FRAMES)
+        FE.BLOCK_SIZE = 5000
+        FE.BLOCK_FRAMES = 16
+
+    def tearDown(self):
+        FE.BLOCK_SIZE, FE.BLOCK_FRAMES = self.block_params
+        shutil.rmtree(self.ds_path)
+
+    def test_read_audio_blocks(self):
+        audio = FE.read_audio(self.audio_file, self.sr)
+        blocks = list(FE.read_audio_blocks(self.audio_file, self.sr))
+        self.assertTrue(all(len(block) <= FE.BLOCK_SIZE for block in blocks))
+        self.assertTrue(np.allclose(np.concatenate(blocks), audio,
+                                    atol=1e-4))
+
+        # Decoded by Essentia (resampled and downmixed)
+        stereo_file = os.path.join(self.ds_path, "stereo.wav")
+        write_wav(stereo_file, np.random.uniform(-0.5, 0.5, (30000, 2)),
+                  2 * self.sr)
+        audio = FE.read_audio(stereo_file, self.sr)
+        blocks = list(FE.read_audio_blocks(stereo_file, self.sr))
+        self.assertTrue(np.allclose(np.concatenate(blocks), audio,
+                                    atol=1e-3))
+
+    def test_cut_frames(self):
+        for n_samples in [0, 100, 2048, 5000, 3 * self.sr + 17]:
+            audio = np.random.uniform(-1, 1, n_samples).astype(np.float32)
+            frames = list(ES.FrameGenerator(audio, frameSize=2048,
+                                            hopSize=1024))
+            for block_size in [1000, 4096]:
+                blocks = [audio[i:i + block_size]
+                          for i in xrange(0, n_samples, block_size)]
+                block_frames = list(FE.cut_frames(iter(blocks), 2048, 1024))
+                self.assertEqual(len(block_frames), len(frames))
+                for frame, block_frame in zip(frames, block_frames):
+                    self.assertTrue(np.array_equal(frame, block_frame))
+
+    def test_sync_features_in_blocks(self):
+        framerate = self.sr / float(msaf.Anal.hop_size)
+        mfcc = np.random.rand(300, 14)
+        hpcp = np.random.rand(300, 12)
+        # Irregular beats, up to after the last frame
+        beats = np.cumsum(np.random.uniform(0.2, 1, 100))
+        beats = beats[beats < (300 + 20) / framerate]
+        features_file = os.path.join(self.ds_path, "features.npz")
+        with io.FeaturesWriter(features_file) as writer:
+            FE.sync_features_in_blocks(mfcc, hpcp, beats, writer,
+                                       "est_beatsync")
+            FE.sync_features_in_blocks(mfcc, hpcp, [], writer, "framesync")
+        features = io.read_features(features_file)
+        for key, values in zip(["est_beatsync", "framesync"],
+                               [FE.sync_features(mfcc, hpcp, beats),
+                                FE.sync_features(mfcc, hpcp, None)]):
+            for feat_name, value in zip(["mfcc", "hpcp", "tonnetz"], values):
+                self.assertTrue(np.allclose(
+                    features["%s.%s" % (key, feat_name)], value, atol=1e-5))
+
+    def test_beat_windows(self):
+        audio_file = os.path.join(self.ds_path, msaf.Dataset.audio_dir,
+                                  "long.wav")
+        write_wav(audio_file, synth_track(90, self.sr), self.sr)
+        batch_beats, conf = FE.compute_beats(FE.read_audio(audio_file,
+                                                           self.sr))
+
+        # Length of the audio given to the beat tracker
+        track_beats = FE.track_beats
+        lengths = []
+
+        def record_track_beats(audio):
+            lengths.append(len(audio))
+            return track_beats(audio)
+        FE.track_beats = record_track_beats
+        try:
+            beat_tracker = FE.BlockBeatTracker(window=30, overlap=8)
+            for block in beat_tracker.track(
+                    FE.read_audio_blocks(audio_file, self.sr)):
+                pass
+            beats, conf = beat_tracker.finish()
+        finally:
+            FE.track_beats = track_beats
+        self.assertTrue(len(lengths) > 3)
+        self.assertTrue(max(lengths) <= 30 * self.sr)
+
+        # Stitched without duplicates, at the tempo of the whole track
+        intervals = np.diff(beats)
+        period = np.median(np.diff(batch_beats))
+        self.assertTrue(np.all(intervals > period / 2.))
+        self.assertTrue(abs(np.median(intervals) - period) < 0.1 * period)
+        self.assertTrue(beats[0] < 4 * period)
+        self.assertTrue(beats[-1] > 90 - 4 * period)
+
+    def test_blocks_vs_batch(self):
+        FE.compute_all_features(self.file_struct)
+        batch = io.read_features(self.file_struct.features_file)
+        FE.compute_all_features(self.file_struct, overwrite=True, blocks=True)
+        features = io.read_features(self.file_struct.features_file)
+
+        self.assertEqual(sorted(features.keys()), sorted(batch.keys()))
+        self.assertEqual(features["analysis"], batch["analysis"])
+        self.assertTrue(np.allclose(features["beats.times"],
+                                    batch["beats.times"], atol=0.01))
+        self.assertTrue(np.allclose(features["beats.confidence"],
+                                    batch["beats.confidence"], atol=0.01))
+        for key in batch.keys():
+            if key.split(".")[0] in msaf.feat_blocks:
+                self.assertEqual(features[key].shape, batch[key].shape)
+                self.assertTrue(np.allclose(features[key], batch[key],
+                                            rtol=1e-3, atol=1e-4))
+
+if __name__ == '__main__':
+    unittest.main()
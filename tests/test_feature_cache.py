@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+"""
+Unit tests for the features cache.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from msaf import feature_cache as FC
+
+
+def random_features(n_frames=100):
+    """Features as stored in a cache entry."""
+    return {"beats.times": np.sort(np.random.rand(20)),
+            "beats.confidence": [1.0],
+            "analysis": {"sample_rate": 11025},
+            "framesync.hpcp": np.random.rand(n_frames, 12)}
+
+
+class TestFeatureCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.params = {"sample_rate": 11025, "hop_size": 1024}
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def put(self, audio_hash, max_size=2 ** 30, **kwargs):
+        features = random_features(**kwargs)
+        FC.put(audio_hash, self.params, features, self.cache_dir, max_size)
+        return features
+
+    def test_hash_audio(self):
+        audio_file = os.path.join(self.cache_dir, "audio.wav")
+        content = os.urandom(3000)
+        with open(audio_file, "wb") as f:
+            f.write(content)
+        audio_hash = FC.hash_audio(audio_file, block_size=1024)
+        self.assertEqual(audio_hash, hashlib.sha1(content).hexdigest())
+
+        with open(audio_file, "ab") as f:
+            f.write("0")
+        self.assertNotEqual(FC.hash_audio(audio_file), audio_hash)
+
+    def test_get_put(self):
+        self.assertTrue(FC.get("ab12", self.params, self.cache_dir) is None)
+        features = self.put("ab12")
+        cached = FC.get("ab12", self.params, self.cache_dir)
+        self.assertTrue(np.allclose(cached["framesync.hpcp"],
+                                    features["framesync.hpcp"]))
+        self.assertEqual(cached["analysis"], features["analysis"])
+
+        # Other analysis parameters
+        params = dict(self.params, hop_size=512)
+        self.assertTrue(FC.get("ab12", params, self.cache_dir) is None)
+
+    def test_get_removed(self):
+        self.put("ab12")
+        utime = FC.os.utime
+
+        def remove_and_utime(path, times):
+            os.remove(path)
+            utime(path, times)
+        FC.os.utime = remove_and_utime
+        try:
+            features = FC.get("ab12", self.params, self.cache_dir)
+        finally:
+            FC.os.utime = utime
+        self.assertTrue(features is not None)
+
+    def test_lru(self):
+        for i, audio_hash in enumerate(["aa01", "bb02", "cc03"]):
+            self.put(audio_hash)
+            cache_file = FC.get_cache_file(audio_hash, self.params,
+                                           self.cache_dir)
+            os.utime(cache_file, (1000 + i, 1000 + i))
+
+        # Using the oldest entry makes it the most recent one
+        FC.get("aa01", self.params, self.cache_dir)
+        entries = FC.get_entries(self.cache_dir)
+        self.assertEqual([os.path.basename(entry[0])[:4]
+                          for entry in entries], ["bb02", "cc03", "aa01"])
+
+        # Keep the two most recent ones
+        max_size = entries[1][1] + entries[2][1]
+        self.assertEqual(FC.prune(self.cache_dir, max_size), 1)
+        self.assertTrue(FC.get("bb02", self.params, self.cache_dir) is None)
+        self.assertTrue(FC.get("aa01", self.params, self.cache_dir)
+                        is not None)
+        self.assertEqual(FC.read_size(self.cache_dir), max_size)
+
+    def test_put_prunes_when_full(self):
+        n_prunes = []
+        prune = FC.prune
+
+        def count_prune(cache_dir=None, max_size=None):
+            n_prunes.append(max_size)
+            return prune(cache_dir, max_size)
+        FC.prune = count_prune
+        try:
+            # First write counts the size
+            self.put("aa01")
+            self.assertEqual(len(n_prunes), 1)
+            size = FC.stats(self.cache_dir)["size"]
+            self.assertEqual(FC.read_size(self.cache_dir), size)
+
+            # Then it is only pruned when the counter exceeds max_size
+            self.put("bb02", max_size=3 * size)
+            self.put("cc03", max_size=3 * size)
+            self.assertEqual(len(n_prunes), 1)
+            self.assertEqual(FC.read_size(self.cache_dir), 3 * size)
+            self.put("dd04", max_size=3 * size)
+            self.assertEqual(len(n_prunes), 2)
+        finally:
+            FC.prune = prune
+        self.assertEqual(FC.stats(self.cache_dir)["n_entries"], 3)
+
+    def test_tmp_files(self):
+        self.put("ab12")
+        tmp_file = os.path.join(self.cache_dir, "ab", "xyz" + FC.TMP_EXT)
+        with open(tmp_file, "w") as f:
+            f.write("0" * 10000)
+
+        # Files being written are not entries, so they are never pruned
+        self.assertEqual(len(FC.get_entries(self.cache_dir)), 1)
+        FC.prune(self.cache_dir, 0)
+        self.assertTrue(os.path.isfile(tmp_file))
+        self.assertEqual(FC.stats(self.cache_dir)["n_entries"], 0)
+
+    def test_stats(self):
+        cache_stats = FC.stats(self.cache_dir)
+        self.assertEqual(cache_stats["n_entries"], 0)
+        self.assertTrue(cache_stats["oldest"] is None)
+
+        self.put("aa01")
+        self.put("bb02")
+        FC.put("aa01", dict(self.params, hop_size=512), random_features(),
+               self.cache_dir, 2 ** 30)
+        cache_stats = FC.stats(self.cache_dir)
+        self.assertEqual(cache_stats["n_entries"], 3)
+        self.assertEqual(cache_stats["n_audio_files"], 2)
+        self.assertEqual(cache_stats["size"], sum(
+            entry[1] for entry in FC.get_entries(self.cache_dir)))
+        self.assertTrue(cache_stats["oldest"] <= cache_stats["newest"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""
+Unit tests for the Foote segmenter.
+"""
+
+import unittest
+import numpy as np
+
+from msaf.algorithms.foote import segmenter as F
+
+
+def compute_nc_loop(X, G):
+    """Original (loop-based) implementation of the novelty curve, used as
+    reference."""
+    N = X.shape[0]
+    M = G.shape[0]
+    nc = np.zeros(N)
+
+    for i in xrange(M / 2, N - M / 2 + 1):
+        nc[i] = np.sum(X[i - M / 2:i + M / 2, i - M / 2:i + M / 2] * G)
+
+    # Normalize
+    nc += nc.min()
+    nc /= nc.max()
+    return nc
+
+
+class TestFoote(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(123)
+
+    def test_compute_ssm_band(self):
+        X = np.random.random((200, 12)).astype(np.float32)
+        S = F.compute_ssm(X)
+        B = F.compute_ssm_band(X, 24, block_size=1000)
+        self.assertEqual(B.shape, (200, 24))
+        for l in xrange(24):
+            self.assertTrue(np.allclose(B[:200 - l, l], np.diagonal(S, l)))
+            self.assertTrue(np.all(B[200 - l:, l] == 0))
+
+    def test_compute_nc(self):
+        S = F.compute_ssm(np.random.random((200, 12)))
+        for M in [8, 16, 24]:
+            G = F.compute_gaussian_krnl(M)
+            self.assertTrue(np.allclose(F.compute_nc(S, G),
+                                        compute_nc_loop(S, G)))
+
+    def test_compute_nc_band(self):
+        X = np.random.random((200, 12))
+        for M in [8, 16, 24]:
+            G = F.compute_gaussian_krnl(M)
+            nc = F.compute_nc(F.compute_ssm(X), G)
+            nc_band = F.compute_nc_band(F.compute_ssm_band(X, M), G)
+            self.assertTrue(np.allclose(nc, nc_band))
+
+    def test_compute_ncs(self):
+        X = np.random.random((200, 12))
+        Ms = [8, 16, 24]
+        S = F.compute_ssm(X)
+        ncs = F.compute_ncs(S, Ms, banded=False)
+        ncs_band = F.compute_ncs(F.compute_ssm_band(X, max(Ms)), Ms)
+        self.assertEqual(len(ncs), len(Ms))
+        for M, nc, nc_band in zip(Ms, ncs, ncs_band):
+            nc_ref = compute_nc_loop(S, F.compute_gaussian_krnl(M))
+            self.assertTrue(np.allclose(nc, nc_ref))
+            self.assertTrue(np.allclose(nc_band, nc_ref))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+"""
+Unit tests for the binary features files of the input and output module.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+import msaf
+from msaf import input_output as io
+from msaf import migrate_features
+
+
+def random_features(n_frames=50, n_beats=20):
+    """Features with the keys and shapes of a features file."""
+    features = {}
+    features["beats.times"] = np.sort(np.random.rand(n_beats)) * 100
+    features["beats.confidence"] = [3.5]
+    features["analysis"] = {"sample_rate": 11025, "hop_size": 1024,
+                            "dur": 100.0}
+    features["timestamp"] = "2014/01/01 00:00:00"
+    for block, N in zip(msaf.feat_blocks, [n_frames, n_beats, n_beats]):
+        for feat_name, dim in zip(msaf.feat_names, [12, 14, 6]):
+            features["%s.%s" % (block, feat_name)] = np.random.rand(N, dim)
+    return features
+
+
+def write_json_features(json_file, features):
+    """Writes the features in the legacy JSON format (Essentia's YamlOutput
+    of the pools)."""
+    feats = {"beats": {"times": [features["beats.times"].tolist()],
+                       "confidence": [features["beats.confidence"]]},
+             "analysis": features["analysis"],
+             "timestamp": features["timestamp"]}
+    for block in msaf.feat_blocks:
+        feats[block] = {}
+        for feat_name in msaf.feat_names:
+            feats[block][feat_name] = \
+                features["%s.%s" % (block, feat_name)].tolist()
+    with open(json_file, "w") as f:
+        json.dump(feats, f)
+
+
+class TestFeaturesFile(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.features_file = os.path.join(self.tmp_dir, "track.npz")
+        self.features = random_features()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def assert_same_features(self, features, keys=None):
+        if keys is None:
+            keys = self.features.keys()
+        self.assertEqual(sorted(features.keys()), sorted(keys))
+        for key in keys:
+            if key in ["analysis", "timestamp"]:
+                self.assertEqual(features[key], self.features[key])
+            else:
+                self.assertTrue(np.allclose(features[key],
+                                            self.features[key]))
+
+    def test_write_read(self):
+        io.write_features(self.features_file, self.features)
+        features = io.read_features(self.features_file)
+        self.assert_same_features(features)
+        self.assertEqual(features["framesync.hpcp"].dtype, np.float32)
+        self.assertEqual(features["beats.times"].dtype, np.float64)
+
+        # Only the requested keys
+        keys = ["analysis", "est_beatsync.mfcc"]
+        self.assert_same_features(
+            io.read_features(self.features_file, keys), keys)
+
+    def test_write_mmap(self):
+        io.write_features(self.features_file, self.features)
+        features = io.read_features(self.features_file, mmap=True)
+        self.assert_same_features(features)
+        self.assertTrue(isinstance(features["framesync.hpcp"], np.memmap))
+
+        for key in ["framesync.mfcc", "beats.times"]:
+            X = io.mmap_features(self.features_file, key)
+            self.assertTrue(isinstance(X, np.memmap))
+            self.assertTrue(np.allclose(X, self.features[key]))
+
+    def test_mmap_fortran_order(self):
+        X = np.asfortranarray(np.random.rand(30, 12))
+        io.write_features(self.features_file, {"framesync.hpcp": X})
+        X_map = io.mmap_features(self.features_file, "framesync.hpcp")
+        self.assertTrue(X_map.flags.f_contiguous)
+        self.assertTrue(np.allclose(X_map, X))
+
+    def test_mmap_empty(self):
+        io.write_features(self.features_file,
+                          {"beats.times": [], "ann_beatsync.hpcp":
+                           np.zeros((0, 12))})
+        beats = io.mmap_features(self.features_file, "beats.times")
+        self.assertEqual(beats.shape, (0,))
+        hpcp = io.mmap_features(self.features_file, "ann_beatsync.hpcp")
+        self.assertEqual(hpcp.shape, (0, 12))
+
+    def test_mmap_compressed(self):
+        X = np.random.rand(30, 12).astype(np.float32)
+        with open(self.features_file, "wb") as f:
+            np.savez_compressed(f, **{"framesync.hpcp": X})
+        X_map = io.mmap_features(self.features_file, "framesync.hpcp")
+        self.assertFalse(isinstance(X_map, np.memmap))
+        self.assertTrue(np.array_equal(X_map, X))
+
+    def test_json_migration(self):
+        json_file = os.path.join(self.tmp_dir, "track.json")
+        write_json_features(json_file, self.features)
+        self.assert_same_features(io.read_features(json_file))
+
+        migrate_features.migrate_features_file(json_file, remove=True)
+        self.assertFalse(os.path.isfile(json_file))
+        self.assert_same_features(io.read_features(self.features_file))
+
+    def test_get_features_file(self):
+        for dir in [msaf.Dataset.audio_dir, msaf.Dataset.features_dir]:
+            os.mkdir(os.path.join(self.tmp_dir, dir))
+        audio_file = os.path.join(self.tmp_dir, msaf.Dataset.audio_dir,
+                                  "track.mp3")
+        features_file = os.path.join(self.tmp_dir, msaf.Dataset.features_dir,
+                                     "track" + msaf.Dataset.features_ext)
+        json_file = os.path.join(self.tmp_dir, msaf.Dataset.features_dir,
+                                 "track.json")
+
+        # Legacy file only if there is no binary one
+        write_json_features(json_file, self.features)
+        self.assertEqual(io.get_features_file(audio_file), json_file)
+        io.write_features(features_file, self.features)
+        self.assertEqual(io.get_features_file(audio_file), features_file)
+
+    def write_blocks(self, writer, block_size=7):
+        """Writes self.features with the writer, appending the feature
+        matrices in blocks."""
+        for key, value in self.features.items():
+            if key.split(".")[0] in msaf.feat_blocks:
+                for i in xrange(0, len(value), block_size):
+                    writer.append(key, value[i:i + block_size])
+            else:
+                writer[key] = value
+
+    def test_features_writer(self):
+        writer = io.FeaturesWriter(self.features_file)
+        self.write_blocks(writer)
+
+        # Rows appended so far
+        self.assertTrue(np.allclose(writer.get("framesync.hpcp"),
+                                    self.features["framesync.hpcp"]))
+        writer.append("framesync.hpcp", np.ones((3, 12)))
+        self.assertEqual(writer.get("framesync.hpcp").shape, (53, 12))
+        self.assertRaises(ValueError, writer.append, "framesync.hpcp",
+                          np.ones((3, 14)))
+        self.assertRaises(ValueError, writer.append, "beats.times", [1.0])
+        writer.close()
+        self.assertFalse(os.path.isdir(writer.tmp_dir))
+
+        self.features["framesync.hpcp"] = np.vstack(
+            (self.features["framesync.hpcp"], np.ones((3, 12))))
+        self.assert_same_features(io.read_features(self.features_file))
+        features = io.read_features(self.features_file, mmap=True)
+        self.assert_same_features(features)
+        self.assertTrue(isinstance(features["est_beatsync.mfcc"], np.memmap))
+        self.assertEqual(features["est_beatsync.mfcc"].dtype, np.float32)
+
+    def test_features_writer_empty(self):
+        with io.FeaturesWriter(self.features_file) as writer:
+            writer.append("ann_beatsync.hpcp", np.zeros((0, 12)))
+            writer.append("beats.times", [])
+        self.assertEqual(io.mmap_features(self.features_file,
+                                          "ann_beatsync.hpcp").shape, (0, 12))
+        self.assertEqual(io.mmap_features(self.features_file,
+                                          "beats.times").shape, (0,))
+
+    def test_features_writer_error(self):
+        io.write_features(self.features_file, self.features)
+
+        def write_and_fail():
+            with io.FeaturesWriter(self.features_file) as writer:
+                self.write_blocks(writer)
+                raise KeyboardInterrupt
+        self.assertRaises(KeyboardInterrupt, write_and_fail)
+
+        # The previous file is kept, and the temporary files removed
+        self.assert_same_features(io.read_features(self.features_file))
+        self.assertEqual(os.listdir(self.tmp_dir), ["track.npz"])
+
+
+class TestFeatureHandle(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        for dir in [msaf.Dataset.audio_dir, msaf.Dataset.features_dir]:
+            os.mkdir(os.path.join(self.tmp_dir, dir))
+        self.audio_file = os.path.join(self.tmp_dir, msaf.Dataset.audio_dir,
+                                       "track.mp3")
+        self.features_file = os.path.join(
+            self.tmp_dir, msaf.Dataset.features_dir,
+            "track" + msaf.Dataset.features_ext)
+        self.features = random_features()
+        io.write_features(self.features_file, self.features)
+
+        # Record the keys read from the features file
+        self.read_keys = []
+        self.read_features = io.read_features
+
+        def read_features(features_file, keys=None, mmap=False):
+            self.read_keys.extend(keys)
+            return self.read_features(features_file, keys, mmap)
+        io.read_features = read_features
+
+    def tearDown(self):
+        io.read_features = self.read_features
+        shutil.rmtree(self.tmp_dir)
+
+    def test_lazy_read(self):
+        feats = io.FeatureHandle(self.audio_file)
+        self.assertEqual(sorted(self.read_keys), ["analysis", "beats.times"])
+        self.assertTrue(np.allclose(feats.beats,
+                                    self.features["beats.times"]))
+        self.assertEqual(feats.dur, self.features["analysis"]["dur"])
+
+        # Only the requested key is mapped, and only once
+        del self.read_keys[:]
+        hpcp = feats["hpcp"]
+        self.assertEqual(self.read_keys, ["est_beatsync.hpcp"])
+        self.assertTrue(isinstance(hpcp, np.memmap))
+        self.assertTrue(np.allclose(hpcp,
+                                    self.features["est_beatsync.hpcp"]))
+        self.assertTrue(feats["hpcp"] is hpcp)
+        self.assertEqual(self.read_keys, ["est_beatsync.hpcp"])
+
+    def test_framesync(self):
+        feats = io.FeatureHandle(self.audio_file, framesync=True)
+        self.assertEqual(self.read_keys, ["analysis"])
+        self.assertTrue(feats.beats is None)
+        self.assertTrue(np.allclose(feats["mfcc"],
+                                    self.features["framesync.mfcc"]))
+
+    def test_copy_on_write(self):
+        feats = io.FeatureHandle(self.audio_file)
+        mfcc = feats["mfcc"]
+        mfcc += 1
+        mfcc[0, :] = 0
+        self.assertTrue(np.allclose(
+            np.load(self.features_file)["est_beatsync.mfcc"],
+            self.features["est_beatsync.mfcc"]))
+        self.assertTrue(np.allclose(
+            io.mmap_features(self.features_file, "est_beatsync.mfcc"),
+            self.features["est_beatsync.mfcc"]))
+
+    def test_get_features(self):
+        C, M, T, beats, dur, analysis = io.get_features(self.audio_file)
+        for X, feat_name in zip([C, M, T], msaf.feat_names):
+            self.assertTrue(np.allclose(
+                X, self.features["est_beatsync.%s" % feat_name]))
+        self.assertEqual(sorted(self.read_keys),
+                         ["analysis", "beats.times", "est_beatsync.hpcp",
+                          "est_beatsync.mfcc", "est_beatsync.tonnetz"])
+        self.assertEqual(analysis, self.features["analysis"])
+
+if __name__ == '__main__':
+    unittest.main()
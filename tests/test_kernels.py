@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""
+Unit tests for the MSAF signal kernels.
+"""
+
+import unittest
+import numpy as np
+from scipy.ndimage import filters
+
+import msaf.kernels as K
+
+
+# Original (loop-based) implementations, used as reference
+def median_filter_loop(X, M=8):
+    for i in xrange(X.shape[1]):
+        X[:, i] = filters.median_filter(X[:, i], size=M)
+    return X
+
+
+def pick_peaks_loop(nc, L=16, offset_denom=0.1):
+    offset = nc.mean() * float(offset_denom)
+    th = filters.median_filter(nc, size=L) + offset
+    peaks = []
+    for i in xrange(1, nc.shape[0] - 1):
+        if nc[i - 1] < nc[i] and nc[i] > nc[i + 1]:
+            if nc[i] > th[i]:
+                peaks.append(i)
+    return peaks
+
+
+def pick_peaks_hills_loop(nc, L=16):
+    offset = nc.mean() / 2.
+    th = filters.median_filter(nc, size=L) + offset
+    peaks = []
+    k_hill = 0
+    hill = False
+    for i in xrange(1, nc.shape[0] - 1):
+        if nc[i] > th[i]:
+            if nc[i - 1] < nc[i] and nc[i] > nc[i + 1]:
+                k_hill = 0
+                hill = False
+                peaks.append(i)
+            if nc[i - 1] == nc[i]:
+                hill = True
+                k_hill += 1
+        elif hill:
+            peaks.append(i - k_hill / 2)
+            k_hill = 0
+            hill = False
+    return peaks
+
+
+def gaussian_cost_loop(X):
+    d, n = X.shape
+    if n < 2:
+        return 0
+    sigma = np.var(X, axis=1, ddof=1)
+    return -0.5 * d * n * np.log(2. * np.pi) - 0.5 * (n - 1.) * np.sum(sigma)
+
+
+class TestKernels(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(123)
+
+    def test_median_filter(self):
+        X = np.random.random((200, 12)).astype(np.float32)
+        for M in [1, 8, 13]:
+            Y = K.median_filter(X, M=M)
+            self.assertEqual(Y.dtype, X.dtype)
+            self.assertTrue(np.array_equal(Y, median_filter_loop(X.copy(), M)))
+            self.assertTrue(np.array_equal(K.median_filter(X.T, M=M, axis=1),
+                                           Y.T))
+
+    def test_gaussian_filter(self):
+        X = np.random.random((200, 12))
+        Y = K.gaussian_filter(X, M=8, axis=0)
+        for i in xrange(X.shape[1]):
+            self.assertTrue(np.allclose(
+                Y[:, i], filters.gaussian_filter(X[:, i], sigma=4)))
+
+    def test_pick_peaks(self):
+        for N in [1, 2, 3, 100, 500]:
+            # Quantized, so that there are flat hills
+            nc = np.repeat(np.round(np.random.random(N) * 4) / 4., 2)
+            for L in [1, 8, 16]:
+                th = K.adaptive_threshold(nc, L=L, offset_coef=0.04)
+                self.assertEqual(list(K.pick_peaks(nc, th)),
+                                 pick_peaks_loop(nc, L, 0.04))
+                th = K.adaptive_threshold(nc, L=L, offset_coef=0.5)
+                self.assertEqual(list(K.pick_peaks(nc, th, flat_hills=True)),
+                                 pick_peaks_hills_loop(nc, L))
+
+        nc = np.array([0, 1, 0, 2, 2, 0, 3, 0.])
+        self.assertEqual(list(K.pick_peaks(nc)), [1, 6])
+        self.assertEqual(list(K.pick_peaks(nc, th=1.5)), [6])
+
+    def test_gaussian_segment_costs(self):
+        # Large offsets, as the time features of OLDA
+        X = np.random.randn(20, 1000) + np.arange(1000)
+        moments = K.segment_moments(X)
+        for boundaries in [[0, 1000], [0, 1, 2, 500, 999, 1000],
+                           np.unique(np.random.randint(0, 1001, 50))]:
+            costs = K.gaussian_segment_costs(moments, boundaries)
+            self.assertEqual(len(costs), len(boundaries) - 1)
+            for cost, start, end in zip(costs, boundaries[:-1],
+                                        boundaries[1:]):
+                self.assertAlmostEqual(cost / 1e3, gaussian_cost_loop(
+                    X[:, start:end]) / 1e3)
+
+if __name__ == '__main__':
+    unittest.main()
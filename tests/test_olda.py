@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""
+Unit tests for the OLDA segmenter.
+"""
+
+import unittest
+import numpy as np
+import sklearn.cluster
+from sklearn.feature_extraction.image import grid_to_graph
+
+from msaf.algorithms.olda import OLDA
+from msaf.algorithms.olda import segmenter
+
+
+def agglomerative(X, k):
+    """Boundaries of the constrained Ward clustering of X in k segments, as
+    librosa.segment.agglomerative, used as reference."""
+    grid = grid_to_graph(n_x=X.shape[1], n_y=1, n_z=1)
+    ward = sklearn.cluster.AgglomerativeClustering(n_clusters=k,
+                                                   connectivity=grid)
+    ward.fit(X.T)
+    return np.concatenate(([0], 1 + np.flatnonzero(np.diff(ward.labels_)),
+                           [X.shape[1]]))
+
+
+def compress_data_eig(X, k):
+    """Original compress_data (general eigensolver), used as reference."""
+    e_vals, e_vecs = np.linalg.eig(X.dot(X.T))
+    e_vals = np.maximum(0.0, np.real(e_vals))
+    e_vecs = np.real(e_vecs)
+    idx = np.argsort(e_vals)[::-1]
+    e_vals = e_vals[idx][:k]
+    e_vecs = e_vecs[:, idx][:, :k]
+    return e_vecs.T.dot(X) / np.sqrt(e_vals.max())
+
+
+class TestOLDA(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(123)
+        # Segments with different means
+        self.X = np.random.randn(10, 120) + \
+            np.repeat(np.random.randn(10, 12) * 3, 10, axis=1)
+
+    def test_compress_data(self):
+        # Binary and sparse, as the filtered structure features
+        P = (np.random.rand(60, 200) > 0.8).astype(np.float32)
+        for k in [1, 32, 100]:
+            R = segmenter.compress_data(P, k)
+            R_ref = compress_data_eig(P, k)
+            self.assertEqual(R.shape, (min(k, 60), 200))
+
+            # The eigenvectors are defined up to their sign
+            signs = np.sign(np.sum(R * R_ref, axis=1))
+            self.assertTrue(np.allclose(R * signs[:, np.newaxis], R_ref,
+                                        atol=1e-4))
+
+        self.assertTrue(segmenter.compress_data(np.zeros((0, 10)), 32) is
+                        None)
+
+        # Non-finite values are ignored
+        P_nan = P.copy()
+        P_nan[P == 0] = np.nan
+        R = segmenter.compress_data(P_nan, 32)
+        self.assertTrue(np.all(np.isfinite(R)))
+        self.assertTrue(np.allclose(np.abs(R), np.abs(
+            segmenter.compress_data(P, 32)), atol=1e-4))
+
+    def test_k_segments(self):
+        merged = segmenter.ward_boundaries(self.X)
+        self.assertEqual(sorted(merged), range(1, 120))
+        for k in [1, 2, 5, 12, 30, 120]:
+            S, cost = segmenter.get_k_segments(self.X, k, merged)
+            self.assertEqual(len(S), k + 1)
+            self.assertTrue(np.array_equal(S, agglomerative(self.X, k)))
+
+    def test_clustering_cost(self):
+        S = segmenter.get_k_segments(self.X, 12)[0]
+        costs = [segmenter.gaussian_cost(self.X[:, start:end])
+                 for start, end in zip(S[:-1], S[1:])]
+        n, d = self.X.shape[1], self.X.shape[0]
+        self.assertAlmostEqual(segmenter.clustering_cost(self.X, S),
+                               -2 * np.sum(costs) / n + 2 * d * 12)
+
+    def test_get_segments(self):
+        # Original loop, running Ward for every k
+        cost_min = np.inf
+        for k in range(20, 4, -1):
+            S = agglomerative(self.X, k)
+            cost = segmenter.clustering_cost(self.X, S)
+            if cost >= cost_min:
+                break
+            cost_min = cost
+            S_ref = S
+        S = segmenter.get_segments(self.X, kmin=4, kmax=20)
+        self.assertTrue(np.array_equal(S, S_ref))
+
+    def test_in_memory_features(self):
+        # Features as computed by featextract in single file mode
+        n = 300
+        features = {"beats": np.arange(n) * 0.5,
+                    "bs_hpcp": np.random.rand(n, 12),
+                    "bs_mfcc": np.random.randn(n, 32),
+                    "anal": {"dur": n * 0.5 + 1}}
+        hpcp = features["bs_hpcp"].copy()
+
+        # No features file is read
+        S = segmenter.Segmenter("nonexistent.mp3", features=features,
+                                transform=None)
+        est_times, est_labels = S.process()
+        self.assertTrue(len(est_times) > 2)
+        self.assertEqual(est_times[-1], features["anal"]["dur"])
+        self.assertTrue(np.array_equal(features["bs_hpcp"], hpcp))
+
+    def test_partial_fit(self):
+        X = [np.random.randn(6, n) for n in [50, 80, 40, 60]]
+        Y = [np.array([0, 10, 30, 50]), np.array([20, 40, 79]),
+             np.array([0, 5, 40]), np.array([0, 30, 45, 60])]
+        model = OLDA.OLDA(sigma=1e-2).fit(X, Y)
+
+        # Streamed in batches, as fit_olda_model does
+        model_stream = OLDA.OLDA(sigma=1e-2)
+        model_stream.partial_fit(X[:3], Y[:3])
+        model_stream.partial_fit(X[3:], Y[3:])
+        self.assertTrue(np.allclose(model_stream.scatter_within_,
+                                    model.scatter_within_))
+        self.assertTrue(np.allclose(model_stream.scatter_ordinal_,
+                                    model.scatter_ordinal_))
+
+        # Other regularizations, without refitting
+        for sigma in [1e-2, 10, 1e8]:
+            model_sigma = model.regularize(sigma)
+            model_ref = OLDA.OLDA(sigma=sigma).fit(X, Y)
+            self.assertEqual(model_sigma.sigma, sigma)
+            self.assertTrue(np.allclose(model_sigma.scatter_within_,
+                                        model_ref.scatter_within_))
+            self.assertTrue(np.allclose(np.sort(model_sigma.e_vals_),
+                                        np.sort(model_ref.e_vals_)))
+        self.assertEqual(model.sigma, 1e-2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""
+Unit tests for the incremental runs of the collection mode.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+import msaf
+from msaf import input_output as io
+from msaf import run
+
+
+def write_features_file(features_file, timestamp="2014/01/01 00:00:00"):
+    """Writes a features file with random beat-synchronous features."""
+    features = {"beats.times": np.arange(20) * 0.5,
+                "beats.confidence": [1.0],
+                "analysis": {"sample_rate": 11025, "dur": 10.0},
+                "timestamp": timestamp}
+    for feat_name in msaf.feat_names:
+        features["est_beatsync.%s" % feat_name] = np.random.rand(20, 12)
+    io.write_features(features_file, features)
+
+
+class TestIncrementalRun(unittest.TestCase):
+
+    def setUp(self):
+        self.ds_path = tempfile.mkdtemp()
+        audio_dir = os.path.join(self.ds_path, msaf.Dataset.audio_dir)
+        os.mkdir(audio_dir)
+        for name in ["Cerulean_track1.wav", "Cerulean_track2.wav"]:
+            open(os.path.join(audio_dir, name), "w").close()
+        self.file_structs = io.get_dataset_files(self.ds_path)
+        for file_struct in self.file_structs:
+            write_features_file(file_struct.features_file)
+        self.config = {"annot_beats": False, "feature": "hpcp",
+                       "framesync": False}
+
+        # Record the tracks that are actually segmented
+        self.segmented = []
+        self.run_algorithms = run.run_algorithms
+
+        def run_algorithms(audio_file, boundaries_id, labels_id, config):
+            self.segmented.append(os.path.basename(audio_file))
+            return np.array([0, 4.5, 10]), np.array([0, 1])
+        run.run_algorithms = run_algorithms
+
+    def tearDown(self):
+        run.run_algorithms = self.run_algorithms
+        shutil.rmtree(self.ds_path)
+
+    def process(self, config=None, force=False):
+        del self.segmented[:]
+        if config is None:
+            config = self.config
+        return run.process(self.ds_path, boundaries_id="foote",
+                           labels_id="scluster", n_jobs=1,
+                           config=dict(config), force=force)
+
+    def test_skip_computed(self):
+        results = self.process()
+        self.assertEqual(sorted(self.segmented),
+                         ["Cerulean_track1.wav", "Cerulean_track2.wav"])
+        for file_struct in self.file_structs:
+            self.assertTrue(run.is_computed(file_struct, "foote",
+                                            "scluster", self.config))
+
+        # Unchanged tracks are read from the estimations
+        results_again = self.process()
+        self.assertEqual(self.segmented, [])
+        for (times, labels), (times_again, labels_again) in \
+                zip(results, results_again):
+            self.assertTrue(np.allclose(times, times_again))
+            self.assertTrue(np.array_equal(labels, labels_again))
+
+    def test_recompute_changed(self):
+        self.process()
+
+        # New features
+        write_features_file(self.file_structs[0].features_file,
+                            timestamp="2014/01/02 00:00:00")
+        self.process()
+        self.assertEqual(self.segmented, [os.path.basename(
+            self.file_structs[0].audio_file)])
+        self.process()
+        self.assertEqual(self.segmented, [])
+
+        # New configuration
+        self.process(config=dict(self.config, feature="mfcc"))
+        self.assertEqual(len(self.segmented), 2)
+
+        # Other algorithms
+        self.assertFalse(run.is_computed(self.file_structs[0], "sf",
+                                         "scluster", self.config))
+
+    def test_force(self):
+        self.process()
+        self.process(force=True)
+        self.assertEqual(len(self.segmented), 2)
+
+    def test_missing_estimations(self):
+        self.process()
+        os.remove(self.file_structs[1].est_file)
+        self.process()
+        self.assertEqual(self.segmented, [os.path.basename(
+            self.file_structs[1].audio_file)])
+
+    def test_atomic_ledger(self):
+        ledger_file = self.file_structs[0].ledger_file
+        io.update_ledger(ledger_file, "key1", {"track": "track1"})
+
+        # Interrupted while writing the new ledger
+        dump = io.json.dump
+
+        def broken_dump(obj, f, **kwargs):
+            f.write(json.dumps(obj)[:10])
+            raise KeyboardInterrupt
+        io.json.dump = broken_dump
+        try:
+            self.assertRaises(KeyboardInterrupt, io.update_ledger,
+                              ledger_file, "key2", {"track": "track1"})
+        finally:
+            io.json.dump = dump
+        self.assertEqual(io.read_ledger(ledger_file),
+                         {"key1": {"track": "track1"}})
+
+        io.update_ledger(ledger_file, "key2", {"track": "track1"})
+        self.assertEqual(sorted(io.read_ledger(ledger_file).keys()),
+                         ["key1", "key2"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+Unit tests for the Laplacian factorization of the Spectral Clustering
+algorithm.
+"""
+
+import unittest
+import numpy as np
+import scipy.sparse
+
+from msaf.algorithms.scluster import main
+
+
+def random_graph(n, k=4):
+    """Random symmetric sparse affinities with a ridge along the +- 1
+    diagonals, like the jukebox matrix of do_segmentation."""
+    A = scipy.sparse.rand(n, n, density=float(k) / n, format="csr")
+    A = A + A.T + scipy.sparse.diags([np.ones(n - 1), np.ones(n - 1)],
+                                     [1, -1])
+    A = A.tolil()
+    A.setdiag(0)
+    return A.tocsr()
+
+
+class TestSCluster(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(123)
+
+    def test_laplacians(self):
+        A = random_graph(50)
+        for laplacian in [main.sym_laplacian, main.rw_laplacian]:
+            L = laplacian(A)
+            self.assertTrue(scipy.sparse.issparse(L))
+            self.assertTrue(np.allclose(L.toarray(), laplacian(A.toarray())))
+
+    def test_factorize_sparse(self):
+        n, k = 200, 6
+        L = main.sym_laplacian(random_graph(n))
+        e_vecs, gap = main.factorize(L, k=k)
+        e_vecs_ref, gap_ref = main.factorize(L.toarray(), k=k)
+        self.assertEqual(e_vecs.shape, (k, n))
+        self.assertAlmostEqual(gap, gap_ref)
+
+        # Same subspace (the eigenvectors are defined up to their sign)
+        self.assertTrue(np.allclose(np.abs(np.sum(e_vecs * e_vecs_ref, 1)),
+                                    1))
+
+    def test_factorize_small(self):
+        # Fewer nodes than eigenvectors: all of them are used
+        L = main.sym_laplacian(random_graph(8))
+        e_vecs, gap = main.factorize(L, k=11)
+        self.assertEqual(e_vecs.shape, (7, 8))
+
+    def test_warm_start_centers(self):
+        Y = np.random.rand(30, 3)
+        labels = np.arange(30) % 2
+        Y[-1] += 10
+        centers = main.warm_start_centers(Y, labels)
+        self.assertEqual(centers.shape, (3, 3))
+        self.assertTrue(np.allclose(centers[0], Y[labels == 0].mean(0)))
+        self.assertTrue(np.allclose(centers[1], Y[labels == 1].mean(0)))
+        self.assertTrue(np.array_equal(centers[2], Y[-1]))
+
+    def test_select_partition(self):
+        # Alternating patterns
+        Lf = np.random.rand(8, 60) * 0.1
+        Lf[1, ::2] += 1
+        scores = {}
+
+        def evaluate(n_types, labels):
+            self.assertEqual(len(labels), 60)
+            self.assertEqual(len(np.unique(labels)), n_types)
+            scores[n_types] = n_types
+            return n_types
+
+        # Nothing better than 4 types
+        upper_bound = lambda n_types: n_types if n_types <= 4 else -np.inf
+
+        for warm_start, n_jobs in [(True, 1), (False, 1), (False, 3)]:
+            scores.clear()
+            n_types, Y, labels = main.select_partition(
+                Lf, evaluate, upper_bound, warm_start, n_jobs, n_init=10)
+            self.assertEqual(n_types, 4)
+            self.assertEqual(Y.shape, (60, 4))
+            self.assertEqual(sorted(scores.keys()), [2, 3, 4])
+
+        # Same partition for the same seed, regardless of the threads
+        partitions = [main.select_partition(Lf, evaluate, upper_bound, False,
+                                            n_jobs, n_init=10, seed=1)[2]
+                      for n_jobs in [1, 3, 3]]
+        for labels in partitions[1:]:
+            self.assertTrue(np.array_equal(labels, partitions[0]))
+
+        # Fewer types than repetition features
+        scores.clear()
+        n_types, Y, labels = main.select_partition(
+            Lf, evaluate, upper_bound, max_types=3, n_init=10)
+        self.assertEqual(n_types, 3)
+        self.assertEqual(sorted(scores.keys()), [2, 3])
+
+    def test_sparse_jukebox_matrix(self):
+        n, k_link = 120, 15
+        Xs = np.random.rand(10, n)
+        Xs[:, 60:] = Xs[:, :60] + 0.01 * np.random.rand(10, 60)
+        X_loc = np.random.rand(5, n)
+        T = main.dense_jukebox_matrix(Xs, X_loc, k_link)
+        T_sparse = main.sparse_jukebox_matrix(Xs, X_loc, k_link)
+        self.assertTrue(scipy.sparse.issparse(T_sparse))
+        self.assertTrue(np.allclose(T, T_sparse.toarray(), atol=1e-6))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""
+Unit tests for the Structural Features segmenter.
+"""
+
+import unittest
+import numpy as np
+import scipy.sparse
+from scipy.spatial import distance
+from scipy.ndimage import filters
+
+from msaf.algorithms.sf import segmenter as SF
+
+
+# Original (loop-based) implementations, used as reference
+def gaussian_filter_loop(X, M=8, axis=0):
+    for i in xrange(X.shape[axis]):
+        if axis == 1:
+            X[:, i] = filters.gaussian_filter(X[:, i], sigma=M / 2.)
+        elif axis == 0:
+            X[i, :] = filters.gaussian_filter(X[i, :], sigma=M / 2.)
+    return X
+
+
+def compute_nc_loop(X):
+    N = X.shape[0]
+    nc = np.zeros(N)
+    for i in xrange(N - 1):
+        nc[i] = distance.euclidean(X[i, :], X[i + 1, :])
+    nc += np.abs(nc.min())
+    nc /= nc.max()
+    return nc
+
+
+def circular_shift_loop(X):
+    N = X.shape[0]
+    L = np.zeros(X.shape)
+    for i in xrange(N):
+        L[i, :] = np.asarray([X[(i + j) % N, j] for j in xrange(N)])
+    return L
+
+
+def embedded_space_loop(X, m, tau=1):
+    N = X.shape[0] - int(np.ceil(m))
+    Y = np.zeros((N, int(np.ceil(X.shape[1] * m))))
+    for i in xrange(N):
+        rem = int((m % 1) * X.shape[1])
+        Y[i, :] = np.concatenate((X[i:i + int(m), :].flatten(),
+                                 X[i + int(m), :rem]))
+    return Y
+
+
+class TestSF(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(123)
+
+    def test_embedded_space(self):
+        X = np.random.random((100, 12)).astype(np.float32)
+        for m in [1, 2, 3, 2.5, 3.25]:
+            Y = SF.embedded_space(X, m)
+            self.assertTrue(np.array_equal(Y, embedded_space_loop(X, m)))
+
+    def test_circular_shift(self):
+        R = (np.random.random((80, 80)) > 0.9).astype(np.float32)
+        L = SF.circular_shift(R)
+        self.assertTrue(np.array_equal(L, circular_shift_loop(R)))
+
+    def test_gaussian_filter(self):
+        L = np.random.random((80, 60))
+        for M, axis in [(16, 1), (1, 0), (8, 0)]:
+            X = SF.gaussian_filter(L.T.copy(), M=M, axis=axis)
+            X_ref = gaussian_filter_loop(L.T.copy(), M=M, axis=axis)
+            self.assertTrue(np.allclose(X, X_ref))
+
+        # Filtered in place, as the segmenter relies on it
+        X = L.T.copy()
+        SF.gaussian_filter(X, M=16, axis=1)
+        X_ref = gaussian_filter_loop(L.T.copy(), M=16, axis=1)
+        self.assertTrue(np.allclose(X, X_ref))
+
+    def test_compute_nc(self):
+        X = np.random.random((100, 50))
+        self.assertTrue(np.allclose(SF.compute_nc(X), compute_nc_loop(X)))
+
+    def test_sparse_structural_features(self):
+        R = (np.random.random((150, 150)) > 0.9).astype(np.float32)
+        L = SF.circular_shift(R)
+        L_sparse = SF.circular_shift_sparse(scipy.sparse.csr_matrix(R))
+        self.assertTrue(np.array_equal(L, L_sparse.toarray()))
+
+        # Dense structural features and novelty curve
+        SF.gaussian_filter(L.T, M=16, axis=1)
+        SF.gaussian_filter(L.T, M=1, axis=0)
+        nc = SF.compute_nc(L.T)
+
+        # In blocks of frames
+        for block_size in [150, 5000, 2 ** 24]:
+            nc_sparse = SF.compute_nc_sparse(L_sparse, M=16,
+                                             block_size=block_size)
+            self.assertTrue(np.allclose(nc, nc_sparse))
+
+    def test_sparse_neighbors(self):
+        # k_nearest * N for short tracks, logarithmic for long ones
+        self.assertEqual(SF.sparse_neighbors(200, 0.06), 12)
+        self.assertEqual(SF.sparse_neighbors(10000, 0.06), 28)
+
+    def test_sparse_novelty_curve(self):
+        # Short enough for both recurrence matrices to have the same links
+        F = np.random.random((200, 12))
+        nc = SF.novelty_curve(F, 3, 16, 0.06)
+        nc_sparse = SF.novelty_curve(F, 3, 16, 0.06, sparse=True)
+        self.assertEqual(nc.shape, nc_sparse.shape)
+        self.assertTrue(np.allclose(nc, nc_sparse, atol=1e-5))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""
+Unit tests for the SI-PLCA decomposition.
+"""
+
+import unittest
+import numpy as np
+
+from msaf.algorithms.siplca import plca
+from msaf.algorithms.siplca import segmenter
+
+
+# Original (loop-based) implementations, used as reference
+def reconstruct_loop(W, Z, H, circular=False):
+    F, rank, win = W.shape
+    rank, T = H.shape
+    WZH = np.zeros((F, T))
+    for tau in xrange(win):
+        WZH += np.dot(W[:, :, tau] * Z, plca.shift(H, tau, 1, circular))
+    return WZH
+
+
+def estep_loop(V, W, Z, H, circular=False):
+    F, rank, win = W.shape
+    WZH = reconstruct_loop(W, Z, H, circular)
+    WZ = W * Z[np.newaxis, :, np.newaxis]
+    VdivWZH = (V / (WZH + plca.EPS))[:, :, np.newaxis]
+    VRW = np.zeros(W.shape)
+    VRH = np.zeros(H.T.shape)
+    for tau in xrange(win):
+        Ht = plca.shift(H, tau, 1, circular)
+        tmp = WZ[:, :, tau][:, np.newaxis, :] * Ht.T[np.newaxis, :, :] * \
+            VdivWZH
+        VRW[:, :, tau] += tmp.sum(1)
+        VRH += plca.shift(tmp.sum(0), -tau, 0, circular)
+    return WZH, VRW, VRH
+
+
+class TestSIPLCA(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(123)
+
+    def random_params(self, F, T, rank, win):
+        V = plca.normalize(np.random.rand(F, T))
+        W = plca.normalize(np.random.rand(F, rank, win), [0, 2])
+        Z = plca.normalize(np.random.rand(rank))
+        H = plca.normalize(np.random.rand(rank, T), 1)
+        # Sparse activations, as found by the segmenter
+        H[np.random.rand(rank, T) > 0.2] *= 1e-12
+        return V, W, Z, H
+
+    def test_reconstruct(self):
+        for T, win, circular in [(100, 1, False), (100, 10, False),
+                                 (100, 10, True), (50, 60, False),
+                                 (50, 60, True)]:
+            V, W, Z, H = self.random_params(12, T, 3, win)
+            WZH = plca.SIPLCA.reconstruct(W, Z, H, circular=circular)
+            self.assertTrue(np.allclose(WZH, reconstruct_loop(W, Z, H,
+                                                              circular)))
+
+    def test_estep(self):
+        for T, rank, win, circular in [(100, 3, 1, False),
+                                       (200, 4, 60, False),
+                                       (200, 4, 60, True),
+                                       (50, 2, 60, True)]:
+            V, W, Z, H = self.random_params(12, T, rank, win)
+            model = plca.SIPLCA(V, rank, win=win, circular=circular)
+            logprob, WZH = model.do_estep(W, Z, H)
+            WZH_ref, VRW_ref, VRH_ref = estep_loop(V, W, Z, H, circular)
+            self.assertTrue(np.allclose(WZH, WZH_ref))
+            self.assertTrue(np.allclose(model.VRW, VRW_ref))
+            self.assertTrue(np.allclose(model.VRH, VRH_ref))
+            self.assertTrue(np.allclose(logprob, model.compute_logprob(
+                W, Z, H, WZH_ref)))
+
+    def test_segment_song_restarts(self):
+        # Repeating patterns, so that there are segments to find
+        seq = np.tile(np.random.rand(12, 20), 8)
+        kwargs = dict(rank=3, win=8, niter=10, nrep=2, seed=1, maxretries=2,
+                      min_segment_length=4, printiter=100)
+        outputs = [segmenter.segment_song(seq, n_jobs=n_jobs, **kwargs)
+                   for n_jobs in [1, 1, 3]]
+
+        # Same results for the same seed, regardless of the processes
+        for labels, W, Z, H, segfun, norm in outputs[1:]:
+            self.assertTrue(np.array_equal(labels, outputs[0][0]))
+            self.assertTrue(np.array_equal(W, outputs[0][1]))
+            self.assertTrue(np.array_equal(H, outputs[0][3]))
+            self.assertEqual(norm, outputs[0][5])
+
+if __name__ == '__main__':
+    unittest.main()
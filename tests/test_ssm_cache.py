@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""
+Unit tests for the SSM cache.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from scipy.spatial import distance
+
+import msaf
+from msaf import ssm_cache
+
+
+class TestSSMCache(unittest.TestCase):
+
+    def setUp(self):
+        self.settings = (msaf.SSMCache.enabled, msaf.SSMCache.max_size,
+                         msaf.SSMCache.cache_dir)
+        msaf.SSMCache.enabled = True
+        msaf.SSMCache.max_size = 2 ** 28
+        msaf.SSMCache.cache_dir = None
+        ssm_cache.clear()
+
+        # Count the distances that are actually computed
+        self.n_computed = 0
+        self.compute_distances = ssm_cache.compute_distances
+
+        def compute_distances(X, metric):
+            self.n_computed += 1
+            return self.compute_distances(X, metric)
+        ssm_cache.compute_distances = compute_distances
+
+        self.X = np.random.random((100, 12))
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        ssm_cache.compute_distances = self.compute_distances
+        msaf.SSMCache.enabled, msaf.SSMCache.max_size, \
+            msaf.SSMCache.cache_dir = self.settings
+        ssm_cache.clear()
+        shutil.rmtree(self.cache_dir)
+
+    def test_hits_and_misses(self):
+        D = ssm_cache.get_distances(self.X, "euclidean", feature="hpcp")
+        self.assertTrue(np.allclose(D, distance.pdist(self.X, "euclidean")))
+        self.assertEqual(self.n_computed, 1)
+
+        # Same features, metric and parameters
+        D_hit = ssm_cache.get_distances(self.X.copy(), "euclidean",
+                                        feature="hpcp")
+        self.assertTrue(D_hit is D)
+        self.assertEqual(self.n_computed, 1)
+
+        # Other metric, parameters or features
+        ssm_cache.get_distances(self.X, "seuclidean", feature="hpcp")
+        ssm_cache.get_distances(self.X, "euclidean", feature="mfcc")
+        ssm_cache.get_distances(self.X, "euclidean", feature="hpcp",
+                                m_median=16)
+        ssm_cache.get_distances(self.X[:50], "euclidean", feature="hpcp")
+        self.assertEqual(self.n_computed, 5)
+
+    def test_find_distances(self):
+        self.assertTrue(ssm_cache.find_distances(self.X, "euclidean") is None)
+        D = ssm_cache.get_distances(self.X, "euclidean")
+        self.assertTrue(ssm_cache.find_distances(self.X, "euclidean") is D)
+        self.assertEqual(self.n_computed, 1)
+
+    def test_disabled(self):
+        msaf.SSMCache.enabled = False
+        ssm_cache.get_distances(self.X, "euclidean")
+        D = ssm_cache.get_distances(self.X, "euclidean")
+        self.assertEqual(self.n_computed, 2)
+        self.assertTrue(D.flags.writeable)
+        self.assertTrue(ssm_cache.find_distances(self.X, "euclidean") is None)
+
+    def test_read_only(self):
+        D = ssm_cache.get_distances(self.X, "euclidean")
+        self.assertFalse(D.flags.writeable)
+
+        def write():
+            D[0] = 0
+        self.assertRaises(ValueError, write)
+
+    def test_lru(self):
+        Xs = [np.random.random((100, 12)) for i in xrange(3)]
+        nbytes = ssm_cache.get_distances(Xs[0], "euclidean").nbytes
+        msaf.SSMCache.max_size = 2 * nbytes
+        ssm_cache.get_distances(Xs[1], "euclidean")
+
+        # Using the oldest entry makes it the most recent one
+        ssm_cache.get_distances(Xs[0], "euclidean")
+        ssm_cache.get_distances(Xs[2], "euclidean")
+        self.assertEqual(self.n_computed, 3)
+        self.assertTrue(ssm_cache.find_distances(Xs[1], "euclidean") is None)
+        self.assertTrue(ssm_cache.find_distances(Xs[0], "euclidean")
+                        is not None)
+        self.assertTrue(ssm_cache.find_distances(Xs[2], "euclidean")
+                        is not None)
+
+        # Entries larger than the whole cache are not kept
+        msaf.SSMCache.max_size = nbytes / 2
+        ssm_cache.get_distances(Xs[1], "euclidean")
+        self.assertTrue(ssm_cache.find_distances(Xs[1], "euclidean") is None)
+
+    def test_disk(self):
+        msaf.SSMCache.cache_dir = self.cache_dir
+        D = ssm_cache.get_distances(self.X, "euclidean", feature="hpcp")
+        self.assertEqual([os.path.splitext(name)[1]
+                          for name in os.listdir(self.cache_dir)], [".npy"])
+
+        # Read back from disk once it is out of memory
+        ssm_cache.clear()
+        D_disk = ssm_cache.get_distances(self.X, "euclidean", feature="hpcp")
+        self.assertEqual(self.n_computed, 1)
+        self.assertTrue(np.array_equal(D, D_disk))
+        self.assertFalse(D_disk.flags.writeable)
+
+        # Corrupt entries are recomputed
+        ssm_cache.clear()
+        for name in os.listdir(self.cache_dir):
+            with open(os.path.join(self.cache_dir, name), "w") as f:
+                f.write("corrupt")
+        ssm_cache.get_distances(self.X, "euclidean", feature="hpcp")
+        self.assertEqual(self.n_computed, 2)
+
+    def test_shared_by_segmenters(self):
+        from msaf.algorithms.foote import segmenter as foote
+        from msaf.algorithms.sf import segmenter as sf
+
+        # The matrices of each segmenter are derived from the same distances
+        D = ssm_cache.get_distances(self.X, "euclidean")
+        self.assertTrue(np.allclose(foote.distances_to_ssm(D),
+                                    foote.compute_ssm(self.X, "euclidean")))
+        sf.novelty_curve(self.X, 3, 16, 0.06,
+                         get_distances=ssm_cache.get_distances)
+        sf.novelty_curve(self.X, 3, 16, 0.04,
+                         get_distances=ssm_cache.get_distances)
+        self.assertEqual(self.n_computed, 2)
+
+if __name__ == '__main__':
+    unittest.main()
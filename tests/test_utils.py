@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+"""
+Unit tests for the MSAF utils module.
+"""
+
+import unittest
+import numpy as np
+from scipy.spatial import distance
+
+import msaf.utils as U
+
+
+def chroma_to_tonnetz_loop(C):
+    """Original (loop-based) implementation of the chroma to Tonnetz
+    transform, used as reference."""
+    N = C.shape[0]
+    T = np.zeros((N, 6))
+
+    r1 = 1      # Fifths
+    r2 = 1      # Minor
+    r3 = 0.5    # Major
+
+    # Generate Transformation matrix
+    phi = np.zeros((6, 12))
+    for i in range(6):
+        for j in range(12):
+            if i % 2 == 0:
+                fun = np.sin
+            else:
+                fun = np.cos
+
+            if i < 2:
+                phi[i, j] = r1 * fun(j * 7 * np.pi / 6.)
+            elif i >= 2 and i < 4:
+                phi[i, j] = r2 * fun(j * 3 * np.pi / 2.)
+            else:
+                phi[i, j] = r3 * fun(j * 2 * np.pi / 3.)
+
+    # Do the transform to tonnetz
+    for i in range(N):
+        for d in range(6):
+            denom = float(C[i, :].sum())
+            if denom == 0:
+                T[i, d] = 0
+            else:
+                T[i, d] = 1 / denom * (phi[d, :] * C[i, :]).sum()
+
+    return T
+
+
+def resample_mx_loop(X, incolpos, outcolpos):
+    """Original (loop-based) implementation of resample_mx, used as
+    reference. The input columns are clipped at 0, so that the output times
+    before incolpos[0] take the values of the first column (the original
+    raised IndexError)."""
+    noutcols = len(outcolpos)
+    Y = np.zeros((X.shape[0], noutcols))
+    # assign 'end times' to final columns
+    if outcolpos.max() > incolpos.max():
+        incolpos = np.concatenate([incolpos, [outcolpos.max()]])
+        X = np.concatenate([X, X[:, -1].reshape(X.shape[0], 1)], axis=1)
+    outcolpos = np.concatenate([outcolpos, [outcolpos[-1]]])
+    # durations (default weights) of input columns)
+    incoldurs = np.concatenate([np.diff(incolpos), [1]])
+
+    for c in range(noutcols):
+        firstincol = max(0, np.sum(incolpos <= outcolpos[c]) - 1)
+        firstincolnext = max(0, np.sum(incolpos < outcolpos[c + 1]) - 1)
+        lastincol = max(firstincol, firstincolnext)
+        # default weights
+        wts = np.array(incoldurs[firstincol:lastincol + 1], dtype=float)
+        # now fix up by partial overlap at ends
+        if len(wts) > 1:
+            wts[0] = wts[0] - (outcolpos[c] - incolpos[firstincol])
+            wts[-1] = wts[-1] - (incolpos[lastincol + 1] - outcolpos[c + 1])
+        wts = wts * 1. / sum(wts)
+        Y[:, c] = np.dot(X[:, firstincol:lastincol + 1], wts)
+    # done
+    return Y
+
+
+class TestUtils(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(123)
+
+    def test_chroma_to_tonnetz(self):
+        C = np.random.random((100, 12))
+        C[[0, 50, 99]] = 0  # Silent frames
+        T = U.chroma_to_tonnetz(C)
+        self.assertEqual(T.shape, (100, 6))
+        self.assertTrue(np.allclose(T, chroma_to_tonnetz_loop(C)))
+        self.assertTrue(np.all(T[[0, 50, 99]] == 0))
+
+    def test_chroma_to_tonnetz_stack(self):
+        Cs = np.random.random((5, 40, 12))
+        Cs[2, 10] = 0
+        Ts = U.chroma_to_tonnetz(Cs)
+        self.assertEqual(Ts.shape, (5, 40, 6))
+        for C, T in zip(Cs, Ts):
+            self.assertTrue(np.allclose(T, chroma_to_tonnetz_loop(C)))
+
+    def test_resample_mx(self):
+        X = np.array([[1., 2., 3., 4., 5., 6.]])
+        incolpos = np.arange(6)
+        outcolpos = np.array([0, 1.5, 3, 3.2, 5.5])
+        Y = U.resample_mx(X, incolpos, outcolpos)
+        # Duration-weighted averages of the overlapping columns
+        self.assertTrue(np.allclose(Y, [[(1 + 0.5 * 2) / 1.5,
+                                         (0.5 * 2 + 3) / 1.5,
+                                         4,
+                                         (0.8 * 4 + 5 + 0.5 * 6) / 2.3,
+                                         6]]))
+
+        # Several matrices in one pass
+        X2 = np.random.random((3, 6))
+        Y1, Y2 = U.resample_mx([X, X2], incolpos, outcolpos)
+        self.assertTrue(np.allclose(Y1, Y))
+        self.assertTrue(np.allclose(
+            Y2, U.resample_mx(X2, incolpos, outcolpos)))
+
+        # Output columns starting before the first input column
+        Y = U.resample_mx(X, incolpos + 1, np.array([0, 0.5, 2.5]))
+        self.assertTrue(np.allclose(Y, [[1, (1.5 * 1 + 0.5 * 2) / 2, 2]]))
+
+    def test_resample_mx_loop(self):
+        for i in xrange(20):
+            # Irregular columns, with output columns before the first and
+            # after the last input columns
+            X = np.random.random((4, 50))
+            incolpos = 1 + np.cumsum(np.random.uniform(0.1, 2, 50))
+            outcolpos = np.sort(np.concatenate((
+                np.random.uniform(0, incolpos[0], 2),
+                np.random.uniform(incolpos[0], incolpos[-1], 15),
+                np.random.uniform(incolpos[-1], incolpos[-1] + 3, 2))))
+            self.assertTrue(np.allclose(
+                U.resample_mx(X, incolpos, outcolpos),
+                resample_mx_loop(X, incolpos, outcolpos)))
+
+            # Fewer input than output columns
+            self.assertTrue(np.allclose(
+                U.resample_mx(X[:, :5], incolpos[:5], outcolpos),
+                resample_mx_loop(X[:, :5], incolpos[:5], outcolpos)))
+
+    def test_recurrence_matrix(self):
+        X = np.random.random((5, 100))
+        D = distance.cdist(X.T, X.T, metric="sqeuclidean")
+        for width in [0, 1, 3]:
+            R = U.recurrence_matrix(X, k=6, width=width).toarray()
+            for i in xrange(100):
+                # Nearest neighbors outside the band
+                d = D[i].copy()
+                d[max(0, i - width + 1):i + width] = np.inf
+                self.assertEqual(set(np.where(R[i])[0]),
+                                 set(np.argsort(d)[:6]))
+
+            # Mutual neighbors
+            R_sym = U.recurrence_matrix(X, k=6, width=width, sym=True)
+            self.assertTrue(np.array_equal(R_sym.toarray(), R * R.T))
+
+    def test_recurrence_from_distances(self):
+        X = np.random.random((5, 100))
+        D = distance.squareform(distance.pdist(X.T, metric="sqeuclidean"))
+        for width in [0, 1, 3]:
+            for sym in [False, True]:
+                R = U.recurrence_matrix(X, k=6, width=width, sym=sym)
+                self.assertTrue(np.array_equal(
+                    U.recurrence_from_distances(D, k=6, width=width, sym=sym),
+                    R.toarray()))
+
+if __name__ == '__main__':
+    unittest.main()
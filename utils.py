@@ -8,11 +8,12 @@ __license__ = "GPL"
 __version__ = "1.0"
 __email__ = "oriol@nyu.edu"
 
-import copy
 import mir_eval
 import numpy as np
 import os
 import scipy.io.wavfile
+import scipy.sparse
+import scipy.spatial
 
 import msaf
 
@@ -52,68 +53,94 @@ def resample_mx(X, incolpos, outcolpos):
     Y is a similar matrix, with time boundaries defined by
     outcolpos.  Each column of Y is a duration-weighted average of
     the overlapping columns of X.
+    X can also be a list of matrices with the same number of columns, in
+    which case all of them are resampled in one pass and a list is returned.
+    Output times before incolpos[0] take the values of the first column.
     2010-04-14 Dan Ellis dpwe@ee.columbia.edu  based on samplemx/beatavg
     -> python: TBM, 2011-11-05, TESTED
+    -> vectorized using the cumulative integral of X, O(frames + beats)
     """
-    noutcols = len(outcolpos)
-    Y = np.zeros((X.shape[0], noutcols))
+    # Stack multiple matrices
+    split_idxs = None
+    if isinstance(X, (list, tuple)):
+        split_idxs = np.cumsum([x.shape[0] for x in X])[:-1]
+        X = np.vstack(X)
+    X = np.asarray(X, dtype=float)
+    incolpos = np.asarray(incolpos, dtype=float)
+    outcolpos = np.asarray(outcolpos, dtype=float)
+
     # assign 'end times' to final columns
     if outcolpos.max() > incolpos.max():
         incolpos = np.concatenate([incolpos, [outcolpos.max()]])
-        X = np.concatenate([X, X[:, -1].reshape(X.shape[0], 1)], axis=1)
-    outcolpos = np.concatenate([outcolpos, [outcolpos[-1]]])
-    # durations (default weights) of input columns)
-    incoldurs = np.concatenate([np.diff(incolpos), [1]])
-
-    for c in range(noutcols):
-        firstincol = np.where(incolpos <= outcolpos[c])[0][-1]
-        firstincolnext = np.where(incolpos < outcolpos[c+1])[0][-1]
-        lastincol = max(firstincol, firstincolnext)
-        # default weights
-        wts = copy.deepcopy(incoldurs[firstincol:lastincol+1])
-        # now fix up by partial overlap at ends
-        if len(wts) > 1:
-            wts[0] = wts[0] - (outcolpos[c] - incolpos[firstincol])
-            wts[-1] = wts[-1] - (incolpos[lastincol+1] - outcolpos[c+1])
-        wts = wts * 1. / sum(wts)
-        Y[:, c] = np.dot(X[:, firstincol:lastincol+1], wts)
+        X = np.concatenate([X, X[:, -1:]], axis=1)
+    outstarts = outcolpos
+    outends = np.concatenate([outcolpos[1:], [outcolpos[-1]]])
+
+    # first and last input columns overlapping each output column (the
+    # first input column also covers the times before it)
+    firstincol = np.searchsorted(incolpos, outstarts, side="right") - 1
+    firstincol = np.maximum(firstincol, 0)
+    lastincol = np.searchsorted(incolpos, outends, side="left") - 1
+    lastincol = np.maximum(firstincol, lastincol)
+
+    # cumulative integral of X at the start of each input column
+    cumX = np.zeros(X.shape)
+    cumX[:, 1:] = np.cumsum(X[:, :-1] * np.diff(incolpos), axis=1)
+
+    def integral(t, col):
+        """Integral of X from the first input column to the times t, that
+        are within the input columns col."""
+        return cumX[:, col] + X[:, col] * (t - incolpos[col])
+
+    # output columns within a single input column simply take its value,
+    # the rest are the average of X over their duration
+    Y = X[:, firstincol]
+    span = lastincol > firstincol
+    Y[:, span] = (integral(outends[span], lastincol[span]) -
+                  integral(outstarts[span], firstincol[span])) / \
+        (outends[span] - outstarts[span])
+
     # done
+    if split_idxs is not None:
+        return np.split(Y, split_idxs, axis=0)
     return Y
 
 
+def _tonnetz_phi(r1=1, r2=1, r3=0.5):
+    """Generates the 6x12 chroma to Tonnetz transformation matrix, with radii
+    for the fifths (r1), minor (r2) and major (r3) thirds circles."""
+    j = np.arange(12)
+    return np.asarray([r1 * np.sin(j * 7 * np.pi / 6.),
+                       r1 * np.cos(j * 7 * np.pi / 6.),
+                       r2 * np.sin(j * 3 * np.pi / 2.),
+                       r2 * np.cos(j * 3 * np.pi / 2.),
+                       r3 * np.sin(j * 2 * np.pi / 3.),
+                       r3 * np.cos(j * 2 * np.pi / 3.)])
+
+# Chroma to Tonnetz transformation matrix
+TONNETZ_PHI = _tonnetz_phi()
+
+
 def chroma_to_tonnetz(C):
-    """Transforms chromagram to Tonnetz (Harte, Sandler, 2006)."""
-    N = C.shape[0]
-    T = np.zeros((N, 6))
-
-    r1 = 1      # Fifths
-    r2 = 1      # Minor
-    r3 = 0.5    # Major
-
-    # Generate Transformation matrix
-    phi = np.zeros((6, 12))
-    for i in range(6):
-        for j in range(12):
-            if i % 2 == 0:
-                fun = np.sin
-            else:
-                fun = np.cos
-
-            if i < 2:
-                phi[i, j] = r1 * fun(j * 7 * np.pi / 6.)
-            elif i >= 2 and i < 4:
-                phi[i, j] = r2 * fun(j * 3 * np.pi / 2.)
-            else:
-                phi[i, j] = r3 * fun(j * 2 * np.pi / 3.)
-
-    # Do the transform to tonnetz
-    for i in range(N):
-        for d in range(6):
-            denom = float(C[i, :].sum())
-            if denom == 0:
-                T[i, d] = 0
-            else:
-                T[i, d] = 1 / denom * (phi[d, :] * C[i, :]).sum()
+    """Transforms chromagram to Tonnetz (Harte, Sandler, 2006).
+
+    Parameters
+    ----------
+    C: np.array((..., N, 12))
+        Chromagram, or stack of chromagrams with the same number of frames.
+
+    Returns
+    -------
+    T: np.array((..., N, 6))
+        Tonnetz. Frames with no energy are mapped to zeros.
+    """
+    C = np.asarray(C, dtype=float)
+
+    # Do the transform to tonnetz, normalizing by the energy of each frame
+    T = np.dot(C, TONNETZ_PHI.T)
+    denom = C.sum(axis=-1)[..., np.newaxis]
+    nonzero = denom != 0
+    T = np.where(nonzero, T / np.where(nonzero, denom, 1), 0)
 
     return T
 
@@ -163,6 +190,133 @@ def get_time_frames(dur, anal):
     return np.linspace(0, dur, num=n_frames)
 
 
+def knn(X, k, metric="euclidean"):
+    """Finds the k nearest neighbors of each column of X using a KD-tree,
+    without storing all the pairwise distances (memory grows with N * k, so
+    k should grow slower than N for long inputs).
+
+    Parameters
+    ----------
+    X : np.array((d, N))
+        Data matrix (one point per column, as in librosa).
+    k : int
+        Number of neighbors (each point is its own nearest neighbor).
+    metric : str
+        Distance metric: "euclidean", "sqeuclidean", "seuclidean" or
+        "cosine" (i.e. the ones that preserve the euclidean neighbors of
+        some transformation of X).
+
+    Returns
+    -------
+    dists : np.array((N, k))
+        Sorted distances to the neighbors of each point.
+    idxs : np.array((N, k))
+        Indeces of the neighbors of each point.
+    """
+    X = np.asarray(X, dtype=np.float64).T
+    if metric == "seuclidean":
+        X = X / np.sqrt(np.var(X, axis=0, ddof=1))
+    elif metric == "cosine":
+        X = X / np.sqrt(np.sum(X ** 2, axis=1))[:, np.newaxis]
+    elif metric not in ["euclidean", "sqeuclidean"]:
+        raise ValueError("Metric %s not supported by knn" % metric)
+
+    k = min(k, X.shape[0])
+    dists, idxs = scipy.spatial.cKDTree(X).query(X, k=k)
+    dists = dists.reshape(X.shape[0], k)
+    idxs = idxs.reshape(X.shape[0], k)
+    if metric == "sqeuclidean":
+        dists = dists ** 2
+    elif metric == "cosine":
+        dists = dists ** 2 / 2.
+    return dists, idxs
+
+
+def recurrence_matrix(X, k=None, width=1, metric="sqeuclidean", sym=False):
+    """Sparse version of librosa.segment.recurrence_matrix: each point is
+    linked to its k nearest neighbors outside the diagonal band of the given
+    width, found with a KD-tree (see knn) instead of computing all the
+    pairwise distances.
+
+    Parameters
+    ----------
+    X : np.array((d, N))
+        Data matrix (one point per column).
+    k : int
+        Number of neighbors of each point (None for 2 * sqrt(N - 2 * width
+        + 1), as librosa).
+    width : int
+        Only link points i and j if |i - j| >= width.
+    metric : str
+        Distance metric (see knn).
+    sym : bool
+        Whether to only keep the mutual neighbors.
+
+    Returns
+    -------
+    R : scipy.sparse.csr_matrix((N, N))
+        Recurrence matrix (ones where points are linked).
+    """
+    N = X.shape[1]
+    if k is None:
+        k = 2 * np.ceil(np.sqrt(N - 2 * width + 1))
+    k = int(k)
+
+    # Query enough neighbors to discard the ones inside the band
+    dists, idxs = knn(X, k + max(0, 2 * width - 1), metric=metric)
+    rows = np.repeat(np.arange(N), idxs.shape[1]).reshape(idxs.shape)
+    valid = np.abs(rows - idxs) >= width
+
+    # Keep the first k valid neighbors of each point
+    valid &= np.cumsum(valid, axis=1) <= k
+    R = scipy.sparse.csr_matrix(
+        (np.ones(valid.sum(), dtype=np.float32),
+         (rows[valid], idxs[valid])), shape=(N, N))
+    if sym:
+        R = R.multiply(R.T).tocsr()
+    return R
+
+
+def recurrence_from_distances(D, k=None, width=1, sym=False):
+    """Dense recurrence matrix as librosa.segment.recurrence_matrix, but
+    computed from the (square) matrix of pairwise distances D, so that the
+    distances can be shared (e.g. through the SSM cache).
+
+    Parameters
+    ----------
+    D : np.array((N, N))
+        Pairwise distances (see scipy.spatial.distance.squareform).
+    k : int
+        Number of neighbors of each point (None for 2 * sqrt(N - 2 * width
+        + 1), as librosa).
+    width : int
+        Only link points i and j if |i - j| >= width.
+    sym : bool
+        Whether to only keep the mutual neighbors.
+
+    Returns
+    -------
+    R : np.array((N, N), dtype=bool)
+        Recurrence matrix.
+    """
+    N = D.shape[0]
+    if k is None:
+        k = 2 * np.ceil(np.sqrt(N - 2 * width + 1))
+    k = int(k)
+
+    # Max out the diagonal band
+    D = np.array(D, dtype=np.float64)
+    lags = np.abs(np.subtract.outer(np.arange(N), np.arange(N)))
+    D[lags < width] = np.inf
+
+    # Link each point to its k nearest neighbors
+    R = np.zeros((N, N), dtype=bool)
+    R[np.arange(N)[:, np.newaxis], np.argsort(D, axis=1)[:, :k]] = True
+    if sym:
+        R = R * R.T
+    return R
+
+
 def remove_empty_segments(times, labels):
     """Removes empty segments if needed."""
     inters = times_to_intervals(times)